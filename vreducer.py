@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import json
 import sys
 from argparse import ArgumentParser
 from os import mkdir
-from os.path import dirname, join, exists, basename
+from copy import copy
+from os.path import dirname, join, exists, basename, splitext
 
-from vrm.debug import print_stat
-from vrm.reducer import reduce_vroid
-from vrm.vrm import load
+from vrm.debug import print_stat, print_image_sizes
+from vrm.imageinfo import image_sizes
+from vrm.report import runtime_report, print_report
+from vrm.validator import ValidationError
+from vrm.vrm import load, load_json
 
 
 def parse_texture_size(texture_size_option):
@@ -17,6 +21,69 @@ def parse_texture_size(texture_size_option):
     return int(w), int(h)
 
 
+def parse_variant(variant_option):
+    # 出力バリエーションオプションのパース(幅,高さ[,s])
+    option = variant_option.split(',')
+    replace_shade_color = len(option) > 2 and option[2] == 's'
+    return parse_texture_size(','.join(option[:2])), replace_shade_color
+
+
+def variant_path(path, texture_size, replace_shade_color):
+    # バリエーションごとの出力ファイル名(model_512x512_s.vrm)
+    name, ext = splitext(path)
+    suffix = '_{}x{}'.format(*texture_size) + ('_s' if replace_shade_color else '')
+    return name + suffix + ext
+
+
+def report_cost(opt, before, gltf, json_path):
+    # 実行時負荷の見積もりを変換前後で比較表示、JSON出力
+    after = runtime_report(gltf)
+    if opt.report:
+        print_report(before, after)
+    if json_path:
+        with open(json_path, 'w') as fo:
+            json.dump({'before': before, 'after': after}, fo, indent=2, sort_keys=True)
+
+
+def save_vrm(vrm, save_path, force, interleaved):
+    # 上書き確認
+    if not force and exists(save_path):
+        if raw_input('Already exists file. Overwrite?(y/N):').lower() not in ['y', 'yes']:
+            return
+
+    # vrm保存
+    try:
+        vrm.save(save_path, interleaved)
+    except ValidationError as e:
+        print 'invalid model, not saved:'
+        for error in e.errors:
+            print '\t', error
+        return
+    print 'saved.'
+
+
+def watch_vrm(opt, path, save_path):
+    # ファイル更新のたびに変換(入力が変わらない処理は前回の結果を再利用)
+    from vrm.imagecache import MB
+    from vrm.reducer import reduce_vroid
+    from vrm.watch import Watcher, watch
+
+    def reduce(gltf, image_cache, memo):
+        print '-' * 30
+        return reduce_vroid(gltf, opt.replace_shade_color, parse_texture_size(opt.texture_size),
+                            opt.remove_unused_bones, opt.max_bone_weights,
+                            opt.reduce_spring_bones, opt.max_spring_joints, opt.merge_meshes,
+                            opt.remove_hidden_body, opt.jpeg_quality, opt.compress_level, image_cache, memo,
+                            opt.min_outline_pixels, opt.texel_density, opt.merge_tinted_materials)
+
+    def save(vrm):
+        print '-' * 30
+        print_stat(vrm.gltf)
+        save_vrm(vrm, save_path, True, opt.interleave)  # 確認せずに上書き
+
+    watch(path, Watcher(reduce, opt.image_cache_mb * MB), save)
+
+
 def main(argv):
     from vrm.version import app_name
     parser = ArgumentParser()
@@ -24,37 +91,167 @@ def main(argv):
     parser.add_argument('-s', '--replace-shade-color', action='store_true', help=u'Replace shade color to main color.')
     parser.add_argument('-t', '--texture-size', default='2048,2048',
                         help=u'Change texture size less equal than this size. (-t 512,512)')
+    parser.add_argument('-b', '--remove-unused-bones', action='store_true',
+                        help=u'Remove bones without vertex weights (except humanoid and spring bones).')
+    parser.add_argument('-w', '--max-bone-weights', type=int, choices=[1, 2, 3, 4],
+                        help=u'Limit bone influences per vertex. (-w 2)')
+    parser.add_argument('-m', '--merge-meshes', action='store_true',
+                        help=u'Merge primitives sharing material and skin across meshes.')
+    parser.add_argument('--remove-hidden-body', action='store_true',
+                        help=u'Remove body triangles fully covered by clothes. (slow)')
+    parser.add_argument('-r', '--reduce-spring-bones', action='store_true',
+                        help=u'Merge spring bone groups and remove unused or redundant colliders.')
+    parser.add_argument('--max-spring-joints', type=int,
+                        help=u'Thin spring bone chains until the joint count fits this budget. (--max-spring-joints 64)')
+    parser.add_argument('--min-outline-pixels', type=float, metavar='PIXELS',
+                        help=u'Disable MToon outlines estimated to cover fewer pixels than this at 2m on a 1080p '
+                             u'screen, then merge materials that became identical. (--min-outline-pixels 50)')
+    parser.add_argument('--merge-tinted-materials', action='store_true',
+                        help=u'Bake _Color into texture copies and merge MToon materials that differ only in color '
+                             u'and texture into one atlas.')
+    parser.add_argument('--texel-density', action='store_true',
+                        help=u'Shrink atlas slots and textures whose texel density (pixels per meter of surface) '
+                             u'is at least twice that of the largest material.')
+    parser.add_argument('--jpeg-quality', type=int, metavar='QUALITY',
+                        help=u'Save opaque textures as JPEG with this quality (1-95) when smaller than PNG.')
+    parser.add_argument('--compress-level', type=int, default=6, choices=range(10),
+                        help=u'PNG compression level (0-9). 9 also optimizes filters. (default 6)')
+    parser.add_argument('--interleave', action='store_true',
+                        help=u'Save vertex attributes interleaved in one strided buffer view per mesh.')
+    parser.add_argument('--gltf', action='store_true',
+                        help=u'Save as .gltf with images and geometry in separate files named by content hash.')
+    parser.add_argument('--image-cache-mb', type=int, default=512, metavar='MB',
+                        help=u'Memory limit of decoded images kept for reuse between steps. (default 512)')
+    parser.add_argument('--payload-memory-mb', type=int, metavar='MB',
+                        help=u'Memory limit of buffer data. Larger or least recently used data '
+                             u'is moved to a temporary file.')
+    parser.add_argument('--variant', action='append', default=[],
+                        help=u'Output a variant with this texture size (and replaced shade color with ",s"). '
+                             u'Repeatable. Overrides -t and -s. (--variant 1024,1024 --variant 512,512,s)')
+    parser.add_argument('-p', '--profile',
+                        help=u'Reduce to fit a budget profile (cluster, mobile or a JSON file). '
+                             u'Passes and texture size are chosen from the measured model; -t is ignored.')
+    parser.add_argument('--report', action='store_true',
+                        help=u'Show estimated runtime cost (draw calls, VRAM, skinning, morphs, spring bones) '
+                             u'before and after reduction.')
+    parser.add_argument('--report-json', metavar='PATH',
+                        help=u'Write the runtime cost estimate before and after reduction as JSON.')
+    parser.add_argument('-i', '--inspect', action='store_true',
+                        help=u'Show model information and image sizes only, reading just the JSON chunk and image headers.')
+    parser.add_argument('--watch', action='store_true',
+                        help=u'Convert again whenever the file changes, reusing results of unchanged steps. '
+                             u'Overwrites the output without asking.')
     parser.add_argument('-f', '--force', action='store_true', help=u'Overwrite file if already exists same file.')
     parser.add_argument('-V', '--version', action='version', version=app_name())
     opt = parser.parse_args(argv)
+    if opt.profile and opt.variant:
+        parser.error('--profile and --variant cannot be used together')
+    if opt.watch and (opt.profile or opt.variant or opt.inspect):
+        parser.error('--watch cannot be used with --profile, --variant or --inspect')
 
     path = opt.path
     print path
 
+    if opt.inspect:
+        # JSONチャンク、画像ヘッダーのみ読み込んで表示
+        _, gltf, bin_offset = load_json(path)
+        print_stat(gltf)
+        print_image_sizes(image_sizes(path, gltf, bin_offset))
+        return
+
+    # 変換時のみPillowを読み込む
+    from vrm.reducer import reduce_vroid, prepare_vroid, finish_vroid
+    from vrm.budget import load_profile, reduce_for_budget, print_budget
+    from vrm.imagecache import ImageCache, MB
+    from vrm.payload import PayloadStore, set_active_store
+
+    save_dir = join(dirname(path), 'result')
+    if not exists(save_dir):
+        mkdir(save_dir)  # 出力先作成
+    save_path = join(save_dir, basename(path))
+    if opt.gltf:
+        save_path = splitext(save_path)[0] + '.gltf'  # 拡張子で保存形式を切り替える
+
+    if opt.payload_memory_mb is not None:
+        # 読み込み前に切り替え、大きなバイトデータを一時ファイルに退避できるようにする
+        set_active_store(PayloadStore(opt.payload_memory_mb * MB))
+
+    if opt.watch:
+        watch_vrm(opt, path, save_path)
+        return
+
     # vrm読み込み
     vrm = load(path)
 
     print_stat(vrm.gltf)
+    before = runtime_report(vrm.gltf) if opt.report or opt.report_json else None
+
+    if opt.variant:
+        # テクスチャサイズに依存しない処理、画像のデコードを共有して複数のバリエーションを出力
+        variants = map(parse_variant, opt.variant)
+        largest = max(variants, key=lambda v: v[0][0] * v[0][1])[0]
+        image_cache = ImageCache(opt.image_cache_mb * MB)
+        atlases = []
+        print '-' * 30
+        prepared = prepare_vroid(vrm.gltf, largest, opt.remove_unused_bones, opt.max_bone_weights,
+                                 opt.reduce_spring_bones, opt.max_spring_joints, opt.merge_meshes,
+                                 opt.remove_hidden_body, image_cache, atlases,
+                                 min_outline_pixels=opt.min_outline_pixels, texel_density=opt.texel_density,
+                                 merge_tinted=opt.merge_tinted_materials)
+        for texture_size, replace_shade_color in variants:
+            print '-' * 30
+            print 'variant: {}x{}{}'.format(texture_size[0], texture_size[1],
+                                            ' (replace shade color)' if replace_shade_color else '')
+            variant = copy(vrm)
+            variant.gltf = finish_vroid(prepared, atlases, replace_shade_color, texture_size, image_cache,
+                                        opt.jpeg_quality, opt.compress_level, texel_density=opt.texel_density)
+            print_stat(variant.gltf)
+            if before:
+                json_path = opt.report_json and variant_path(opt.report_json, texture_size, replace_shade_color)
+                report_cost(opt, before, variant.gltf, json_path)
+            save_vrm(variant, variant_path(save_path, texture_size, replace_shade_color), opt.force, opt.interleave)
+        return
+
+    if opt.profile:
+        # プロファイルの上限に収まるように軽量化
+        try:
+            profile = load_profile(opt.profile)
+        except ValueError as e:
+            print e
+            return
+        print '-' * 30
+        options = {'merge_meshes': opt.merge_meshes, 'remove_bones': opt.remove_unused_bones,
+                   'max_bone_weights': opt.max_bone_weights, 'reduce_springs': opt.reduce_spring_bones,
+                   'max_spring_joints': opt.max_spring_joints, 'remove_hidden': opt.remove_hidden_body,
+                   'min_outline_pixels': opt.min_outline_pixels, 'texel_density': opt.texel_density,
+                   'merge_tinted': opt.merge_tinted_materials}
+        vrm.gltf, report, over = reduce_for_budget(vrm.gltf, profile, opt.replace_shade_color, options,
+                                                   opt.jpeg_quality, opt.compress_level,
+                                                   ImageCache(opt.image_cache_mb * MB))
+        print '-' * 30
+        print_stat(vrm.gltf)
+        print_budget(report, profile['limits'])
+        if before:
+            report_cost(opt, before, vrm.gltf, opt.report_json)
+        if over:
+            print 'warning: over budget:', ', '.join(key for key, _, _ in over)
+        save_vrm(vrm, save_path, opt.force, opt.interleave)
+        return
 
     print '-' * 30
-    vrm.gltf = reduce_vroid(vrm.gltf, opt.replace_shade_color, parse_texture_size(opt.texture_size))
+    vrm.gltf = reduce_vroid(vrm.gltf, opt.replace_shade_color, parse_texture_size(opt.texture_size),
+                            opt.remove_unused_bones, opt.max_bone_weights,
+                            opt.reduce_spring_bones, opt.max_spring_joints, opt.merge_meshes,
+                            opt.remove_hidden_body, opt.jpeg_quality, opt.compress_level,
+                            ImageCache(opt.image_cache_mb * MB), min_outline_pixels=opt.min_outline_pixels,
+                            texel_density=opt.texel_density, merge_tinted=opt.merge_tinted_materials)
 
     print '-' * 30
     print_stat(vrm.gltf)
+    if before:
+        report_cost(opt, before, vrm.gltf, opt.report_json)
 
-    save_dir = join(dirname(path), 'result')
-    if not exists(save_dir):
-        mkdir(save_dir)  # 出力先作成
-
-    save_path = join(save_dir, basename(path))
-    # 上書き確認
-    if not opt.force and exists(save_path):
-        if raw_input('Already exists file. Overwrite?(y/N):').lower() not in ['y', 'yes']:
-            return
-
-    # vrm保存
-    vrm.save(save_path)
-    print 'saved.'
+    save_vrm(vrm, save_path, opt.force, opt.interleave)
 
 
 if __name__ == '__main__':
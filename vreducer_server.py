@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+from argparse import ArgumentParser
+
+from vrm.server import serve
+
+
+def parse_address(address_option):
+    # 待ち受けアドレスオプションのパース(ポート、ホスト:ポート、unix:パス)
+    if address_option.startswith('unix:'):
+        return address_option[len('unix:'):]
+    host, _, port = address_option.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def main(argv):
+    from vrm.version import app_name
+    parser = ArgumentParser()
+    parser.add_argument('address', nargs='?', default='127.0.0.1:8080',
+                        help=u'Listen address. PORT, HOST:PORT or unix:PATH. (default 127.0.0.1:8080)')
+    parser.add_argument('-j', '--workers', type=int, default=2, help=u'Number of worker processes. (default 2)')
+    parser.add_argument('-q', '--max-queue', type=int, default=4,
+                        help=u'Requests allowed to wait for a worker. More requests get 503. (default 4)')
+    parser.add_argument('--max-tasks', type=int,
+                        help=u'Restart each worker process after this many conversions.')
+    parser.add_argument('--payload-memory-mb', type=int, metavar='MB',
+                        help=u'Memory limit of buffer data per worker. Larger or least recently used data '
+                             u'is moved to a temporary file.')
+    parser.add_argument('-V', '--version', action='version', version=app_name())
+    opt = parser.parse_args(argv)
+
+    payload_memory = opt.payload_memory_mb * 1024 * 1024 if opt.payload_memory_mb is not None else None
+    serve(parse_address(opt.address), opt.workers, opt.max_queue, opt.max_tasks, payload_memory)
+
+
+if __name__ == '__main__':
+    reload(sys)
+    sys.setdefaultencoding(sys.getfilesystemencoding())
+
+    main(sys.argv[1:])
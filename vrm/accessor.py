@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import struct
+
+from model import Accessor, BufferView
+
+"""
+アクセッサーのバイナリデータ読み書き
+"""
+
+# componentType -> structフォーマット
+COMPONENT_FORMATS = {
+    5120: 'b',  # BYTE
+    5121: 'B',  # UNSIGNED_BYTE
+    5122: 'h',  # SHORT
+    5123: 'H',  # UNSIGNED_SHORT
+    5125: 'I',  # UNSIGNED_INT
+    5126: 'f'  # FLOAT
+}
+
+# type -> 要素数
+TYPE_SIZES = {
+    'SCALAR': 1,
+    'VEC2': 2,
+    'VEC3': 3,
+    'VEC4': 4,
+    'MAT2': 4,
+    'MAT3': 9,
+    'MAT4': 16
+}
+
+
+def component_size(accessor):
+    """
+    :param accessor: アクセッサー
+    :return: 1要素の成分数
+    """
+    return TYPE_SIZES[accessor['type']]
+
+
+def element_size(accessor):
+    """
+    :param accessor: アクセッサー
+    :return: 1要素のバイト数
+    """
+    fmt = COMPONENT_FORMATS[accessor['componentType']]
+    return struct.calcsize('<' + fmt) * component_size(accessor)
+
+
+def read_accessor(accessor):
+    """
+    アクセッサーの値を読み込む
+    :param accessor: アクセッサー(bufferViewはインスタンス参照)
+    :return: 全要素の成分を並べたタプル
+    """
+    view = accessor['bufferView']
+    data = view['data']
+    offset = accessor.get('byteOffset', 0)
+    count = accessor['count']
+    n = component_size(accessor)
+    fmt = COMPONENT_FORMATS[accessor['componentType']]
+    size = element_size(accessor)
+    stride = view.get('byteStride', size)
+    if stride == size:
+        # 詰めて格納されている場合は一括で読み込む
+        return struct.unpack_from('<{}{}'.format(count * n, fmt), data, offset)
+
+    element = struct.Struct('<{}{}'.format(n, fmt))
+    values = []
+    for i in xrange(count):
+        values.extend(element.unpack_from(data, offset + i * stride))
+    return tuple(values)
+
+
+def read_elements(accessor):
+    """
+    アクセッサーの値を要素ごとに読み込む
+    :param accessor: アクセッサー
+    :return: 要素(タプル)のリスト
+    """
+    values = read_accessor(accessor)
+    n = component_size(accessor)
+    return [values[i:i + n] for i in xrange(0, len(values), n)]
+
+
+def pack_values(values, component_type):
+    """
+    値をバイトデータに変換する
+    :param values: 値リスト
+    :param component_type: componentType
+    :return: バイトデータ
+    """
+    fmt = COMPONENT_FORMATS[component_type]
+    return struct.pack('<{}{}'.format(len(values), fmt), *values)
+
+
+def value_bounds(values, n):
+    """
+    成分ごとの最小値、最大値を計算する
+    :param values: 値リスト
+    :param n: 1要素の成分数
+    :return: 最小値リスト、最大値リスト
+    """
+    columns = [values[i::n] for i in xrange(n)]
+    return [min(c) for c in columns], [max(c) for c in columns]
+
+
+def packed_accessor(accessor, values):
+    """
+    元のアクセッサーと同じ型で値を詰め直した新しいアクセッサーを作成する
+    :param accessor: 元のアクセッサー
+    :param values: 新しい値リスト(全要素の成分を並べたもの)
+    :return: 新しいアクセッサー、新しいbufferView
+    """
+    n = component_size(accessor)
+    view = accessor['bufferView']
+    new_view = BufferView({'data': pack_values(values, accessor['componentType'])})
+    if 'target' in view:
+        new_view['target'] = view['target']
+
+    new_accessor = Accessor({k: v for k, v in accessor.items()
+                             if k not in ['bufferView', 'byteOffset', 'count', 'min', 'max']})
+    new_accessor['bufferView'] = new_view
+    new_accessor['byteOffset'] = 0
+    new_accessor['count'] = len(values) // n
+    if values and ('min' in accessor or 'max' in accessor):
+        # 範囲情報を持っていた場合は再計算する
+        new_accessor['min'], new_accessor['max'] = value_bounds(values, n)
+    return new_accessor, new_view
+
+
+def element_bytes(accessor):
+    """
+    アクセッサーの要素を詰めたバイトデータを返す
+    :param accessor: アクセッサー
+    :return: バイトデータ(要素数 * 要素バイト数)
+    """
+    view = accessor['bufferView']
+    data = view['data']
+    offset = accessor.get('byteOffset', 0)
+    size = element_size(accessor)
+    stride = view.get('byteStride', size)
+    if stride == size:
+        return data[offset:offset + size * accessor['count']]
+    return b''.join(data[offset + i * stride:offset + i * stride + size] for i in xrange(accessor['count']))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from copy import deepcopy
+from io import BytesIO
+from math import floor, ceil
+
+from PIL import Image, ImageDraw
+
+from accessor import read_accessor
+from memo import memoized
+
+"""
+テクスチャのアルファ値による描画モード(不透明、カットアウト、半透明)の選択
+マテリアルが実際に使うUV範囲のアルファ値を調べ、半透明描画は必要な場合のみ残す
+"""
+
+OPAQUE = 'Opaque'
+CUTOUT = 'Cutout'
+TRANSPARENT = 'Transparent'
+
+# 描画モードごとのMToonの設定値
+RENDER_MODES = {
+    OPAQUE: {
+        'renderType': 'Opaque', 'renderQueue': 2000, 'keyword': None, 'alphaMode': 'OPAQUE',
+        'floatProperties': {'_BlendMode': 0, '_SrcBlend': 1, '_DstBlend': 0, '_ZWrite': 1, '_AlphaToMask': 0}
+    },
+    CUTOUT: {
+        'renderType': 'TransparentCutout', 'renderQueue': 2450, 'keyword': '_ALPHATEST_ON', 'alphaMode': 'MASK',
+        'floatProperties': {'_BlendMode': 1, '_SrcBlend': 1, '_DstBlend': 0, '_ZWrite': 1, '_AlphaToMask': 1}
+    },
+    TRANSPARENT: {
+        'renderType': 'Transparent', 'renderQueue': 3000, 'keyword': '_ALPHABLEND_ON', 'alphaMode': 'BLEND',
+        'floatProperties': {'_BlendMode': 2, '_SrcBlend': 5, '_DstBlend': 10, '_ZWrite': 0, '_AlphaToMask': 0}
+    }
+}
+
+# 描画モードを表すキーワード
+ALPHA_KEYWORDS = ['_ALPHATEST_ON', '_ALPHABLEND_ON', '_ALPHAPREMULTIPLY_ON']
+
+# カットアウトの閾値の既定値
+DEFAULT_CUTOFF = 0.5
+
+# 1つの三角形を描画する繰り返し範囲の数の上限(超える三角形はテクスチャ全体を使用するとみなす)
+MAX_WRAP_TILES = 64
+
+
+def render_mode(vrm_material):
+    """
+    :param vrm_material: VRMマテリアル
+    :return: 現在の描画モード
+    """
+    keywords = vrm_material['keywordMap']
+    render_type = vrm_material['tagMap'].get('RenderType')
+    if keywords.get('_ALPHABLEND_ON') or keywords.get('_ALPHAPREMULTIPLY_ON') or render_type == 'Transparent':
+        return TRANSPARENT
+    if keywords.get('_ALPHATEST_ON') or render_type == 'TransparentCutout':
+        return CUTOUT
+    return OPAQUE
+
+
+def set_render_mode(vrm_material, material, mode):
+    """
+    描画モードのキーワード、タグ、描画キュー、ブレンド設定、glTFのalphaModeをまとめて変更する
+    :param vrm_material: VRMマテリアル
+    :param material: 同名のglTFマテリアル(なければNone)
+    :param mode: 描画モード
+    """
+    settings = RENDER_MODES[mode]
+    keywords = {k: v for k, v in vrm_material['keywordMap'].items() if k not in ALPHA_KEYWORDS}
+    if settings['keyword']:
+        keywords[settings['keyword']] = True
+    vrm_material['keywordMap'] = keywords
+    vrm_material['tagMap']['RenderType'] = settings['renderType']
+    vrm_material['renderQueue'] = settings['renderQueue']
+
+    float_props = vrm_material['floatProperties']
+    for name, value in settings['floatProperties'].items():
+        if name in float_props or name != '_AlphaToMask':
+            float_props[name] = value
+    cutoff = float_props.get('_Cutoff', DEFAULT_CUTOFF)
+    if mode == CUTOUT and not 0 < cutoff <= 1:
+        float_props['_Cutoff'] = cutoff = DEFAULT_CUTOFF  # アルファ値0を透明、255を不透明に判定する閾値にする
+
+    if material is not None:
+        material['alphaMode'] = settings['alphaMode']
+        if mode == CUTOUT:
+            material['alphaCutoff'] = cutoff
+        elif 'alphaCutoff' in material:
+            del material['alphaCutoff']
+
+
+def texcoords(accessor):
+    """
+    :param accessor: TEXCOORD_nのアクセッサー
+    :return: UV座標リスト
+    """
+    values = read_accessor(accessor)
+    if accessor['componentType'] != 5126:
+        scale = 255.0 if accessor['componentType'] == 5121 else 65535.0
+        values = [x / scale for x in values]
+    return [values[i:i + 2] for i in xrange(0, len(values), 2)]
+
+
+def uv_mask(primitives, size):
+    """
+    プリミティブの三角形をUV空間に描画したマスク画像を作成する
+    範囲外のUVは繰り返しとして扱い、バイリニア補間で参照される縁のピクセルも含める
+    :param primitives: 同じテクスチャを使うプリミティブリスト
+    :param size: テクスチャサイズ
+    :return: Lモードのマスク画像(使用するピクセルが255)
+    """
+    w, h = size
+    mask = Image.new('L', size, 0)
+    draw = ImageDraw.Draw(mask)
+    for primitive in primitives:
+        if primitive.get('mode', 4) != 4 or 'TEXCOORD_0' not in primitive['attributes']:
+            continue  # 三角形リスト以外は対象外
+        uvs = texcoords(primitive['attributes']['TEXCOORD_0'])
+        indices = read_accessor(primitive['indices']) if 'indices' in primitive else xrange(len(uvs))
+        for i in xrange(0, len(indices) - 2, 3):
+            triangle = [uvs[indices[i + k]] for k in xrange(3)]
+            # 三角形が含まれる繰り返し範囲を0～1に移動し、はみ出した分は重なる全ての範囲に描画する
+            du, dv = floor(min(u for u, _ in triangle)), floor(min(v for _, v in triangle))
+            points = [((u - du) * w, (v - dv) * h) for u, v in triangle]
+            tiles_u = max(1, int(ceil(max(x for x, _ in points) / w)))
+            tiles_v = max(1, int(ceil(max(y for _, y in points) / h)))
+            if tiles_u * tiles_v > MAX_WRAP_TILES:
+                draw.rectangle([0, 0, w, h], fill=255)  # テクスチャ全体を使用するとみなす
+                continue
+            for tu in xrange(tiles_u):
+                for tv in xrange(tiles_v):
+                    draw.polygon([(x - tu * w, y - tv * h) for x, y in points], fill=255, outline=255)
+    return mask
+
+
+def alpha_histogram(img, mask):
+    """
+    :param img: PIL.Imageオブジェクト
+    :param mask: uv_maskで作成したマスク画像
+    :return: マスク範囲のアルファ値のヒストグラム(256要素、アルファ値がなければNone)
+    """
+    if img.mode not in ['LA', 'RGBA', 'PA', 'P'] or (img.mode == 'P' and 'transparency' not in img.info):
+        return None
+    alpha = img.convert('RGBA').getchannel('A')
+    if alpha.size != mask.size:
+        mask = mask.resize(alpha.size)
+    return alpha.histogram(mask)
+
+
+def required_mode(histogram):
+    """
+    :param histogram: アルファ値のヒストグラム(Noneでアルファ値なし)
+    :return: アルファ値の表現に必要な描画モード
+    """
+    if histogram is None or not any(histogram[:255]):
+        return OPAQUE  # 全て255
+    if not any(histogram[1:255]):
+        return CUTOUT  # 0と255の2値
+    return TRANSPARENT
+
+
+def analyzed_mode(data, primitives, image_cache=None):
+    """
+    :param data: _MainTexの画像ファイルのバイトデータ
+    :param primitives: マテリアルを使うプリミティブリスト
+    :param image_cache: デコード済み画像キャッシュ
+    :return: 必要な描画モード(使用範囲がなければNone)
+    """
+    img = image_cache.load(data) if image_cache is not None else Image.open(BytesIO(data))
+    mask = uv_mask(primitives, img.size)
+    if not mask.getbbox():
+        return None
+    return required_mode(alpha_histogram(img, mask))
+
+
+def optimize_render_modes(gltf, image_cache=None, memo=None):
+    """
+    半透明、カットアウトのマテリアルを、テクスチャの使用範囲のアルファ値で表現できる最も軽い描画モードに変更する
+    (不透明なら不透明、2値ならカットアウトにする。_Colorのアルファ値が1未満なら変更しない)
+    :param gltf: glTFオブジェクト
+    :param image_cache: デコード済み画像キャッシュ
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
+    :return: 描画モード変更後のglTFオブジェクト
+    """
+    gltf = deepcopy(gltf)
+    materials = {m['name']: m for m in gltf['materials']}
+    primitives = {}  # マテリアル名 -> プリミティブリスト
+    for mesh in gltf['meshes']:
+        for primitive in mesh['primitives']:
+            primitives.setdefault(primitive['material']['name'], []).append(primitive)
+
+    order = [OPAQUE, CUTOUT, TRANSPARENT]
+    for vrm_material in gltf['extensions']['VRM']['materialProperties']:
+        current = render_mode(vrm_material)
+        if current == OPAQUE or vrm_material['shader'] != 'VRM/MToon':
+            continue
+        if vrm_material['vectorProperties'].get('_Color', [1, 1, 1, 1])[3] < 1:
+            continue  # 色のアルファ値で透過している
+        if '_MainTex' not in vrm_material['textureProperties'] or vrm_material['name'] not in primitives:
+            continue
+        data = vrm_material['textureProperties']['_MainTex']['source']['bufferView']['data']
+        used = primitives[vrm_material['name']]
+        mode = memoized(memo, lambda: analyzed_mode(data, used, image_cache), 'render_mode', data, used)
+        if mode is None or order.index(mode) >= order.index(current):
+            continue  # 半透明化、カットアウト化はしない
+        print '{}: {} -> {}'.format(vrm_material['name'], current, mode)
+        set_render_mode(vrm_material, materials.get(vrm_material['name']), mode)
+    return gltf
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import struct
+import zlib
+from io import BytesIO
+
+from PIL import Image, ImageChops
+
+from payload import load_payload
+
+"""
+帯(行ごとの領域)単位の結合画像作成とPNGの逐次書き出し
+メモリ使用量が結合画像全体ではなく帯の大きさで決まるようにする
+"""
+
+# 帯の高さ(ピクセル)
+BAND_HEIGHT = 256
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNGのSubフィルタ(左のピクセルとの差分)
+PNG_FILTER_SUB = b'\x01'
+
+
+class PNGWriter(object):
+    def __init__(self, fo, size, compress_level=6):
+        """
+        RGBA画像を行の帯ごとに書き出すPNGライター
+        :param fo: 書き出し先ファイルオブジェクト
+        :param size: 画像サイズ
+        :param compress_level: zlibの圧縮レベル
+        """
+        self.fo = fo
+        self.width, self.height = size
+        self.rows = 0
+        self.compressor = zlib.compressobj(compress_level)
+        fo.write(PNG_SIGNATURE)
+        # 8bit RGBA、インターレースなし
+        self.write_chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 6, 0, 0, 0))
+
+    def write_chunk(self, chunk_type, data):
+        self.fo.write(struct.pack('>I', len(data)))
+        self.fo.write(chunk_type)
+        self.fo.write(data)
+        self.fo.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    def write_band(self, band):
+        """
+        帯を書き出す
+        :param band: 画像幅のRGBA画像
+        """
+        assert band.mode == 'RGBA' and band.size[0] == self.width
+        # 1ピクセル右にずらした画像との差(256の剰余)が各バイトのSubフィルタ値になる
+        shifted = Image.new('RGBA', band.size, (0, 0, 0, 0))
+        shifted.paste(band.crop((0, 0, self.width - 1, band.size[1])), (1, 0))
+        raw = ImageChops.subtract_modulo(band, shifted).tobytes()
+        stride = self.width * 4
+        rows = b''.join(PNG_FILTER_SUB + raw[i:i + stride] for i in xrange(0, len(raw), stride))
+        self.write_data(self.compressor.compress(rows))
+        self.rows += band.size[1]
+
+    def write_data(self, data):
+        if data:
+            self.write_chunk(b'IDAT', data)
+
+    def close(self):
+        assert self.rows == self.height
+        self.write_data(self.compressor.flush())
+        self.write_chunk(b'IEND', b'')
+
+
+def decoded_source(data, size, image_cache=None):
+    """
+    貼り付け元画像を読み込む
+    JPEGは貼り付けサイズ以上の範囲で縮小デコードする(縮小した画像は共有のデコード済み画像とは別に保持する)
+    :param data: 画像ファイルのバイトデータ(またはPayload)
+    :param size: 貼り付けサイズ
+    :param image_cache: デコード済み画像キャッシュ(ImageCache)
+    :return: PIL.Imageオブジェクト
+    """
+    if image_cache is not None:
+        return image_cache.draft(data, size)
+    image = Image.open(BytesIO(load_payload(data)))
+    if image.format == 'JPEG':
+        image.draft(image.mode, size)
+    return image
+
+
+def compose_atlas(fo, sources, placements, size, image_cache=None, band_height=BAND_HEIGHT, compress_level=6):
+    """
+    貼り付け元画像を帯ごとに縮小、配置してPNGとして書き出す
+    各帯では、帯と重なる範囲の貼り付け元領域のみを縮小する(Image.resizeのbox指定)
+    :param fo: 書き出し先ファイルオブジェクト
+    :param sources: 名前 -> 画像ファイルのバイトデータ(またはPayload)
+    :param placements: 名前 -> {'pos': 配置位置, 'size': 配置サイズ}
+    :param size: 結合画像サイズ
+    :param image_cache: デコード済み画像キャッシュ
+    :param band_height: 帯の高さ
+    :param compress_level: zlibの圧縮レベル
+    """
+    width, height = size
+    images = {name: decoded_source(data, placements[name]['size'], image_cache) for name, data in sources.items()}
+    writer = PNGWriter(fo, size, compress_level)
+    for top in xrange(0, height, band_height):
+        bottom = min(top + band_height, height)
+        band = Image.new('RGBA', (width, bottom - top), (0, 0, 0, 0))
+        for name, image in images.items():
+            (x, y), (w, h) = placements[name]['pos'], placements[name]['size']
+            y0, y1 = max(y, top), min(y + h, bottom)
+            if y0 >= y1 or w <= 0:
+                continue  # 帯と重ならない
+            # 帯と重なる行に対応する貼り付け元の範囲
+            source_w, source_h = image.size
+            scale = source_h / float(h)
+            box = (0, (y0 - y) * scale, source_w, (y1 - y) * scale)
+            resized = image.resize((w, y1 - y0), Image.BICUBIC, box)  # 透過境界部分にノイズが出ないようにBICUBICを使用
+            band.paste(resized, (x, y0 - top))
+        writer.write_band(band)
+    writer.close()
+
+
+def atlas_png(sources, placements, size, image_cache=None, band_height=BAND_HEIGHT):
+    """
+    :param sources: 名前 -> 画像ファイルのバイトデータ(またはPayload)
+    :param placements: 名前 -> {'pos': 配置位置, 'size': 配置サイズ}
+    :param size: 結合画像サイズ
+    :param image_cache: デコード済み画像キャッシュ
+    :param band_height: 帯の高さ
+    :return: 結合画像(pngファイルのバイトデータ)
+    """
+    bio = BytesIO()
+    compose_atlas(bio, sources, placements, size, image_cache, band_height)
+    return bio.getvalue()
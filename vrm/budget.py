@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import json
+from copy import deepcopy
+from os.path import exists
+
+from encoder import DEFAULT_COMPRESS_LEVEL
+from imagecache import ImageCache
+from reducer import prepare_vroid, finish_vroid
+from report import runtime_report, format_value, REPORT_ITEMS
+
+"""
+プラットフォームごとの負荷上限(プロファイル)に合わせた軽量化計画
+"""
+
+MB = 1024 * 1024
+
+# 負荷上限プロファイル(目安の値)
+# limits: runtime_reportの項目名 -> 上限値
+# texture_sizes: 試すテクスチャサイズ上限(大きい順)
+# max_bone_weights: 1頂点あたりのボーン影響数の上限値(Noneで制限しない)
+# min_outline_pixels: ドローコール数が上限を超えた場合に、見積もったピクセル数がこれ未満のアウトラインを無効にする
+# texel_density: テクスチャ量が上限を超えた場合に、テクセル密度に合わせてテクスチャを縮小する
+PROFILES = {
+    'cluster': {
+        'limits': {
+            'materials': 8,
+            'draw_calls': 20,
+            'triangles': 70000,
+            'texture_bytes': 48 * MB,
+            'joints': 150,
+            'spring_joints': 128
+        },
+        'texture_sizes': [2048, 1024, 512],
+        'max_bone_weights': None,
+        'min_outline_pixels': 50,
+        'texel_density': False
+    },
+    'mobile': {
+        'limits': {
+            'materials': 6,
+            'draw_calls': 12,
+            'triangles': 32000,
+            'texture_bytes': 12 * MB,
+            'joints': 75,
+            'spring_joints': 48,
+            'skinned_vertices': 20000
+        },
+        'texture_sizes': [1024, 512, 256],
+        'max_bone_weights': 2,
+        'min_outline_pixels': 150,
+        'texel_density': True
+    }
+}
+
+
+# JSONファイルのプロファイルの項目 -> 省略時の値
+PROFILE_DEFAULTS = {
+    'limits': {},
+    'texture_sizes': [2048],
+    'max_bone_weights': None,
+    'min_outline_pixels': None,
+    'texel_density': False
+}
+
+
+def validate_profile(profile):
+    """
+    JSONファイルのプロファイルの項目を確認する
+    :param profile: プロファイル辞書
+    :raise ValueError: 不明な項目、上限値のない項目がある場合
+    """
+    if not isinstance(profile, dict):
+        raise ValueError('profile must be a JSON object')
+    unknown = sorted(set(profile) - set(PROFILE_DEFAULTS))
+    if unknown:
+        raise ValueError('unknown profile keys: {} (available: {})'.format(
+            ', '.join(unknown), ', '.join(sorted(PROFILE_DEFAULTS))))
+    limits = profile.get('limits', {})
+    if not isinstance(limits, dict):
+        raise ValueError('profile limits must be a JSON object')
+    items = [key for key, _, _ in REPORT_ITEMS]
+    unknown = sorted(set(limits) - set(items))
+    if unknown:
+        raise ValueError('unknown profile limits: {} (available: {})'.format(', '.join(unknown), ', '.join(items)))
+
+
+def load_profile(name):
+    """
+    プロファイルを取得する
+    :param name: プロファイル名、またはプロファイルのJSONファイルパス
+    :return: プロファイル辞書
+    :raise ValueError: 不明なプロファイル名、不正なJSONファイルの場合
+    """
+    if name in PROFILES:
+        return deepcopy(PROFILES[name])
+    if exists(name):
+        with open(name) as fi:
+            profile = json.load(fi)
+        validate_profile(profile)
+        for key, value in PROFILE_DEFAULTS.items():
+            profile.setdefault(key, deepcopy(value))
+        return profile
+    raise ValueError('unknown profile: {} (available: {})'.format(name, ', '.join(sorted(PROFILES))))
+
+
+def over_budget(report, limits):
+    """
+    上限を超えている項目を列挙する
+    :param report: 実行時負荷の見積もり辞書
+    :param limits: 項目名 -> 上限値
+    :return: (項目名, 見積もり値, 上限値)リスト
+    """
+    return [(key, report[key], limit) for key, limit in sorted(limits.items()) if report[key] > limit]
+
+
+# 計画で対応する処理がある項目(それ以外の項目は上限を超えても計画に反映されない)
+PLANNED_LIMITS = ['materials', 'draw_calls', 'texture_bytes', 'joints', 'spring_joints', 'triangles',
+                  'skinned_vertices']
+
+
+def plan_reduction(report, profile):
+    """
+    上限を超えている項目から実行する処理とパラメータを決める
+    マテリアル、テクスチャ結合は常に行い、その他の処理は対応する項目が上限を超えている場合のみ行う
+    PLANNED_LIMITS以外の項目(頂点数、モーフターゲット数など)を減らす処理はない
+    :param report: 変換前の実行時負荷の見積もり辞書
+    :param profile: プロファイル辞書
+    :return: prepare_vroidの引数辞書
+    """
+    limits = profile['limits']
+    over = set(key for key, _, _ in over_budget(report, limits))
+    plan = {
+        'merge_meshes': bool(over & {'materials', 'draw_calls'}),
+        # マテリアル数を減らせるのは色違いのマテリアルの統合のみ(メッシュ結合は同じマテリアル同士を結合する)
+        'merge_tinted': bool(over & {'materials', 'draw_calls'}),
+        'remove_bones': 'joints' in over,
+        'max_bone_weights': profile.get('max_bone_weights'),
+        'reduce_springs': 'spring_joints' in over,
+        'max_spring_joints': limits['spring_joints'] if 'spring_joints' in over else None,
+        'min_outline_pixels': profile.get('min_outline_pixels') if 'draw_calls' in over else None,
+        'texel_density': bool(profile.get('texel_density')) and 'texture_bytes' in over,
+        # 三角形数の削減は服に隠れる体の削除のみ(ポリゴン削減は行わない)
+        'remove_hidden': bool(over & {'triangles', 'skinned_vertices'})
+    }
+    return plan
+
+
+def reduce_for_budget(gltf, profile, replace_shade_color=False, options=None, jpeg_quality=None,
+                      compress_level=DEFAULT_COMPRESS_LEVEL, image_cache=None):
+    """
+    プロファイルの上限に収まるように軽量化する
+    上限内のモデルは変換しない。テクスチャサイズは上限に収まる最大のサイズを選ぶ
+    :param gltf: glTFオブジェクト
+    :param profile: プロファイル辞書
+    :param replace_shade_color: Trueで陰色を消す
+    :param options: 計画に追加で有効にするprepare_vroidの引数辞書(コマンドライン指定)
+    :param jpeg_quality: 不透明な画像をJPEGにする場合の品質(Noneで可逆圧縮のみ)
+    :param compress_level: PNGの圧縮レベル(0～9)
+    :param image_cache: デコード済み画像キャッシュ(Noneで既定の上限のキャッシュを使用する)
+    :return: glTFオブジェクト、変換後の見積もり辞書、上限を超えている項目リスト
+    """
+    limits = profile['limits']
+    report = runtime_report(gltf)
+    if not over_budget(report, limits):
+        print 'already within budget, skip reduction.'
+        return gltf, report, []
+
+    plan = plan_reduction(report, profile)
+    unplanned = [key for key, _, _ in over_budget(report, limits) if key not in PLANNED_LIMITS]
+    if unplanned:
+        print 'no reduction for:', ', '.join(unplanned)
+    for key, value in (options or {}).items():
+        plan[key] = plan.get(key) or value  # 明示指定された処理も行う
+    print 'plan:', ', '.join('{}={}'.format(k, v) for k, v in sorted(plan.items()) if v)
+
+    # テクスチャサイズに依存しない処理は1回だけ行い、テクスチャサイズのみ下げて試す
+    sizes = [(size, size) for size in profile['texture_sizes']]
+    image_cache = ImageCache() if image_cache is None else image_cache
+    atlases = []
+    prepared = prepare_vroid(gltf, sizes[0], image_cache=image_cache, atlases=atlases, **plan)
+    for texture_size in sizes:
+        print 'texture size: {}x{}'.format(*texture_size)
+        gltf = finish_vroid(prepared, atlases, replace_shade_color, texture_size, image_cache, jpeg_quality,
+                            compress_level, texel_density=plan['texel_density'])
+        report = runtime_report(gltf)
+        if report['texture_bytes'] <= limits.get('texture_bytes', report['texture_bytes']):
+            break
+
+    return gltf, report, over_budget(report, limits)
+
+
+def print_budget(report, limits):
+    """
+    プロファイルの上限と見積もりを表示する
+    :param report: 実行時負荷の見積もり辞書
+    :param limits: 項目名 -> 上限値
+    """
+    print 'budget:'
+    for key, limit in sorted(limits.items()):
+        unit = 'MB' if key.endswith('_bytes') else None
+        print '\t{}: {} / {}{}'.format(key, format_value(report[key], unit), format_value(limit, unit),
+                                      '' if report[key] <= limit else ' (over)')
@@ -2,7 +2,7 @@
 # -*- coding:utf-8 -*-
 from copy import deepcopy
 
-from util import unique
+from util import unique_instances
 
 
 def used_material_names(gltf):
@@ -21,7 +21,8 @@ def clean_gltf_materials(gltf):
     :param gltf: glTFオブジェクト
     :return: 新しいマテリアルリスト
     """
-    return filter(lambda m: m['name'] in used_material_names(gltf), gltf['materials'])
+    used = set(primitive['material'] for mesh in gltf['meshes'] for primitive in mesh['primitives'])
+    return [m for m in gltf['materials'] if m in used]
 
 
 def clean_vrm_materials(gltf):
@@ -32,7 +33,8 @@ def clean_vrm_materials(gltf):
     """
     # VRMマテリアル削除
     vrm = gltf['extensions']['VRM']
-    return filter(lambda m: m['name'] in used_material_names(gltf), vrm['materialProperties'])
+    used = used_material_names(gltf)
+    return [m for m in vrm['materialProperties'] if m['name'] in used]
 
 
 def list_textures(gltf):
@@ -63,7 +65,7 @@ def clean_textures(gltf):
     :param gltf: glTFオブジェクト
     :return: 新しいテクスチャリスト
     """
-    return unique(list_textures(gltf))
+    return unique_instances(list_textures(gltf))
 
 
 def clean_images(gltf):
@@ -110,7 +112,7 @@ def clean_accesors(gltf):
     :param gltf: glTFオブジェクト
     :return: 新しいアクセッサーリスト
     """
-    return unique(list_accessors(gltf))
+    return unique_instances(list_accessors(gltf))
 
 
 def list_buffer_views(gltf):
@@ -130,7 +132,7 @@ def clean_buffer_views(gltf):
     :param gltf: glTFオブジェクト
     :return: 新しいバッファービューリスト
     """
-    return unique(list_buffer_views(gltf))
+    return unique_instances(list_buffer_views(gltf))
 
 
 def clean(gltf):
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from spring import spring_cost
 
 
 def print_stat(gltf):
@@ -18,3 +19,19 @@ def print_stat(gltf):
     print 'primitives:', sum([len(m['primitives']) for m in meshes])
     for mesh in meshes:
         print '\t', mesh['name'], ':', len(mesh['primitives'])
+
+    cost = spring_cost(gltf)
+    print 'spring bones:', cost['joints']
+    print '\tgroups:', cost['groups']
+    print '\tcolliders:', cost['colliders']
+    print '\tcollision checks:', cost['collision_checks']
+
+
+def print_image_sizes(image_sizes):
+    """
+    画像サイズ表示
+    :param image_sizes: (画像名, MIMEタイプ, (幅, 高さ)またはNone)リスト
+    """
+    print 'image sizes:'
+    for name, mime_type, size in image_sizes:
+        print '\t', name, ':', mime_type, '{}x{}'.format(*size) if size else 'unknown'
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from math import sqrt, log
+
+from accessor import read_accessor
+from alpha import texcoords
+
+"""
+テクセル密度(表面1mあたりのテクスチャのピクセル数)の解析
+マテリアルごとの表面積とUV面積から、画面上の大きさに見合ったテクスチャサイズを決める
+基準より2倍以上密度の高いテクスチャは、基準の密度に近づくように縦横を1/2ずつ縮小する
+"""
+
+# 密度を揃える際の縮小の下限(縦横の小さい方)
+MIN_TEXTURE_SIZE = 64
+
+
+def triangle_area(a, b, c):
+    """
+    :param a: 頂点座標(x, y, z)
+    :param b: 頂点座標(x, y, z)
+    :param c: 頂点座標(x, y, z)
+    :return: 三角形の面積
+    """
+    ux, uy, uz = b[0] - a[0], b[1] - a[1], b[2] - a[2]
+    vx, vy, vz = c[0] - a[0], c[1] - a[1], c[2] - a[2]
+    return sqrt((uy * vz - uz * vy) ** 2 + (uz * vx - ux * vz) ** 2 + (ux * vy - uy * vx) ** 2) / 2
+
+
+def uv_triangle_area(a, b, c):
+    """
+    :param a: UV座標(u, v)
+    :param b: UV座標(u, v)
+    :param c: UV座標(u, v)
+    :return: UV空間の三角形の面積(裏返っていても正の値)
+    """
+    return abs((b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])) / 2
+
+
+def surface_areas(primitives):
+    """
+    :param primitives: 同じテクスチャを使うプリミティブリスト
+    :return: 表面積(m^2、ノードの変形は含めない)、UV空間の面積(テクスチャ全体を1とする)
+    """
+    world, uv = 0.0, 0.0
+    for primitive in primitives:
+        attributes = primitive['attributes']
+        if primitive.get('mode', 4) != 4 or 'TEXCOORD_0' not in attributes:
+            continue  # 三角形リスト以外は対象外
+        values = read_accessor(attributes['POSITION'])
+        positions = [values[i:i + 3] for i in xrange(0, len(values), 3)]
+        uvs = texcoords(attributes['TEXCOORD_0'])
+        indices = read_accessor(primitive['indices']) if 'indices' in primitive else xrange(len(uvs))
+        for i in xrange(0, len(indices) - 2, 3):
+            a, b, c = indices[i], indices[i + 1], indices[i + 2]
+            world += triangle_area(positions[a], positions[b], positions[c])
+            uv += uv_triangle_area(uvs[a], uvs[b], uvs[c])
+    return world, uv
+
+
+def texels_per_meter(areas, size):
+    """
+    :param areas: surface_areasの結果
+    :param size: テクスチャサイズ
+    :return: 表面1mあたりのピクセル数(面積がなければNone)
+    """
+    world, uv = areas
+    if world <= 0 or uv <= 0:
+        return None
+    return sqrt(uv * size[0] * size[1] / world)
+
+
+def density_size(size, density, reference):
+    """
+    :param size: テクスチャサイズ
+    :param density: テクスチャサイズでのテクセル密度(Noneで縮小しない)
+    :param reference: 基準のテクセル密度
+    :return: 基準の密度を下回らない範囲で縦横を1/2ずつ縮小したサイズ
+    """
+    if density is None or not reference or density < reference * 2:
+        return size
+    halvings = int(log(density / reference, 2))
+    w, h = size
+    while halvings > 0 and min(w, h) // 2 >= MIN_TEXTURE_SIZE:
+        w, h = w // 2, h // 2
+        halvings -= 1
+    return w, h
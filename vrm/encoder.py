@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from copy import deepcopy
+from io import BytesIO
+
+from PIL import Image, ImageChops
+
+from memo import memoized
+
+"""
+テクスチャ画像の再エンコード
+画素値が変わらない範囲で最も小さい形式(RGB、グレースケール、パレット)を選び、不透明な画像は任意でJPEGにする
+"""
+
+# PNGの圧縮レベルの既定値
+DEFAULT_COMPRESS_LEVEL = 6
+
+
+def is_opaque(img):
+    """
+    :param img: L、LA、RGB、RGBAのPIL.Imageオブジェクト
+    :return: 全ピクセルが不透明ならTrue
+    """
+    if img.mode not in ['LA', 'RGBA']:
+        return True
+    return img.getchannel('A').getextrema()[0] == 255
+
+
+def is_gray(img):
+    """
+    :param img: L、LA、RGB、RGBAのPIL.Imageオブジェクト
+    :return: 全ピクセルのRGBが同じ値ならTrue
+    """
+    if img.mode in ['L', 'LA']:
+        return True
+    r, g, b = img.split()[:3]
+    return not ImageChops.difference(r, g).getbbox() and not ImageChops.difference(g, b).getbbox()
+
+
+def exact_palette(img):
+    """
+    256色以下の画像を画素値の変わらないパレット画像に変換する
+    アルファ値はRGBごとに1つに決まる場合のみパレットの透明度(tRNS)で表す
+    :param img: RGB、RGBAのPIL.Imageオブジェクト
+    :return: パレット画像(変換できなければNone)
+    """
+    colors = img.getcolors(256)
+    if colors is None:
+        return None
+    rgb = img.convert('RGB')
+    if len(rgb.getcolors(256)) != len(colors):
+        return None  # 同じRGBで異なるアルファ値がある
+    palette = rgb.quantize(len(colors), method=0)  # 256色以下ならメディアンカットは全色を保持する
+    if ImageChops.difference(palette.convert('RGB'), rgb).getbbox():
+        return None
+    if img.mode == 'RGBA':
+        indices = Image.frombytes('L', img.size, palette.tobytes())
+        alphas = dict(c for _, c in Image.merge('LA', (indices, img.getchannel('A'))).getcolors(256 * 256))
+        transparency = bytearray(alphas.get(i, 255) for i in xrange(max(alphas) + 1))
+        palette.info['transparency'] = bytes(transparency)
+    return palette
+
+
+def reduced_mode(img):
+    """
+    画素値が変わらない範囲で色数、チャンネル数を減らす
+    :param img: PIL.Imageオブジェクト
+    :return: L、LA、RGB、RGBA、PのPIL.Imageオブジェクト
+    """
+    if img.mode not in ['L', 'LA', 'RGB', 'RGBA']:
+        img = img.convert('RGBA')
+    if img.mode in ['LA', 'RGBA'] and is_opaque(img):
+        img = img.convert(img.mode[:-1])  # アルファ値を削除
+    if is_gray(img):
+        return img.convert('L' if img.mode in ['L', 'RGB'] else 'LA')
+    return exact_palette(img) or img
+
+
+def png_bytes(img, compress_level=DEFAULT_COMPRESS_LEVEL):
+    bio = BytesIO()
+    # 最大圧縮レベルではフィルタの選択も最適化する(パレットの透明度はinfoから保存される)
+    img.save(bio, 'png', compress_level=compress_level, optimize=compress_level >= 9)
+    return bio.getvalue()
+
+
+def jpeg_bytes(img, quality, compress_level=DEFAULT_COMPRESS_LEVEL):
+    bio = BytesIO()
+    img.save(bio, 'jpeg', quality=quality, optimize=compress_level >= 9)
+    return bio.getvalue()
+
+
+def encode_image(img, jpeg_quality=None, compress_level=DEFAULT_COMPRESS_LEVEL):
+    """
+    最も小さくなる形式で画像をエンコードする
+    :param img: PIL.Imageオブジェクト
+    :param jpeg_quality: 不透明な画像をJPEGにする場合の品質(Noneで可逆圧縮のみ)
+    :param compress_level: PNGの圧縮レベル(0～9)
+    :return: 画像ファイルのバイトデータ、MIMEタイプ
+    """
+    reduced = reduced_mode(img)
+    candidates = [(png_bytes(reduced, compress_level), 'image/png')]
+    if jpeg_quality and reduced.mode in ['L', 'RGB']:
+        candidates.append((jpeg_bytes(reduced, jpeg_quality, compress_level), 'image/jpeg'))
+    return min(candidates, key=lambda c: len(c[0]))
+
+
+def encoded_image(data, jpeg_quality=None, compress_level=DEFAULT_COMPRESS_LEVEL, image_cache=None, memo=None):
+    """
+    PNG画像を再エンコードする(JPEG画像、小さくならない場合は元のまま)
+    :param data: 画像ファイルのバイトデータ
+    :param jpeg_quality: 不透明な画像をJPEGにする場合の品質(Noneで可逆圧縮のみ)
+    :param compress_level: PNGの圧縮レベル(0～9)
+    :param image_cache: デコード済み画像キャッシュ(ImageCache)
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
+    :return: 画像ファイルのバイトデータ、MIMEタイプ
+    """
+    if memo is not None:
+        return memoized(memo, lambda: encoded_image(data, jpeg_quality, compress_level, image_cache),
+                        'encoded_image', data, jpeg_quality, compress_level)
+
+    img = image_cache.get(data) if image_cache is not None else None
+    if img is None:
+        img = Image.open(BytesIO(data))
+    if img.format == 'JPEG':
+        return data, 'image/jpeg'  # 非可逆圧縮済み
+    new_data, mime_type = encode_image(img, jpeg_quality, compress_level)
+    if len(new_data) >= len(data):
+        return data, 'image/png'
+    return new_data, mime_type
+
+
+def encoded_images(gltf, jpeg_quality=None, compress_level=DEFAULT_COMPRESS_LEVEL, image_cache=None, memo=None):
+    """
+    全画像を再エンコードする
+    :param gltf: glTFオブジェクト
+    :param jpeg_quality: 不透明な画像をJPEGにする場合の品質(Noneで可逆圧縮のみ)
+    :param compress_level: PNGの圧縮レベル(0～9)
+    :param image_cache: デコード済み画像キャッシュ
+    :param memo: 処理結果のキャッシュ
+    :return: 画像再エンコード後のglTFオブジェクト
+    """
+    gltf = deepcopy(gltf)
+    for image in gltf['images']:
+        buffer_view = image['bufferView']
+        buffer_view['data'], image['mimeType'] = encoded_image(buffer_view['data'], jpeg_quality, compress_level,
+                                                               image_cache, memo)
+    return gltf
@@ -3,6 +3,11 @@
 import re
 from copy import deepcopy
 
+from accessor import element_bytes, element_size
+from cleaner import clean_buffer_views
+from index import positions
+from model import Accessor, BufferView, Image, Texture, Material, VrmMaterial, Mesh, to_json
+from util import unique
 from version import app_name
 
 
@@ -25,11 +30,18 @@ def instancing(gltf, chunks=None):
     """
     インデックス番号による参照をインスタンスデータへの直接参照に変換する
     :param gltf: glTFオブジェクト
-    :param chunks: チャンクデータリスト
+    :param chunks: バッファデータリスト(GLBのチャンク、.gltfの外部ファイル、data URI)
     :return: 変換後のglTFオブジェクト
     """
     gltf = deepcopy(gltf)
 
+    # 参照される要素を型付きのオブジェクトに変換
+    for key, element_type in [('accessors', Accessor), ('bufferViews', BufferView), ('images', Image),
+                              ('textures', Texture), ('materials', Material), ('meshes', Mesh)]:
+        gltf[key] = map(element_type, gltf[key])
+    vrm = gltf['extensions']['VRM']
+    vrm['materialProperties'] = map(VrmMaterial, vrm['materialProperties'])
+
     accessors = gltf['accessors']
     materials = gltf['materials']
     buffer_views = gltf['bufferViews']
@@ -101,77 +113,198 @@ def instancing(gltf, chunks=None):
         material['name'] = vrm_material['name'] = '{}-{:02d}'.format(material['name'], n)
 
     if not chunks:
-        # TODO: buffer URI
         return gltf
 
-    # bufferViewにchunkデータをcontentとして設定
+    # bufferViewにchunkデータをcontentとして設定(.gltfの外部バッファはメモリマップからbufferViewごとに切り出す)
     for buffer_view in buffer_views:
-        offset = buffer_view['byteOffset']
+        offset = buffer_view.get('byteOffset', 0)
         length = buffer_view['byteLength']
         chunk = chunks[buffer_view['buffer']]
-        buffer_view['data'] = chunk[offset:][:length]
+        buffer_view['data'] = chunk[offset:offset + length]
 
     return gltf
 
 
-def indexing(gltf):
+# インターリーブ時の頂点属性の並び順
+INTERLEAVE_ORDER = ['POSITION', 'NORMAL', 'TANGENT', 'TEXCOORD_0', 'TEXCOORD_1', 'COLOR_0', 'JOINTS_0', 'WEIGHTS_0']
+# byteStrideの上限値
+MAX_BYTE_STRIDE = 252
+
+
+def align(length, alignment=4):
+    """
+    :param length: バイト数
+    :param alignment: アライメント
+    :return: アライメントに揃えたバイト数
+    """
+    return (length + alignment - 1) // alignment * alignment
+
+
+def vertex_groups(gltf):
+    """
+    同じ頂点を共有する頂点属性アクセッサーのグループを列挙する
+    プリミティブ間で共有されるアクセッサーは同じグループにまとめる
+    :param gltf: glTFオブジェクト
+    :return: (頂点属性名、アクセッサー)リストのリスト
+    """
+    groups = []  # [(属性名, アクセッサー)]リストのリスト
+    group_of = {}  # アクセッサーid -> groupsのインデックス
+    for mesh in gltf['meshes']:
+        for primitive in mesh['primitives']:
+            items = primitive['attributes'].items()
+            indices = unique([group_of[id(a)] for _, a in items if id(a) in group_of])
+            if indices:
+                # 既存グループとアクセッサーを共有しているので統合する
+                target = indices[0]
+                for index in indices[1:]:
+                    for _, accessor in groups[index]:
+                        group_of[id(accessor)] = target
+                    groups[target].extend(groups[index])
+                    groups[index] = []
+            else:
+                target = len(groups)
+                groups.append([])
+            for name, accessor in items:
+                if id(accessor) not in group_of:
+                    groups[target].append((name, accessor))
+                    group_of[id(accessor)] = target
+    return [group for group in groups if group]
+
+
+def interleaved_view(group):
+    """
+    頂点属性を1つのbufferViewにインターリーブする
+    アクセッサーのbufferView、byteOffsetを新しいbufferViewに書き換える
+    :param group: (頂点属性名、アクセッサー)リスト
+    :return: 新しいbufferView、インターリーブできない場合はNone
+    """
+    accessors = [a for _, a in group]
+    if len(set(a['count'] for a in accessors)) != 1 or len(set(id(a) for a in accessors)) != len(accessors):
+        return None  # 頂点数が揃っていない、同じアクセッサーが別名で使われている
+
+    def order(item):
+        name = item[0]
+        return INTERLEAVE_ORDER.index(name) if name in INTERLEAVE_ORDER else len(INTERLEAVE_ORDER), name
+
+    group = sorted(group, key=order)
+    offsets = []
+    stride = 0
+    for _, accessor in group:
+        offsets.append(stride)
+        stride += align(element_size(accessor))  # 各属性の先頭を4バイト境界に揃える
+    if stride > MAX_BYTE_STRIDE:
+        return None
+
+    # 頂点ごとに全属性を並べる
+    count = accessors[0]['count']
+    elements = []
+    for _, accessor in group:
+        size = element_size(accessor)
+        data = element_bytes(accessor)
+        padding = b'\0' * (align(size) - size)
+        elements.append([data[i * size:(i + 1) * size] + padding for i in xrange(count)])
+    new_view = BufferView({
+        'data': b''.join(b''.join(vertex) for vertex in zip(*elements)),
+        'byteStride': stride,
+        'target': 34962  # ARRAY_BUFFER
+    })
+    for offset, (_, accessor) in zip(offsets, group):
+        accessor['bufferView'] = new_view
+        accessor['byteOffset'] = offset
+    return new_view
+
+
+def interleave(gltf):
+    """
+    プリミティブの頂点属性(POSITION, NORMAL, TEXCOORD_0, JOINTS_0, WEIGHTS_0など)を
+    頂点属性グループごとにbyteStride付きの1つのbufferViewにまとめる
+    :param gltf: glTFオブジェクト(インスタンス参照)
+    """
+    # モーフターゲット、インデックスと共有されているアクセッサーは対象外
+    others = set(id(a) for mesh in gltf['meshes'] for primitive in mesh['primitives']
+                 for a in [primitive['indices']] + [v for t in primitive.get('targets', []) for v in t.values()])
+
+    for group in vertex_groups(gltf):
+        if any(id(a) in others or 'byteStride' in a['bufferView'] for _, a in group):
+            continue
+        new_view = interleaved_view(group)
+        if new_view:
+            gltf['bufferViews'].append(new_view)
+
+    # 使われなくなったbufferViewを削除
+    gltf['bufferViews'] = clean_buffer_views(gltf)
+
+
+def indexing(gltf, interleaved=False):
     """
     参照をインデックス番号に戻す
     :param gltf: glTFオブジェクト
+    :param interleaved: Trueで頂点属性をインターリーブしたbufferViewにまとめる
     :return: 変換後のglTFオブジェクト
     """
     gltf = deepcopy(gltf)
 
+    if interleaved:
+        interleave(gltf)
+
     # bufferをchunkに戻す
     buffer_views = gltf['bufferViews']
 
     # bufferViewからchunkを生成
-    chunk = ''
+    datas = []
     offset = 0
     for buffer_view in buffer_views:
         data = buffer_view.pop('data')
         length = len(data)
+        padding = align(offset) - offset  # アクセッサーのアライメントのため4バイト境界に揃える
+        if padding:
+            datas.append(b'\0' * padding)
+            offset += padding
         buffer_view['buffer'] = 0  # 1バッファにまとめるのでインデックスは0
         buffer_view['byteOffset'] = offset
         buffer_view['byteLength'] = length
-        chunk += data
+        datas.append(data)
         offset += length
+    chunk = b''.join(datas)
     gltf['buffers'] = [{'byteLength': len(chunk)}]
     chunks = [chunk]
 
-    # bufferViewインデックスに戻す
+    # bufferViewインデックスに戻す(要素 -> インデックスの辞書で引く)
+    view_positions = positions(buffer_views)
     accessors = gltf['accessors']
     for accessor in accessors:
-        accessor['bufferView'] = buffer_views.index(accessor['bufferView'])
+        accessor['bufferView'] = view_positions[accessor['bufferView']]
 
     images = gltf['images']
     for image in images:
         if 'bufferView' in image:
-            image['bufferView'] = buffer_views.index(image['bufferView'])
+            image['bufferView'] = view_positions[image['bufferView']]
 
     # accessorインデックス、materialインデックスに戻す
+    accessor_positions = positions(accessors)
     meshes = gltf['meshes']
-    materials = gltf['materials']
+    material_positions = positions(gltf['materials'])
     for mesh in meshes:
         primitives = mesh['primitives']
         for primitive in primitives:
-            primitive['indices'] = accessors.index(primitive['indices'])
+            primitive['indices'] = accessor_positions[primitive['indices']]
             attributes = primitive['attributes']
-            primitive['material'] = materials.index(primitive['material'])
+            primitive['material'] = material_positions[primitive['material']]
             for name in attributes:
-                attributes[name] = accessors.index(attributes[name])
+                attributes[name] = accessor_positions[attributes[name]]
             if 'targets' in primitive:
                 targets = primitive['targets']
                 for target in targets:
                     for name in target:
-                        target[name] = accessors.index(target[name])
+                        target[name] = accessor_positions[target[name]]
 
     skins = gltf['skins']
     for skin in skins:
-        skin['inverseBindMatrices'] = accessors.index(skin['inverseBindMatrices'])
+        skin['inverseBindMatrices'] = accessor_positions[skin['inverseBindMatrices']]
 
     samplers = gltf['samplers']
     textures = gltf['textures']
+    texture_positions = positions(textures)
 
     # 材質テクスチャ変換
     materials = gltf['materials']
@@ -180,24 +313,25 @@ def indexing(gltf):
         for name in ['baseColorTexture', 'metallicRoughnessTexture']:
             if name in pbr:
                 texture = pbr[name]
-                texture['index'] = textures.index(texture['index'])
+                texture['index'] = texture_positions[texture['index']]
         for name in ['normalTexture', 'occulusionTexture', 'emissiveTexture']:
             if name in material:
                 texture = material[name]
-                texture['index'] = textures.index(texture['index'])
+                texture['index'] = texture_positions[texture['index']]
 
     # VRMシェーダーテクスチャ変換
     vrm = gltf['extensions']['VRM']
-    vrm['meta']['texture'] = textures.index(vrm['meta']['texture'])
+    vrm['meta']['texture'] = texture_positions[vrm['meta']['texture']]
 
     vrm_materials = vrm['materialProperties']
     for material in vrm_materials:
         properties = material['textureProperties']
         for name in properties:
-            properties[name] = textures.index(properties[name])
+            properties[name] = texture_positions[properties[name]]
 
+    image_positions = positions(images)
     for texture in textures:
-        texture['source'] = images.index(texture['source'])
+        texture['source'] = image_positions[texture['source']]
         texture['sampler'] = samplers.index(texture['sampler'])
 
     # マテリアル名を戻す
@@ -208,4 +342,9 @@ def indexing(gltf):
     # Exporter名を変更
     vrm['exporterVersion'] = app_name()
 
+    # 型付きのオブジェクトをJSONの辞書に戻す
+    for key in ['accessors', 'bufferViews', 'images', 'textures', 'materials', 'meshes']:
+        gltf[key] = map(to_json, gltf[key])
+    vrm['materialProperties'] = map(to_json, vrm_materials)
+
     return gltf, chunks
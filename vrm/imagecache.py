@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+from payload import payload_holder, load_payload
+
+"""
+デコード済み画像のキャッシュ
+1回の変換中に同じ画像を何度もデコードしないように、パス間でPIL.Imageを共有する
+画像データがPayloadに保持されていれば、バイトデータの代わりにPayloadをキーにして保持する
+"""
+
+MB = 1024 * 1024
+
+# キャッシュするデコード済み画像のメモリ量の上限の既定値
+DEFAULT_MAX_BYTES = 512 * MB
+
+
+def image_bytes(img):
+    """
+    :param img: PIL.Imageオブジェクト
+    :return: デコード後の画素データのバイト数(見積もり)
+    """
+    w, h = img.size
+    return w * h * len(img.getbands())
+
+
+class ImageCache(object):
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        メモリ上限付きのLRUキャッシュ(id(バイトデータ、Payload) -> (バイトデータ、Payload, PIL.Image))
+        画像データはglTFのコピー間で同じオブジェクトが共有されるため、オブジェクトの同一性で判定する
+        上限を超えた場合は最も長く使われていない画像から解放する
+        :param max_bytes: デコード済み画像のメモリ量の上限
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # キー -> (バイトデータ、Payload, PIL.Image, バイト数)
+        self.total_bytes = 0
+        self.headers = {}  # キー -> (バイトデータ、Payload, (フォーマット, モード, サイズ))
+        self.decoded = 0
+        self.evicted = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        data, img, size = self.entries.pop(key)
+        self.entries[key] = (data, img, size)  # 最近使用した画像として末尾に移動
+        return data, img
+
+    def __setitem__(self, key, value):
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)[2]
+        data, img = value
+        size = image_bytes(img)
+        self.entries[key] = (data, img, size)
+        self.total_bytes += size
+        self.decoded += 1
+        # 追加した画像は残す
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            _, (_, _, evicted_size) = self.entries.popitem(last=False)
+            self.total_bytes -= evicted_size
+            self.evicted += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def values(self):
+        # 縮小デコードした画像は含めない
+        return [(data, img) for key, (data, img, _) in self.entries.items() if not isinstance(key, tuple)]
+
+    @staticmethod
+    def key(data):
+        """
+        :param data: 画像ファイルのバイトデータ、またはPayloadオブジェクト
+        :return: キャッシュのキー(退避したデータを読み戻しても変わらない)
+        """
+        return id(payload_holder(data))
+
+    def get(self, data):
+        """
+        :param data: 画像ファイルのバイトデータ
+        :return: デコード済みの画像(なければNone)
+        """
+        key = self.key(data)
+        return self[key][1] if key in self else None
+
+    def put(self, data, img):
+        """
+        :param data: 画像ファイルのバイトデータ
+        :param img: デコード済みの画像
+        """
+        # idの再利用を防ぐため、バイトデータ(を保持するPayload)も保持する
+        holder = payload_holder(data)
+        self[id(holder)] = (holder, img)
+
+    def load(self, data):
+        """
+        デコード済みの画像を返す(なければ読み込んでキャッシュする)
+        :param data: 画像ファイルのバイトデータ、またはPayloadオブジェクト
+        :return: PIL.Imageオブジェクト
+        """
+        img = self.get(data)
+        if img is None:
+            img = Image.open(BytesIO(load_payload(data)))
+            self.put(data, img)
+        return img
+
+    def draft(self, data, size):
+        """
+        JPEGを指定サイズ以上の範囲で縮小デコードした画像を返す(なければ読み込んでキャッシュする)
+        縮小した画像がloadで返されないように、(キー, サイズ)をキーにして保持する(メモリ量の上限は共通)
+        :param data: 画像ファイルのバイトデータ、またはPayloadオブジェクト
+        :param size: 必要なサイズ
+        :return: PIL.Imageオブジェクト(JPEG以外、デコード済みの画像があればloadと同じ)
+        """
+        img = self.get(data)
+        if img is not None:
+            return img
+        holder = payload_holder(data)
+        key = (id(holder), tuple(size))
+        if key in self:
+            return self[key][1]
+        img = Image.open(BytesIO(load_payload(data)))
+        if img.format != 'JPEG':
+            self.put(data, img)
+            return img
+        img.draft(img.mode, size)
+        self[key] = (holder, img)
+        return img
+
+    def header(self, data):
+        """
+        画像のヘッダー情報を返す(画素データはデコードしない、上限とは別に保持する)
+        :param data: 画像ファイルのバイトデータ
+        :return: フォーマット、モード、サイズ
+        """
+        holder = payload_holder(data)
+        key = id(holder)
+        if key in self.entries:
+            img = self.entries[key][1]
+            return img.format, img.mode, img.size
+        if key not in self.headers:
+            img = Image.open(BytesIO(load_payload(data)))  # ヘッダーのみ読み込まれる
+            self.headers[key] = (holder, (img.format, img.mode, img.size))
+        return self.headers[key][1]
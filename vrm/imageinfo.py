@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import struct
+from io import BytesIO
+from os.path import dirname, getsize
+
+from uri import is_data_uri, decode_data_uri, uri_path
+
+"""
+画像ファイルのヘッダーから画像サイズを読み取る(画像データはデコードしない)
+"""
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# 画像サイズを持つJPEGマーカー(SOF0～SOF15、DHT/JPG/DACを除く)
+JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+
+def png_size(fi, offset):
+    """
+    :param fi: ファイルオブジェクト
+    :param offset: PNGデータの先頭位置
+    :return: (幅, 高さ)、PNGでなければNone
+    """
+    fi.seek(offset)
+    header = fi.read(24)
+    if len(header) < 24 or header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+
+def jpeg_size(fi, offset, length):
+    """
+    SOFセグメントまでマーカーをたどって画像サイズを読む
+    :param fi: ファイルオブジェクト
+    :param offset: JPEGデータの先頭位置
+    :param length: JPEGデータのバイト数
+    :return: (幅, 高さ)、JPEGでなければNone
+    """
+    fi.seek(offset)
+    if fi.read(2) != b'\xff\xd8':
+        return None
+    position = 2
+    while position + 4 <= length:
+        fi.seek(offset + position)
+        marker = fi.read(4)
+        if len(marker) < 4 or ord(marker[0]) != 0xff:
+            return None
+        code = ord(marker[1])
+        if code == 0xff:
+            position += 1  # フィルバイト
+            continue
+        if code in [0x01] or 0xd0 <= code <= 0xd7:
+            position += 2  # 長さを持たないマーカー
+            continue
+        segment_length, = struct.unpack('>H', marker[2:4])
+        if code in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', fi.read(5)[1:5])
+            return width, height
+        position += 2 + segment_length
+    return None
+
+
+def image_size(fi, offset, length, mime_type=None):
+    """
+    :param fi: ファイルオブジェクト
+    :param offset: 画像データの先頭位置
+    :param length: 画像データのバイト数
+    :param mime_type: MIMEタイプ(判定順の優先に使用)
+    :return: (幅, 高さ)、判定できなければNone
+    """
+    readers = [lambda: png_size(fi, offset), lambda: jpeg_size(fi, offset, length)]
+    if mime_type == 'image/jpeg':
+        readers.reverse()
+    for reader in readers:
+        size = reader()
+        if size:
+            return size
+    return None
+
+
+def uri_image_size(uri, base_dir, mime_type=None):
+    """
+    :param uri: 画像のdata URIまたは相対URI
+    :param base_dir: .gltfファイルのディレクトリ
+    :param mime_type: MIMEタイプ
+    :return: (幅, 高さ)、判定できなければNone
+    """
+    if is_data_uri(uri):
+        data = decode_data_uri(uri)[1]
+        return image_size(BytesIO(data), 0, len(data), mime_type)
+    path = uri_path(uri, base_dir)
+    with open(path, 'rb') as fi:
+        return image_size(fi, 0, getsize(path), mime_type)
+
+
+def image_sizes(path, gltf, bin_offset):
+    """
+    GLB、.gltfファイルの画像サイズを画像ヘッダーの部分読み込みで列挙する
+    :param path: GLB、.gltfファイルパス
+    :param gltf: glTFオブジェクト(インデックス番号参照のJSON)
+    :param bin_offset: BINチャンクのデータの先頭位置(.gltfファイルはNone)
+    :return: (画像名, MIMEタイプ, (幅, 高さ)またはNone)リスト
+    """
+    base_dir = dirname(path)
+    buffers = gltf.get('buffers', [])
+    views = gltf.get('bufferViews', [])
+    result = []
+    with open(path, 'rb') as fi:
+        for image in gltf.get('images', []):
+            size = None
+            mime_type = image.get('mimeType')
+            view = views[image['bufferView']] if 'bufferView' in image else None
+            buf = buffers[view['buffer']] if view is not None else None
+            if 'uri' in image:
+                size = uri_image_size(image['uri'], base_dir, mime_type)
+            elif buf is not None and 'uri' in buf:
+                # 外部バッファの画像はバッファのファイルから読む
+                if is_data_uri(buf['uri']):
+                    bfi = BytesIO(decode_data_uri(buf['uri'])[1])
+                else:
+                    bfi = open(uri_path(buf['uri'], base_dir), 'rb')
+                with bfi:
+                    size = image_size(bfi, view.get('byteOffset', 0), view['byteLength'], mime_type)
+            elif view is not None and view['buffer'] == 0 and bin_offset is not None:  # GLBのBINチャンクはバッファ0
+                size = image_size(fi, bin_offset + view.get('byteOffset', 0), view['byteLength'], mime_type)
+            result.append((image.get('name'), mime_type, size))
+    return result
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from collections import OrderedDict
+from functools import wraps
+from threading import local
+
+from util import unique
+
+"""
+マテリアル名、プリミティブ、accessor、bufferViewの検索用インデックス
+glTFオブジェクトごとに1回だけ作成し、マテリアル名の部分一致検索の結果を記憶する
+インデックスを作成したglTFオブジェクトへの変更はModelIndexのメソッドで行う(インデックスも更新される)
+各処理はglTFオブジェクトをコピーしてから変更するので、コピーには新しいインデックスが作成される
+それ以外の方法で変更した場合はinvalidate_indexでインデックスを破棄する
+インデックスはindexedを付けた処理の実行中のみ保持し、処理が終わればglTFオブジェクトごと解放する
+"""
+
+# 処理中に保持するインデックスの数(直前の処理のglTFオブジェクトの分のみ)
+MAX_CACHED_INDEXES = 4
+
+# 実行中の処理のインデックス(スレッドごと)
+_scope = local()
+
+
+def positions(seq):
+    """
+    :param seq: glTF要素のリスト
+    :return: 要素 -> リスト上のインデックス の辞書(重複する要素は最初のインデックス、list.indexと同じ)
+    """
+    result = {}
+    for n, x in enumerate(seq):
+        result.setdefault(x, n)
+    return result
+
+
+def primitive_accessors(primitive):
+    """
+    :param primitive: プリミティブ
+    :return: プリミティブが参照するaccessorリスト(頂点インデックス、頂点属性、モーフターゲット)
+    """
+    accessors = [primitive.get('indices')] + primitive['attributes'].values()
+    accessors += [a for target in primitive.get('targets', []) for a in target.values()]
+    return unique([a for a in accessors if a is not None])
+
+
+class NameIndex(object):
+    def __init__(self, elements):
+        """
+        名前の部分一致検索用インデックス
+        名前を'_'で区切ったトークン -> 要素 の辞書で候補を絞り込み、検索結果を記憶する
+        :param elements: 名前を持つ要素のリスト
+        """
+        self.elements = elements
+        self.tokens = {}  # トークン -> 要素リスト(元の順番)
+        for element in elements:
+            for token in set(element['name'].split('_')):
+                self.tokens.setdefault(token, []).append(element)
+        self.queries = {}  # 部分名 -> 部分一致する要素リスト
+
+    def candidates(self, name):
+        # 両側が'_'の部分は名前のトークンと完全に一致する必要がある
+        tokens = [token for token in name.split('_')[1:-1] if token]
+        if not tokens:
+            return self.elements
+        return min((self.tokens.get(token, []) for token in tokens), key=len)
+
+    def find_all(self, name):
+        """
+        :param name: 部分名
+        :return: 名前に部分一致する要素リスト(元の順番)
+        """
+        if not name:
+            return []
+        if name not in self.queries:
+            self.queries[name] = [x for x in self.candidates(name) if name in x['name']]
+        return self.queries[name]
+
+    def find(self, name):
+        """
+        :param name: 部分名
+        :return: 名前に部分一致する最初の要素、見つからなければNone
+        """
+        found = self.find_all(name)
+        return found[0] if found else None
+
+
+class ModelIndex(object):
+    def __init__(self, gltf):
+        """
+        :param gltf: glTFオブジェクト
+        """
+        self.materials = NameIndex(gltf['materials'])
+        self.vrm_materials = NameIndex(gltf['extensions']['VRM']['materialProperties'])
+        self.material_primitives = {}  # glTFマテリアル -> プリミティブリスト
+        self.primitive_order = {}  # プリミティブ -> モデル上の順番
+        for mesh in gltf['meshes']:
+            for primitive in mesh['primitives']:
+                self.primitive_order[primitive] = len(self.primitive_order)
+                self.material_primitives.setdefault(primitive['material'], []).append(primitive)
+        self.used_materials = None  # プリミティブが使用するマテリアルのNameIndex(変更時に作り直す)
+        self.view_positions = positions(gltf['bufferViews'])
+        self.gltf = gltf
+        self.view_users = None  # bufferView -> 参照するaccessor、画像リスト(最初の参照時に作成する)
+        self.accessor_users = None  # accessor -> 参照するプリミティブ、スキンリスト(最初の参照時に作成する)
+
+    @staticmethod
+    def add_user(users, element, user):
+        if element is not None:
+            users.setdefault(element, []).append(user)
+
+    def build_users(self):
+        self.view_users = {}
+        self.accessor_users = {}
+        for mesh in self.gltf['meshes']:
+            for primitive in mesh['primitives']:
+                for accessor in primitive_accessors(primitive):
+                    self.add_user(self.accessor_users, accessor, primitive)
+        for skin in self.gltf.get('skins', []):
+            self.add_user(self.accessor_users, skin.get('inverseBindMatrices'), skin)
+        # 追加したaccessorはclean処理までaccessorリストにないので、プリミティブとスキンから辿る
+        for accessor in self.accessor_users:
+            self.add_user(self.view_users, accessor.get('bufferView'), accessor)
+        for image in self.gltf['images']:
+            self.add_user(self.view_users, image.get('bufferView'), image)
+
+    def buffer_view_users(self, buffer_view):
+        """
+        :param buffer_view: bufferView
+        :return: bufferViewを参照するaccessor、画像リスト
+        """
+        if self.view_users is None:
+            self.build_users()
+        return self.view_users.get(buffer_view, [])
+
+    def primitives_using_view(self, buffer_view):
+        """
+        accessor -> bufferView -> 参照元 の対応から、bufferViewのデータを書き換えると影響するプリミティブを求める
+        :param buffer_view: bufferView
+        :return: (プリミティブ、accessor)リスト
+        """
+        return [(user, accessor) for accessor in self.buffer_view_users(buffer_view)
+                for user in self.accessor_users.get(accessor, []) if 'attributes' in user]
+
+    def primitives_has_material(self, name):
+        """
+        :param name: マテリアル部分名
+        :return: マテリアル名に部分一致するプリミティブリスト(モデル上の順番)
+        """
+        if self.used_materials is None:
+            self.used_materials = NameIndex(list(self.material_primitives))
+        primitives = [p for m in self.used_materials.find_all(name) for p in self.material_primitives[m]]
+        return sorted(primitives, key=self.primitive_order.get)
+
+    def set_material(self, primitive, material):
+        """
+        プリミティブのマテリアルを変更する
+        :param primitive: プリミティブ
+        :param material: glTFマテリアル
+        """
+        old = primitive['material']
+        self.material_primitives[old].remove(primitive)
+        if not self.material_primitives[old]:
+            del self.material_primitives[old]
+        primitive['material'] = material
+        self.material_primitives.setdefault(material, []).append(primitive)
+        self.used_materials = None
+
+    def append_buffer_view(self, gltf, buffer_view):
+        """
+        bufferViewを追加する
+        :param gltf: glTFオブジェクト
+        :param buffer_view: bufferView
+        """
+        self.view_positions.setdefault(buffer_view, len(gltf['bufferViews']))
+        gltf['bufferViews'].append(buffer_view)
+
+    def append_image(self, gltf, image):
+        """
+        bufferViewを参照する画像を追加する
+        :param gltf: glTFオブジェクト
+        :param image: glTF画像
+        """
+        gltf['images'].append(image)
+        if self.view_users is not None:
+            self.add_user(self.view_users, image.get('bufferView'), image)
+
+
+def indexed(func):
+    """
+    処理の実行中のみ、glTFオブジェクトのインデックスを保持する
+    入れ子の処理は外側の処理のインデックスを共有する
+    :param func: glTFオブジェクトを処理する関数
+    :return: インデックスを保持して実行する関数
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_scope, 'indexes', None) is not None:
+            return func(*args, **kwargs)
+        _scope.indexes = OrderedDict()  # id(glTFオブジェクト) -> (glTFオブジェクト, ModelIndex)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _scope.indexes = None
+    return wrapper
+
+
+def model_index(gltf):
+    """
+    glTFオブジェクトのインデックスを返す(変更の確認はしない、ModelIndex以外で変更したらinvalidate_indexを呼ぶ)
+    indexedの処理の外では保持せず、毎回作成する
+    :param gltf: glTFオブジェクト
+    :return: ModelIndexオブジェクト
+    """
+    indexes = getattr(_scope, 'indexes', None)
+    if indexes is None:
+        return ModelIndex(gltf)
+    key = id(gltf)
+    if key in indexes:
+        _, index = indexes.pop(key)
+    else:
+        index = ModelIndex(gltf)
+    indexes[key] = (gltf, index)  # idの再利用を防ぐためglTFオブジェクトも保持する
+    while len(indexes) > MAX_CACHED_INDEXES:
+        indexes.popitem(last=False)
+    return index
+
+
+def invalidate_index(gltf):
+    """
+    ModelIndexのメソッド以外でマテリアル、プリミティブ、bufferViewを変更したglTFオブジェクトのインデックスを破棄する
+    :param gltf: glTFオブジェクト
+    """
+    indexes = getattr(_scope, 'indexes', None)
+    if indexes is not None:
+        indexes.pop(id(gltf), None)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import hashlib
+
+from imagecache import ImageCache, DEFAULT_MAX_BYTES
+from model import Element
+from payload import Payload, payload_holder, load_payload, store_payload
+
+"""
+入力内容のハッシュ値をキーにした処理結果のキャッシュ
+監視モードで変換をまたいで保持し、入力が変わらない処理の結果とデコード済み画像を再利用する
+バイトデータはPayloadStoreが有効ならPayloadとして保持し、上限を超えた分は一時ファイルに退避できるようにする
+"""
+
+
+def stored(value):
+    """
+    :param value: 処理結果
+    :return: バイトデータをPayloadにした処理結果
+    """
+    if isinstance(value, tuple):
+        return tuple(map(stored, value))
+    return store_payload(value)
+
+
+def loaded(value):
+    """
+    :param value: storedで変換した処理結果
+    :return: Payloadをバイトデータに戻した処理結果
+    """
+    if isinstance(value, tuple):
+        return tuple(map(loaded, value))
+    return load_payload(value)
+
+
+class Memo(object):
+    def __init__(self):
+        self.results = {}  # キー -> 処理結果
+        self.used = set()  # 今回の変換で使用したキー
+        self.decoded = {}  # 画像データのハッシュ値 -> PIL.Image
+        self.hashes = {}  # id(バイトデータ、Payload) -> (バイトデータ、Payload, ハッシュ値)
+
+    def data_hash(self, data):
+        """
+        バイトデータのハッシュ値(同じオブジェクトは1回だけ計算する)
+        :param data: バイトデータ、またはPayloadオブジェクト
+        :return: ハッシュ値
+        """
+        holder = payload_holder(data)
+        key = id(holder)
+        if key not in self.hashes:
+            # idの再利用を防ぐためバイトデータ(を保持するPayload)も保持する
+            self.hashes[key] = (holder, hashlib.sha1(load_payload(holder)).digest())
+        return self.hashes[key][1]
+
+    def update_hash(self, h, obj):
+        if isinstance(obj, (dict, Element)):
+            h.update('{')
+            for k in sorted(obj):
+                self.update_hash(h, k)
+                self.update_hash(h, obj[k])
+            h.update('}')
+        elif isinstance(obj, (list, tuple)):
+            h.update('[')
+            for x in obj:
+                self.update_hash(h, x)
+            h.update(']')
+        elif isinstance(obj, (str, Payload)):
+            h.update('b')
+            h.update(self.data_hash(obj))
+        else:
+            h.update(repr(obj))
+
+    def key(self, name, *parts):
+        """
+        :param name: 処理名
+        :param parts: 処理の入力(glTFオブジェクト、リサイズ情報、画像データなど)
+        :return: 入力内容のハッシュ値
+        """
+        h = hashlib.sha1(name)
+        for part in parts:
+            self.update_hash(h, part)
+        return h.hexdigest()
+
+    def get(self, key, compute):
+        """
+        :param key: 入力内容のハッシュ値
+        :param compute: 処理結果を返す関数
+        :return: キャッシュ済みの処理結果、なければcomputeの結果
+        """
+        if key not in self.results:
+            self.results[key] = stored(compute())
+        self.used.add(key)
+        return loaded(self.results[key])
+
+    def image_cache(self, gltf, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        前回までにデコードした画像からデコード済み画像キャッシュを作成する
+        :param gltf: glTFオブジェクト
+        :param max_bytes: デコード済み画像のメモリ量の上限
+        :return: デコード済み画像キャッシュ(ImageCache)
+        """
+        image_cache = ImageCache(max_bytes)
+        for image in gltf['images']:
+            data = image['bufferView']['data']
+            digest = self.data_hash(data)
+            if digest in self.decoded:
+                image_cache.put(data, self.decoded[digest])
+        return image_cache
+
+    def finish(self, image_cache):
+        """
+        変換終了時に、今回使用しなかった処理結果を破棄してデコード済み画像を保持する
+        :param image_cache: 今回の変換のデコード済み画像キャッシュ
+        """
+        self.results = {key: self.results[key] for key in self.used}
+        self.used = set()
+        self.decoded = {self.data_hash(data): img for data, img in image_cache.values()}
+        self.hashes = {}
+
+
+def memoized(memo, compute, name, *parts):
+    """
+    :param memo: Memoオブジェクト(Noneでキャッシュしない)
+    :param compute: 処理結果を返す関数
+    :param name: 処理名
+    :param parts: 処理の入力
+    :return: 処理結果
+    """
+    if memo is None:
+        return compute()
+    return memo.get(memo.key(name, *parts), compute)
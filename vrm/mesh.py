@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from copy import deepcopy
+
+from accessor import read_accessor, packed_accessor, component_size
+from model import Primitive
+from skin import remove_nodes, protected_nodes
+
+"""
+メッシュをまたいだプリミティブ結合(ドローコール削減)
+"""
+
+
+def mesh_nodes(gltf):
+    """
+    :param gltf: glTFオブジェクト
+    :return: メッシュインデックス -> 参照ノードインデックスリスト の対応辞書
+    """
+    nodes = {}
+    for n, node in enumerate(gltf['nodes']):
+        if 'mesh' in node:
+            nodes.setdefault(node['mesh'], []).append(n)
+    return nodes
+
+
+def skin_key(gltf, skin_index):
+    """
+    スキンの比較用キーを返す(VRoidはメッシュごとに同じ内容のスキンを出力するため内容で比較する)
+    :param gltf: glTFオブジェクト
+    :param skin_index: スキンインデックス
+    :return: 比較用キー
+    """
+    skin = gltf['skins'][skin_index]
+    return tuple(skin['joints']), tuple(read_accessor(skin['inverseBindMatrices'])), skin.get('skeleton')
+
+
+def attribute_layout(primitive):
+    """
+    :param primitive: プリミティブ
+    :return: 頂点属性、モーフターゲットの型情報(比較用)
+    """
+
+    def layout(attributes):
+        return tuple((name, a['componentType'], a['type'], a.get('normalized', False))
+                     for name, a in sorted(attributes.items()))
+
+    targets = tuple(layout(target) for target in primitive.get('targets', []))
+    return layout(primitive['attributes']), targets
+
+
+def first_person_flags(gltf):
+    """
+    :param gltf: glTFオブジェクト
+    :return: メッシュインデックス -> firstPersonFlag の対応辞書
+    """
+    annotations = gltf['extensions']['VRM'].get('firstPerson', {}).get('meshAnnotations', [])
+    return {a['mesh']: a.get('firstPersonFlag') for a in annotations}
+
+
+def primitive_keys(gltf, ordered_mesh_names):
+    """
+    結合可能なプリミティブが同じキーになるように、プリミティブごとのキーを列挙する
+    マテリアル、スキン、頂点属性の型、一人称表示設定が同じものを結合対象とする
+    モーフターゲットを持つプリミティブはBlendShapeの参照があるため同じメッシュ内でのみ結合する
+    描画順を維持するメッシュでは連続したプリミティブのみ結合する
+    :param gltf: glTFオブジェクト
+    :param ordered_mesh_names: 描画順を維持するメッシュ部分名リスト
+    :return: (メッシュインデックス、プリミティブ、キー)リスト
+    """
+    nodes = mesh_nodes(gltf)
+    flags = first_person_flags(gltf)
+    first_skins = {}  # スキンの比較用キー -> 同じ内容の最初のスキンインデックス
+    same_skins = [first_skins.setdefault(skin_key(gltf, n), n) for n in xrange(len(gltf['skins']))]
+
+    keys = {}  # キー -> キーの番号(出現順)
+    result = []
+    for mesh_index, mesh in enumerate(gltf['meshes']):
+        ordered = any(name in mesh['name'] for name in ordered_mesh_names)
+        node_indices = nodes.get(mesh_index, [])
+        run = 0
+        previous = None
+        for primitive in mesh['primitives']:
+            if len(node_indices) != 1:
+                owner = ('mesh', mesh_index)  # 複数ノードから参照されるメッシュは結合しない
+            elif 'skin' in gltf['nodes'][node_indices[0]]:
+                owner = ('skin', gltf['nodes'][node_indices[0]]['skin'])
+            else:
+                owner = ('node', node_indices[0])  # スキンがなければノードの変換が必要なので同じノードのみ
+            if owner[0] == 'skin':
+                owner = ('skin', same_skins[owner[1]])
+
+            key = (primitive['material'], owner, primitive.get('mode', 4), attribute_layout(primitive),
+                   flags.get(mesh_index))
+            if primitive.get('targets'):
+                key += (('mesh', mesh_index),)
+            if ordered:
+                if previous is not None and key != previous:
+                    run += 1
+                previous = key
+                key += (('run', mesh_index, run),)
+
+            result.append((mesh_index, primitive, keys.setdefault(key, len(keys))))
+    return result
+
+
+def merged_primitive(gltf, primitives):
+    """
+    プリミティブリストを1つのプリミティブに結合する
+    頂点属性が共通ならインデックスのみ結合し、異なる場合は使用頂点のみの新しい頂点属性を作成する
+    :param gltf: glTFオブジェクト(追加アクセッサー、bufferViewを登録する)
+    :param primitives: プリミティブリスト
+    :return: 結合済みプリミティブ
+    """
+    head = primitives[0]
+
+    def source_key(primitive):
+        # 頂点データの同一性判定
+        targets = [tuple(id(t[k]) for k in sorted(t)) for t in primitive.get('targets', [])]
+        return tuple(id(primitive['attributes'][k]) for k in sorted(primitive['attributes'])), tuple(targets)
+
+    source_keys = [source_key(p) for p in primitives]
+    source_positions = {}  # 頂点データの同一性判定キー -> sources上のインデックス
+    sources = []  # 頂点データごとの先頭プリミティブ
+    for primitive, key in zip(primitives, source_keys):
+        if key not in source_positions:
+            source_positions[key] = len(sources)
+            sources.append(primitive)
+    indices_values = [read_accessor(p['indices']) for p in primitives]
+
+    def append(accessor, values):
+        new_accessor, new_view = packed_accessor(accessor, values)
+        gltf['accessors'].append(new_accessor)
+        gltf['bufferViews'].append(new_view)
+        return new_accessor
+
+    new_primitive = Primitive({k: v for k, v in head.items() if k not in ['indices', 'attributes', 'targets']})
+    indices_template = dict(head['indices'], componentType=5125)  # 結合後の頂点数に備えてUNSIGNED_INT
+    if len(sources) == 1:
+        # 頂点属性が共通なのでインデックスのみ結合
+        new_primitive['attributes'] = head['attributes']
+        if 'targets' in head:
+            new_primitive['targets'] = head['targets']
+        new_primitive['indices'] = append(indices_template, [i for values in indices_values for i in values])
+        return new_primitive
+
+    # 頂点データごとに使用頂点のみを詰めて並べる
+    vertex_maps = []
+    used_vertices = []
+    base = 0
+    for source in sources:
+        key = source_key(source)
+        used = sorted(set(i for k, values in zip(source_keys, indices_values) if k == key for i in values))
+        vertex_maps.append({old: base + new for new, old in enumerate(used)})
+        used_vertices.append(used)
+        base += len(used)
+
+    def merged_accessor(get_accessor):
+        values = []
+        for source, used in zip(sources, used_vertices):
+            accessor = get_accessor(source)
+            data = read_accessor(accessor)
+            n = component_size(accessor)
+            for i in used:
+                values.extend(data[i * n:i * n + n])
+        return append(get_accessor(head), values)
+
+    new_primitive['attributes'] = {name: merged_accessor(lambda p: p['attributes'][name])
+                                   for name in head['attributes']}
+    if 'targets' in head:
+        new_primitive['targets'] = [{name: merged_accessor(lambda p: p['targets'][n][name]) for name in target}
+                                    for n, target in enumerate(head['targets'])]
+
+    # プリミティブの元の順番でインデックスを並べる
+    new_indices = []
+    for key, values in zip(source_keys, indices_values):
+        vertex_map = vertex_maps[source_positions[key]]
+        new_indices.extend(vertex_map[i] for i in values)
+    new_primitive['indices'] = append(indices_template, new_indices)
+    return new_primitive
+
+
+def remove_meshes(gltf, removed):
+    """
+    指定したメッシュを削除してインデックスを詰める
+    メッシュを参照していたノードは子ノードがなければ削除する
+    :param gltf: glTFオブジェクト
+    :param removed: 削除するメッシュインデックスのset
+    """
+    mesh_map = {}
+    new_meshes = []
+    for n, mesh in enumerate(gltf['meshes']):
+        if n not in removed:
+            mesh_map[n] = len(new_meshes)
+            new_meshes.append(mesh)
+    gltf['meshes'] = new_meshes
+
+    removed_nodes = set()
+    for n, node in enumerate(gltf['nodes']):
+        if 'mesh' not in node:
+            continue
+        if node['mesh'] in mesh_map:
+            node['mesh'] = mesh_map[node['mesh']]
+            continue
+        del node['mesh']
+        node.pop('skin', None)
+        if not node.get('children'):
+            removed_nodes.add(n)
+
+    # 他から参照されるノードは残す
+    removed_nodes -= protected_nodes(gltf)
+    removed_nodes -= set(joint for skin in gltf['skins'] for joint in skin['joints'])
+
+    vrm = gltf['extensions']['VRM']
+    first_person = vrm.get('firstPerson', {})
+    if 'meshAnnotations' in first_person:
+        first_person['meshAnnotations'] = [dict(a, mesh=mesh_map[a['mesh']]) for a in first_person['meshAnnotations']
+                                           if a['mesh'] in mesh_map]
+    for group in vrm.get('blendShapeMaster', {}).get('blendShapeGroups', []):
+        group['binds'] = [dict(b, mesh=mesh_map[b['mesh']]) for b in group.get('binds', []) if b['mesh'] in mesh_map]
+
+    remove_nodes(gltf, removed_nodes)
+
+
+def merge_mesh_primitives(gltf, ordered_mesh_names):
+    """
+    マテリアル、スキンが同じプリミティブをメッシュをまたいで結合する
+    結合後のプリミティブは最初のプリミティブの位置に配置し、空になったメッシュは削除する
+    :param gltf: glTFオブジェクト
+    :param ordered_mesh_names: 描画順を維持するメッシュ部分名リスト
+    :return: プリミティブ結合後のglTFオブジェクト
+    """
+    gltf = deepcopy(gltf)
+    keyed = primitive_keys(gltf, ordered_mesh_names)
+
+    groups = {}
+    for _, primitive, key in keyed:
+        groups.setdefault(key, []).append(primitive)
+
+    new_primitives = [[] for _ in gltf['meshes']]
+    placed = set()
+    for mesh_index, primitive, key in keyed:
+        if key in placed:
+            continue  # 結合先に統合済み
+        placed.add(key)
+        group = groups[key]
+        new_primitives[mesh_index].append(merged_primitive(gltf, group) if len(group) > 1 else primitive)
+
+    for mesh, primitives in zip(gltf['meshes'], new_primitives):
+        mesh['primitives'] = primitives
+
+    remove_meshes(gltf, set(n for n, primitives in enumerate(new_primitives) if not primitives))
+    return gltf
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from copy import deepcopy
+
+from payload import store_payload, load_payload
+
+"""
+インスタンス参照のglTF要素の型
+辞書と同じ添字アクセスができ、比較、ハッシュはオブジェクトの同一性で行う(setや辞書のキーに使える)
+派生クラスの__slots__がglTFのプロパティ名(JSONの出力順)で、
+型で定義していないプロパティはothersに保持し、JSONとの変換で失われないようにする
+"""
+
+
+class Element(object):
+    __slots__ = ('others',)
+
+    def __init__(self, properties=None):
+        """
+        :param properties: プロパティ辞書(glTFのJSON)
+        """
+        self.others = None  # 型で定義していないプロパティ(辞書)
+        if properties:
+            self.update(properties)
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.others and key in self.others:
+            return self.others[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self.__slots__:
+            setattr(self, key, value)
+            return
+        if self.others is None:
+            self.others = {}
+        self.others[key] = value
+
+    def __delitem__(self, key):
+        if key in self.__slots__:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self.others and key in self.others:
+            del self.others[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.__slots__:
+            return hasattr(self, key)
+        return bool(self.others) and key in self.others
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.get('name', hex(id(self))))
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)] + list(self.others or [])
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, properties):
+        for key, value in properties.items():
+            self[key] = value
+
+    def __copy__(self):
+        new = type(self).__new__(type(self))
+        new.others = dict(self.others) if self.others else None
+        for key in self.__slots__:
+            if hasattr(self, key):
+                setattr(new, key, getattr(self, key))
+        return new
+
+    def __deepcopy__(self, memo):
+        new = type(self).__new__(type(self))
+        memo[id(self)] = new
+        new.others = deepcopy(self.others, memo)
+        for key in self.__slots__:
+            if hasattr(self, key):
+                setattr(new, key, deepcopy(getattr(self, key), memo))
+        return new
+
+    def to_json(self):
+        """
+        :return: プロパティ辞書(参照はそのまま)
+        """
+        return dict(self.items())
+
+
+# 全要素共通のプロパティ
+COMMON_FIELDS = ('name', 'extensions', 'extras')
+
+
+class Accessor(Element):
+    __slots__ = ('bufferView', 'byteOffset', 'componentType', 'normalized', 'count', 'type', 'max', 'min',
+                 'sparse') + COMMON_FIELDS
+
+
+class BufferView(Element):
+    # dataはバッファから切り出したバイトデータ(保存時にbuffer、byteOffset、byteLengthに戻す)
+    # 有効なPayloadStoreがあればPayloadとして保持し、添字アクセスではバイトデータを返す
+    __slots__ = ('buffer', 'byteOffset', 'byteLength', 'byteStride', 'target', 'data') + COMMON_FIELDS
+
+    def __getitem__(self, key):
+        value = Element.__getitem__(self, key)
+        return load_payload(value) if key == 'data' else value
+
+    def __setitem__(self, key, value):
+        Element.__setitem__(self, key, store_payload(value) if key == 'data' else value)
+
+
+class Image(Element):
+    __slots__ = ('uri', 'mimeType', 'bufferView') + COMMON_FIELDS
+
+
+class Texture(Element):
+    __slots__ = ('sampler', 'source') + COMMON_FIELDS
+
+
+class Material(Element):
+    __slots__ = ('pbrMetallicRoughness', 'normalTexture', 'occlusionTexture', 'emissiveTexture', 'emissiveFactor',
+                 'alphaMode', 'alphaCutoff', 'doubleSided') + COMMON_FIELDS
+
+
+class VrmMaterial(Element):
+    __slots__ = ('name', 'shader', 'renderQueue', 'floatProperties', 'vectorProperties', 'textureProperties',
+                 'keywordMap', 'tagMap')
+
+
+class Primitive(Element):
+    __slots__ = ('attributes', 'indices', 'material', 'mode', 'targets', 'extensions', 'extras')
+
+
+class Mesh(Element):
+    __slots__ = ('primitives', 'weights') + COMMON_FIELDS
+
+    def __init__(self, properties=None):
+        Element.__init__(self, properties)
+        if 'primitives' in self:
+            self.primitives = [p if isinstance(p, Primitive) else Primitive(p) for p in self.primitives]
+
+    def to_json(self):
+        properties = Element.to_json(self)
+        if 'primitives' in properties:
+            properties['primitives'] = [to_json(p) for p in properties['primitives']]
+        return properties
+
+
+def to_json(element):
+    """
+    :param element: Elementオブジェクト、またはプロパティ辞書
+    :return: プロパティ辞書
+    """
+    return element.to_json() if isinstance(element, Element) else element
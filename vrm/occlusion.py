@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from copy import deepcopy
+from io import BytesIO
+from math import sqrt, sin, cos, radians
+
+from PIL import Image
+
+from accessor import read_accessor, packed_accessor
+
+"""
+服に隠れる体の三角形の削除
+"""
+
+# 体、服のマテリアル部分名
+BODY_MATERIAL_NAMES = ['_Body_']
+CLOTH_MATERIAL_NAMES = ['_Tops_', '_Bottoms_', 'F00_002_Onepi', '_Shoes_', '_Accessory_']
+
+# 判定に使用するポーズ(ヒューマノイドボーン名 -> (回転軸, 角度))
+SAMPLE_POSES = [
+    {},  # バインドポーズ
+    {'leftUpperArm': ((0, 0, 1), -70), 'rightUpperArm': ((0, 0, 1), 70)},  # 腕を下ろす
+    {'leftUpperArm': ((0, 0, 1), 45), 'rightUpperArm': ((0, 0, 1), -45)},  # 腕を上げる
+    {'leftUpperLeg': ((1, 0, 0), -70), 'rightUpperLeg': ((1, 0, 0), -70),
+     'leftLowerLeg': ((1, 0, 0), 90), 'rightLowerLeg': ((1, 0, 0), 90)},  # 座る
+    {'spine': ((1, 0, 0), 30), 'chest': ((1, 0, 0), 15)},  # 前屈
+    {'spine': ((1, 0, 0), -20), 'chest': ((0, 1, 0), 30)}  # 反る、ひねる
+]
+
+# 法線周りのレイ方向(法線からの角度, 分割数)
+RAY_RINGS = [(0, 1), (40, 6), (75, 8)]
+
+
+def quaternion_multiply(a, b):
+    """
+    :param a: クォータニオン(x, y, z, w)
+    :param b: クォータニオン(x, y, z, w)
+    :return: a * b
+    """
+    ax, ay, az, aw = a
+    bx, by, bz, bw = b
+    return (aw * bx + ax * bw + ay * bz - az * by,
+            aw * by - ax * bz + ay * bw + az * bx,
+            aw * bz + ax * by - ay * bx + az * bw,
+            aw * bw - ax * bx - ay * by - az * bz)
+
+
+def axis_angle(axis, degree):
+    """
+    :param axis: 回転軸
+    :param degree: 角度(度)
+    :return: クォータニオン(x, y, z, w)
+    """
+    half = radians(degree) / 2
+    s = sin(half)
+    return axis[0] * s, axis[1] * s, axis[2] * s, cos(half)
+
+
+def trs_matrix(translation, rotation, scale):
+    """
+    :param translation: 平行移動
+    :param rotation: 回転クォータニオン(x, y, z, w)
+    :param scale: スケール
+    :return: 4x4行列(列優先)
+    """
+    x, y, z, w = rotation
+    sx, sy, sz = scale
+    return [(1 - 2 * (y * y + z * z)) * sx, (2 * (x * y + z * w)) * sx, (2 * (x * z - y * w)) * sx, 0,
+            (2 * (x * y - z * w)) * sy, (1 - 2 * (x * x + z * z)) * sy, (2 * (y * z + x * w)) * sy, 0,
+            (2 * (x * z + y * w)) * sz, (2 * (y * z - x * w)) * sz, (1 - 2 * (x * x + y * y)) * sz, 0,
+            translation[0], translation[1], translation[2], 1]
+
+
+def matrix_multiply(a, b):
+    """
+    :param a: 4x4行列(列優先)
+    :param b: 4x4行列(列優先)
+    :return: a * b
+    """
+    return [sum(a[k * 4 + r] * b[c * 4 + k] for k in xrange(4)) for c in xrange(4) for r in xrange(4)]
+
+
+def world_matrices(gltf, pose):
+    """
+    ポーズを適用したノードのワールド行列を計算する
+    :param gltf: glTFオブジェクト
+    :param pose: ヒューマノイドボーン名 -> (回転軸, 角度)
+    :return: ノードごとのワールド行列リスト
+    """
+    nodes = gltf['nodes']
+    bones = {b['node']: b['bone'] for b in gltf['extensions']['VRM']['humanoid']['humanBones']}
+
+    def local(n):
+        node = nodes[n]
+        if 'matrix' in node:
+            matrix = list(node['matrix'])
+            if bones.get(n) in pose:
+                matrix = matrix_multiply(matrix, trs_matrix((0, 0, 0), axis_angle(*pose[bones[n]]), (1, 1, 1)))
+            return matrix
+        rotation = tuple(node.get('rotation', (0, 0, 0, 1)))
+        if bones.get(n) in pose:
+            rotation = quaternion_multiply(rotation, axis_angle(*pose[bones[n]]))
+        return trs_matrix(node.get('translation', (0, 0, 0)), rotation, node.get('scale', (1, 1, 1)))
+
+    matrices = [None] * len(nodes)
+    children = set(c for node in nodes for c in node.get('children', []))
+    stack = [(n, None) for n in xrange(len(nodes)) if n not in children]
+    while stack:
+        n, parent = stack.pop()
+        matrices[n] = local(n) if parent is None else matrix_multiply(parent, local(n))
+        stack.extend((c, matrices[n]) for c in nodes[n].get('children', []))
+    return matrices
+
+
+def posed_vertices(gltf, node_index, primitive, matrices):
+    """
+    スキニングを適用した頂点座標、法線を計算する
+    :param gltf: glTFオブジェクト
+    :param node_index: プリミティブを持つノードインデックス
+    :param primitive: プリミティブ
+    :param matrices: ノードのワールド行列リスト
+    :return: 頂点座標リスト、法線リスト
+    """
+    attributes = primitive['attributes']
+    positions = read_accessor(attributes['POSITION'])
+    normals = read_accessor(attributes['NORMAL']) if 'NORMAL' in attributes else None
+    count = len(positions) // 3
+    node = gltf['nodes'][node_index]
+
+    if 'skin' in node and 'JOINTS_0' in attributes:
+        skin = gltf['skins'][node['skin']]
+        inverse = read_accessor(skin['inverseBindMatrices'])
+        joint_matrices = [matrix_multiply(matrices[j], inverse[n * 16:(n + 1) * 16])
+                          for n, j in enumerate(skin['joints'])]
+        joints = read_accessor(attributes['JOINTS_0'])
+        weights = read_accessor(attributes['WEIGHTS_0'])
+        if attributes['WEIGHTS_0']['componentType'] != 5126:
+            scale = 255.0 if attributes['WEIGHTS_0']['componentType'] == 5121 else 65535.0
+            weights = [w / scale for w in weights]
+        vertex_matrices = []
+        for i in xrange(count):
+            m = [0.0] * 16
+            for k in xrange(4):
+                w = weights[i * 4 + k]
+                if w:
+                    jm = joint_matrices[joints[i * 4 + k]]
+                    m = [a + w * b for a, b in zip(m, jm)]
+            vertex_matrices.append(m)
+    else:
+        vertex_matrices = [matrices[node_index]] * count
+
+    new_positions = []
+    new_normals = []
+    for i in xrange(count):
+        m = vertex_matrices[i]
+        x, y, z = positions[i * 3:i * 3 + 3]
+        new_positions.append((m[0] * x + m[4] * y + m[8] * z + m[12],
+                              m[1] * x + m[5] * y + m[9] * z + m[13],
+                              m[2] * x + m[6] * y + m[10] * z + m[14]))
+        if normals:
+            x, y, z = normals[i * 3:i * 3 + 3]
+            nx, ny, nz = (m[0] * x + m[4] * y + m[8] * z, m[1] * x + m[5] * y + m[9] * z,
+                          m[2] * x + m[6] * y + m[10] * z)
+            length = sqrt(nx * nx + ny * ny + nz * nz) or 1.0
+            new_normals.append((nx / length, ny / length, nz / length))
+    return new_positions, new_normals
+
+
+class AlphaTexture(object):
+    def __init__(self, vrm_material, image_cache=None):
+        """
+        服マテリアルの透明部分判定
+        :param vrm_material: VRMマテリアル
+        :param image_cache: デコード済み画像キャッシュ(ImageCache)
+        """
+        keywords = vrm_material['keywordMap'] if vrm_material else {}
+        self.blend = bool(keywords.get('_ALPHABLEND_ON') or keywords.get('_ALPHAPREMULTIPLY_ON'))
+        self.cutout = bool(keywords.get('_ALPHATEST_ON'))
+        self.threshold = vrm_material['floatProperties'].get('_Cutoff', 0.5) if self.cutout else 0.99
+        self.pixels = None
+        if vrm_material and (self.blend or self.cutout) and '_MainTex' in vrm_material['textureProperties']:
+            source = vrm_material['textureProperties']['_MainTex']['source']
+            data = source['bufferView']['data']
+            image = image_cache.load(data) if image_cache is not None else Image.open(BytesIO(data))
+            image = image.convert('RGBA')
+            self.size = image.size
+            self.pixels = image.split()[3].load()
+
+    def opaque(self, u, v):
+        """
+        :param u: テクスチャ座標
+        :param v: テクスチャ座標
+        :return: 不透明ならTrue
+        """
+        if self.pixels is None:
+            return not self.blend  # 透過設定がなければアルファ値は使われない
+        w, h = self.size
+        x = int((u % 1.0) * w) % w
+        y = int((v % 1.0) * h) % h
+        return self.pixels[x, y] >= self.threshold * 255
+
+
+class TriangleGrid(object):
+    def __init__(self, cell_size):
+        """
+        レイ判定用の三角形の一様グリッド
+        :param cell_size: セルの大きさ
+        """
+        self.cell_size = cell_size
+        self.cells = {}
+        self.triangles = []
+
+    def cell(self, p):
+        return tuple(int(c // self.cell_size) for c in p)
+
+    def add(self, a, b, c, uvs, alpha):
+        """
+        :param a: 頂点座標
+        :param b: 頂点座標
+        :param c: 頂点座標
+        :param uvs: 頂点のテクスチャ座標
+        :param alpha: AlphaTexture
+        """
+        index = len(self.triangles)
+        self.triangles.append((a, b, c, uvs, alpha))
+        lo = self.cell([min(a[k], b[k], c[k]) for k in xrange(3)])
+        hi = self.cell([max(a[k], b[k], c[k]) for k in xrange(3)])
+        for x in xrange(lo[0], hi[0] + 1):
+            for y in xrange(lo[1], hi[1] + 1):
+                for z in xrange(lo[2], hi[2] + 1):
+                    self.cells.setdefault((x, y, z), []).append(index)
+
+    def candidates(self, origin, end):
+        """
+        :param origin: 線分の始点
+        :param end: 線分の終点
+        :return: 線分と交差する可能性のある三角形インデックスのset
+        """
+        lo = self.cell([min(origin[k], end[k]) for k in xrange(3)])
+        hi = self.cell([max(origin[k], end[k]) for k in xrange(3)])
+        result = set()
+        for x in xrange(lo[0], hi[0] + 1):
+            for y in xrange(lo[1], hi[1] + 1):
+                for z in xrange(lo[2], hi[2] + 1):
+                    result.update(self.cells.get((x, y, z), []))
+        return result
+
+    def occluded(self, origin, direction, distance):
+        """
+        レイが不透明な三角形に当たるか判定する(Moller-Trumbore)
+        :param origin: レイの始点
+        :param direction: レイの方向(単位ベクトル)
+        :param distance: レイの長さ
+        :return: 当たればTrue
+        """
+        ox, oy, oz = origin
+        dx, dy, dz = direction
+        end = (ox + dx * distance, oy + dy * distance, oz + dz * distance)
+        for index in self.candidates(origin, end):
+            a, b, c, uvs, alpha = self.triangles[index]
+            e1x, e1y, e1z = b[0] - a[0], b[1] - a[1], b[2] - a[2]
+            e2x, e2y, e2z = c[0] - a[0], c[1] - a[1], c[2] - a[2]
+            px, py, pz = dy * e2z - dz * e2y, dz * e2x - dx * e2z, dx * e2y - dy * e2x
+            det = e1x * px + e1y * py + e1z * pz
+            if -1e-12 < det < 1e-12:
+                continue
+            inv = 1.0 / det
+            tx, ty, tz = ox - a[0], oy - a[1], oz - a[2]
+            u = (tx * px + ty * py + tz * pz) * inv
+            if u < 0 or u > 1:
+                continue
+            qx, qy, qz = ty * e1z - tz * e1y, tz * e1x - tx * e1z, tx * e1y - ty * e1x
+            v = (dx * qx + dy * qy + dz * qz) * inv
+            if v < 0 or u + v > 1:
+                continue
+            t = (e2x * qx + e2y * qy + e2z * qz) * inv
+            if t <= 1e-6 or t > distance:
+                continue
+            # 当たった位置のテクスチャの透明度を確認する
+            w = 1 - u - v
+            tex_u = w * uvs[0][0] + u * uvs[1][0] + v * uvs[2][0]
+            tex_v = w * uvs[0][1] + u * uvs[1][1] + v * uvs[2][1]
+            if alpha.opaque(tex_u, tex_v):
+                return True
+        return False
+
+
+def ray_directions(normal):
+    """
+    法線を中心とした半球上のレイ方向を列挙する
+    :param normal: 法線(単位ベクトル)
+    :return: 方向リスト
+    """
+    nx, ny, nz = normal
+    # 法線に垂直な基底
+    if abs(nx) < 0.9:
+        tx, ty, tz = 0, -nz, ny
+    else:
+        tx, ty, tz = nz, 0, -nx
+    length = sqrt(tx * tx + ty * ty + tz * tz)
+    tx, ty, tz = tx / length, ty / length, tz / length
+    bx, by, bz = ny * tz - nz * ty, nz * tx - nx * tz, nx * ty - ny * tx
+
+    directions = []
+    for angle, divisions in RAY_RINGS:
+        s, c = sin(radians(angle)), cos(radians(angle))
+        for k in xrange(divisions):
+            phi = radians(360.0 * k / divisions)
+            a, b = s * cos(phi), s * sin(phi)
+            directions.append((nx * c + (tx * a + bx * b), ny * c + (ty * a + by * b), nz * c + (tz * a + bz * b)))
+    return directions
+
+
+def mesh_node_indices(gltf):
+    """
+    :param gltf: glTFオブジェクト
+    :return: メッシュインデックス -> 参照ノードインデックス の対応辞書
+    """
+    return {node['mesh']: n for n, node in enumerate(gltf['nodes']) if 'mesh' in node}
+
+
+def contain_name(name, names):
+    return any(n in name for n in names)
+
+
+def hidden_vertices(gltf, body, cloths, alphas, pose, candidates, distance):
+    """
+    指定ポーズで服に隠れる体の頂点を判定する
+    :param gltf: glTFオブジェクト
+    :param body: (ノードインデックス、体プリミティブ)
+    :param cloths: (ノードインデックス、服プリミティブ)リスト
+    :param alphas: マテリアル名 -> AlphaTexture の対応辞書
+    :param pose: ポーズ
+    :param candidates: 判定対象の頂点インデックスのset
+    :param distance: 服を探すレイの長さ
+    :return: 隠れる頂点インデックスのset
+    """
+    matrices = world_matrices(gltf, pose)
+
+    grid = TriangleGrid(distance)
+    for node_index, primitive in cloths:
+        positions, _ = posed_vertices(gltf, node_index, primitive, matrices)
+        uv = read_accessor(primitive['attributes']['TEXCOORD_0'])
+        alpha = alphas[primitive['material']['name']]
+        indices = read_accessor(primitive['indices'])
+        for i in xrange(0, len(indices), 3):
+            tri = indices[i:i + 3]
+            grid.add(positions[tri[0]], positions[tri[1]], positions[tri[2]],
+                     [uv[k * 2:k * 2 + 2] for k in tri], alpha)
+
+    node_index, primitive = body
+    positions, normals = posed_vertices(gltf, node_index, primitive, matrices)
+    hidden = set()
+    for i in candidates:
+        if all(grid.occluded(positions[i], d, distance) for d in ray_directions(normals[i])):
+            hidden.add(i)
+    return hidden
+
+
+def remove_hidden_body(gltf, distance=0.1, poses=None, image_cache=None):
+    """
+    服に完全に覆われる体の三角形を削除する
+    複数のポーズで体の頂点から法線側の半球にレイを飛ばし、全てのレイが服の不透明部分に当たる頂点を隠れているとする
+    3頂点とも全ポーズで隠れている三角形を削除する(頂点の詰め直しは行わない)
+    :param gltf: glTFオブジェクト
+    :param distance: 服を探すレイの長さ(これより離れた服は覆っていないとみなす)
+    :param poses: 判定に使用するポーズリスト(Noneで標準ポーズ)
+    :param image_cache: デコード済み画像キャッシュ(ImageCache)
+    :return: 三角形削除後のglTFオブジェクト
+    """
+    gltf = deepcopy(gltf)
+    poses = SAMPLE_POSES if poses is None else poses
+    nodes = mesh_node_indices(gltf)
+    vrm_materials = {m['name']: m for m in gltf['extensions']['VRM']['materialProperties']}
+
+    bodies = []
+    cloths = []
+    alphas = {}  # マテリアル名 -> AlphaTexture
+    for mesh_index, mesh in enumerate(gltf['meshes']):
+        if mesh_index not in nodes:
+            continue
+        for primitive in mesh['primitives']:
+            name = primitive['material']['name']
+            if contain_name(name, BODY_MATERIAL_NAMES) and 'NORMAL' in primitive['attributes']:
+                bodies.append((nodes[mesh_index], primitive))
+            elif contain_name(name, CLOTH_MATERIAL_NAMES) and 'TEXCOORD_0' in primitive['attributes']:
+                cloths.append((nodes[mesh_index], primitive))
+                if name not in alphas:
+                    alphas[name] = AlphaTexture(vrm_materials.get(name), image_cache)
+    if not bodies or not cloths:
+        return gltf
+
+    for body in bodies:
+        _, primitive = body
+        indices = read_accessor(primitive['indices'])
+        hidden = set(indices)
+        for pose in poses:
+            hidden = hidden_vertices(gltf, body, cloths, alphas, pose, hidden, distance)
+            if not hidden:
+                break
+
+        kept = []
+        for i in xrange(0, len(indices), 3):
+            tri = indices[i:i + 3]
+            if not all(k in hidden for k in tri):
+                kept.extend(tri)
+        if len(kept) == len(indices):
+            continue
+        accessor, view = packed_accessor(primitive['indices'], kept)
+        gltf['accessors'].append(accessor)
+        gltf['bufferViews'].append(view)
+        primitive['indices'] = accessor
+    return gltf
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from copy import deepcopy
+from math import tan, radians
+
+from accessor import read_accessor
+from report import has_outline
+
+"""
+MToonのアウトラインの削減
+基準距離から見たアウトラインの画面上のピクセル数を見積もり、ほとんど見えないアウトラインを無効にする
+(アウトラインはマテリアルごとにジオメトリをもう1回描画する)
+"""
+
+# 見積もりの基準(距離(m)、垂直画角(度)、画面の高さ(ピクセル))
+REFERENCE_DISTANCE = 2.0
+REFERENCE_FOV = 60.0
+REFERENCE_SCREEN_HEIGHT = 1080
+
+# _OutlineWidthMode
+OUTLINE_NONE = 0
+OUTLINE_WORLD = 1
+OUTLINE_SCREEN = 2
+
+OUTLINE_KEYWORDS = ['MTOON_OUTLINE_WIDTH_WORLD', 'MTOON_OUTLINE_WIDTH_SCREEN', 'MTOON_OUTLINE_COLOR_FIXED',
+                    'MTOON_OUTLINE_COLOR_MIXED']
+
+# アウトラインを無効にしたマテリアルのパラメータ(値をそろえて重複排除できるようにする)
+DISABLED_OUTLINE_FLOATS = {'_OutlineWidthMode': OUTLINE_NONE, '_OutlineWidth': 0, '_OutlineColorMode': 0,
+                           '_OutlineLightingMix': 1, '_OutlineScaledMaxDistance': 1}
+DISABLED_OUTLINE_VECTORS = {'_OutlineColor': [0, 0, 0, 1]}
+
+
+def pixels_per_meter(distance=REFERENCE_DISTANCE):
+    """
+    :param distance: カメラからの距離(m)
+    :return: 距離での1mの画面上のピクセル数
+    """
+    return REFERENCE_SCREEN_HEIGHT / (2 * distance * tan(radians(REFERENCE_FOV) / 2))
+
+
+def outline_width_pixels(vrm_material, distance=REFERENCE_DISTANCE):
+    """
+    MToonのシェーダーと同じ式でアウトラインの幅を画面上のピクセル数にする
+    :param vrm_material: VRMマテリアル
+    :param distance: カメラからの距離(m)
+    :return: アウトラインの幅(ピクセル)
+    """
+    float_props = vrm_material['floatProperties']
+    width = float_props.get('_OutlineWidth', 0) * 0.01
+    if vrm_material['keywordMap'].get('MTOON_OUTLINE_WIDTH_SCREEN'):
+        # クリップ空間の幅(_OutlineScaledMaxDistanceまでは距離によらず一定)
+        max_distance = float_props.get('_OutlineScaledMaxDistance', 1)
+        return width * min(distance, max_distance) / distance * REFERENCE_SCREEN_HEIGHT / 2
+    return width * pixels_per_meter(distance)  # ワールド空間の幅(m)
+
+
+def primitive_extent(primitive):
+    """
+    :param primitive: プリミティブ
+    :return: プリミティブが使う頂点の範囲の大きさ(x, y, z)(m、ノードの変形は含めない)
+    """
+    positions = read_accessor(primitive['attributes']['POSITION'])
+    if 'indices' in primitive:
+        used = set(read_accessor(primitive['indices']))
+    else:
+        used = xrange(len(positions) // 3)
+    if not used:
+        return 0, 0, 0
+    return tuple(max(positions[i * 3 + k] for i in used) - min(positions[i * 3 + k] for i in used)
+                 for k in xrange(3))
+
+
+def outline_pixels(vrm_material, primitives, distance=REFERENCE_DISTANCE):
+    """
+    アウトラインの画面上のピクセル数を見積もる(シルエットの周長 * アウトラインの幅)
+    :param vrm_material: VRMマテリアル
+    :param primitives: マテリアルを使うプリミティブリスト
+    :param distance: カメラからの距離(m)
+    :return: ピクセル数
+    """
+    width = outline_width_pixels(vrm_material, distance)
+    scale = pixels_per_meter(distance)
+    total = 0
+    for primitive in primitives:
+        x, y, z = primitive_extent(primitive)
+        total += 2 * (max(x, z) + y) * scale * width  # 正面、側面の大きい方のシルエット
+    return total
+
+
+def disable_outline(vrm_material):
+    """
+    アウトラインのキーワードを削除し、パラメータを既定値にそろえる
+    :param vrm_material: VRMマテリアル
+    """
+    vrm_material['keywordMap'] = {k: v for k, v in vrm_material['keywordMap'].items() if k not in OUTLINE_KEYWORDS}
+    vrm_material['floatProperties'].update(DISABLED_OUTLINE_FLOATS)
+    vrm_material['vectorProperties'].update(deepcopy(DISABLED_OUTLINE_VECTORS))
+    vrm_material['textureProperties'].pop('_OutlineWidthTexture', None)
+
+
+def reduce_outlines(gltf, min_pixels):
+    """
+    見積もったアウトラインのピクセル数が下限未満のマテリアルのアウトラインを無効にする
+    アウトラインのパラメータだけが異なっていたマテリアルは、この後の重複排除で統合される
+    :param gltf: glTFオブジェクト
+    :param min_pixels: アウトラインを残すピクセル数の下限
+    :return: アウトライン削減後のglTFオブジェクト
+    """
+    gltf = deepcopy(gltf)
+    primitives = {}  # マテリアル名 -> プリミティブリスト
+    for mesh in gltf['meshes']:
+        for primitive in mesh['primitives']:
+            primitives.setdefault(primitive['material']['name'], []).append(primitive)
+
+    saved = 0
+    for vrm_material in gltf['extensions']['VRM']['materialProperties']:
+        used = primitives.get(vrm_material['name'], [])
+        if not has_outline(vrm_material) or not used:
+            continue
+        pixels = outline_pixels(vrm_material, used)
+        if pixels >= min_pixels:
+            continue
+        print '{}: outline {:.1f}px < {}px, disabled'.format(vrm_material['name'], pixels, min_pixels)
+        disable_outline(vrm_material)
+        saved += len(used)
+    print 'outline draw calls saved: {}'.format(saved)
+    return gltf
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import mmap
+import weakref
+from collections import OrderedDict
+from tempfile import TemporaryFile
+
+"""
+bufferViewのバイトデータの保持先
+メモリ量の上限を超えたら、最も長く使われていない大きなデータから一時ファイルに退避する
+退避したデータは参照されたときにメモリマップから読み戻す
+BufferViewの添字アクセス(view['data'])は常にバイトデータを返すので、各処理からは区別できない
+"""
+
+MB = 1024 * 1024
+
+# これより小さいデータは退避しない
+MIN_SPILL_BYTES = 64 * 1024
+
+# 一時ファイルを作り直すときに一度に書き写すバイト数
+COPY_CHUNK_BYTES = 1 * MB
+
+# 有効なPayloadStore(Noneで全てメモリ上に保持する)
+_active_store = [None]
+
+
+def active_store():
+    return _active_store[0]
+
+
+def set_active_store(store):
+    """
+    以降に設定されるbufferViewのバイトデータの保持先を切り替える
+    :param store: PayloadStoreオブジェクト(Noneで全てメモリ上に保持する)
+    """
+    _active_store[0] = store
+
+
+def store_payload(data):
+    """
+    :param data: バイトデータ
+    :return: 有効な保持先があり退避対象の大きさならPayloadオブジェクト、それ以外はバイトデータそのもの
+    """
+    store = _active_store[0]
+    if store is None or not isinstance(data, str):
+        return data
+    return store.put(data)
+
+
+def load_payload(value):
+    """
+    :param value: バイトデータ、またはPayloadオブジェクト
+    :return: バイトデータ
+    """
+    return value.read() if isinstance(value, Payload) else value
+
+
+def payload_holder(data):
+    """
+    キャッシュがバイトデータの代わりに保持、キーにするオブジェクトを返す
+    バイトデータを直接保持すると、退避後もメモリ上に残ってしまう
+    :param data: バイトデータ、またはPayloadオブジェクト
+    :return: バイトデータを保持しているPayloadオブジェクト(なければdataそのもの)
+    """
+    store = _active_store[0]
+    if store is None or not isinstance(data, str):
+        return data
+    return store.holder(data)
+
+
+class Payload(object):
+    __slots__ = ('store', 'data', 'offset', 'length', '__weakref__')
+
+    def __init__(self, store, data):
+        """
+        PayloadStoreに保持したバイトデータ
+        内容は変更されないため、glTFのコピー間で同じオブジェクトを共有する
+        :param store: PayloadStoreオブジェクト
+        :param data: バイトデータ
+        """
+        self.store = store
+        self.data = data  # 退避中はNone
+        self.offset = None  # 一時ファイル上の位置(未退避ならNone)
+        self.length = len(data)
+
+    def read(self):
+        """
+        :return: バイトデータ(メモリ上にある間は同じオブジェクト)
+        """
+        if self.data is None:
+            self.store.load(self)
+        else:
+            self.store.touch(self)
+        return self.data
+
+    def __len__(self):
+        return self.length
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+class PayloadStore(object):
+    def __init__(self, max_memory_bytes, min_spill_bytes=MIN_SPILL_BYTES, directory=None):
+        """
+        メモリ上限付きのバイトデータの保持先
+        参照されなくなったデータの領域が一時ファイルの半分を超えたら、参照されているデータだけを詰めて作り直す
+        :param max_memory_bytes: メモリ上に保持する(min_spill_bytes以上の)データの合計バイト数の上限
+        :param min_spill_bytes: 退避対象にするデータの最小バイト数
+        :param directory: 一時ファイルの作成先(Noneで既定の場所)
+        """
+        self.max_memory_bytes = max_memory_bytes
+        self.min_spill_bytes = min_spill_bytes
+        self.directory = directory
+        self.payloads = {}  # id(Payload) -> Payloadの弱参照(参照されている全てのPayload)
+        self.resident = OrderedDict()  # id(Payload) -> (id(バイトデータ), バイト数)(メモリ上のもの、最近使用したものが末尾)
+        self.owners = {}  # id(バイトデータ) -> id(Payload)(メモリ上のもの)
+        self.memory_bytes = 0
+        self.extents = {}  # id(Payload) -> 一時ファイル上のバイト数
+        self.file = None
+        self.file_bytes = 0
+        self.garbage_bytes = 0  # 参照されなくなったデータの一時ファイル上のバイト数
+        self.map = None
+        self.spilled = 0
+        self.loaded = 0
+        self.compacted = 0
+
+    def put(self, data):
+        """
+        :param data: バイトデータ
+        :return: Payloadオブジェクト(min_spill_bytes未満ならバイトデータそのもの)
+        """
+        if len(data) < self.min_spill_bytes:
+            return data
+        holder = self.holder(data)
+        if holder is not data:
+            return holder  # Payloadから読んだバイトデータは同じPayloadで保持する
+        payload = Payload(self, data)
+        key = id(payload)
+        # 参照されなくなったデータは解放する(コールバックからPayloadを参照しない)
+        self.payloads[key] = weakref.ref(payload, lambda _: self.release(key))
+        self.add(payload)
+        self.spill(payload)
+        return payload
+
+    def holder(self, data):
+        """
+        :param data: バイトデータ
+        :return: バイトデータをメモリ上に保持しているPayloadオブジェクト(なければdataそのもの)
+        """
+        key = self.owners.get(id(data))
+        payload = self.payloads[key]() if key in self.payloads else None
+        return payload if payload is not None and payload.data is data else data
+
+    def add(self, payload):
+        key = id(payload)
+        self.resident[key] = (id(payload.data), payload.length)
+        self.owners[id(payload.data)] = key
+        self.memory_bytes += payload.length
+
+    def forget(self, key):
+        if key in self.resident:
+            data_key, length = self.resident.pop(key)
+            if self.owners.get(data_key) == key:
+                del self.owners[data_key]
+            self.memory_bytes -= length
+
+    def release(self, key):
+        self.payloads.pop(key, None)
+        self.forget(key)
+        self.garbage_bytes += self.extents.pop(key, 0)
+
+    def touch(self, payload):
+        key = id(payload)
+        self.resident[key] = self.resident.pop(key)  # 最近使用したデータとして末尾に移動
+
+    def spill(self, keep=None):
+        """
+        メモリ量が上限を超えている間、最も長く使われていないデータから一時ファイルに退避する
+        :param keep: 退避しないPayloadオブジェクト(追加、読み戻したばかりのもの)
+        """
+        while self.memory_bytes > self.max_memory_bytes and self.resident:
+            key = next(iter(self.resident))
+            payload = self.payloads[key]()
+            if payload is keep:
+                if len(self.resident) == 1:
+                    break
+                self.touch(payload)
+                continue
+            self.forget(key)
+            if payload.offset is None:
+                payload.offset = self.write(payload.data)  # 内容は変わらないので一度だけ書き込む
+                self.extents[key] = payload.length
+            payload.data = None
+            self.spilled += 1
+
+    def load(self, payload):
+        """
+        退避したデータをメモリ上に読み戻す
+        :param payload: Payloadオブジェクト
+        """
+        payload.data = self.read(payload.offset, payload.length)
+        self.loaded += 1
+        self.add(payload)
+        self.spill(payload)
+
+    def read(self, offset, length):
+        """
+        :param offset: 一時ファイル上の位置
+        :param length: バイト数
+        :return: 一時ファイルから読んだバイトデータ
+        """
+        end = offset + length
+        if self.map is None or len(self.map) < end:
+            # 追記した分を含めてマップし直す
+            self.file.flush()
+            if self.map is not None:
+                self.map.close()
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.map[offset:end]
+
+    def write(self, data):
+        """
+        :param data: バイトデータ
+        :return: 一時ファイル上の位置
+        """
+        if self.garbage_bytes * 2 > self.file_bytes:
+            self.compact()
+        if self.file is None:
+            self.file = TemporaryFile(prefix='vreducer-', dir=self.directory)
+        offset = self.file_bytes
+        self.file.seek(offset)
+        self.file.write(data)
+        self.file_bytes += len(data)
+        return offset
+
+    def compact(self):
+        """
+        参照されているデータだけを新しい一時ファイルに詰めて書き込み、古い一時ファイルを削除する
+        古いファイルのメモリマップからCOPY_CHUNK_BYTESずつ書き写すので、データ全体をメモリに読み込まない
+        メモリ上にあるデータは次に退避するときに書き込む
+        """
+        payloads = [ref() for key, ref in self.payloads.items() if key in self.extents]
+        spilled = sorted((p for p in payloads if p.data is None), key=lambda p: p.offset)
+        new_file = TemporaryFile(prefix='vreducer-', dir=self.directory) if spilled else None
+        new_bytes = 0
+        extents = {}
+        for payload in spilled:
+            for start in xrange(0, payload.length, COPY_CHUNK_BYTES):
+                size = min(COPY_CHUNK_BYTES, payload.length - start)
+                new_file.write(self.read(payload.offset + start, size))  # 古いファイルから読む
+            payload.offset = new_bytes
+            new_bytes += payload.length
+            extents[id(payload)] = payload.length
+        for payload in payloads:
+            if payload.data is not None:
+                payload.offset = None
+        self.close()
+        self.file = new_file
+        self.file_bytes = new_bytes
+        self.extents = extents
+        self.garbage_bytes = 0
+        self.compacted += 1
+
+    def close(self):
+        """
+        一時ファイルを削除する(以降、退避したデータは読めない)
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
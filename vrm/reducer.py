@@ -7,8 +7,26 @@ from itertools import groupby
 
 from PIL import Image
 
+from accessor import read_accessor
+from alpha import optimize_render_modes, set_render_mode, texcoords, CUTOUT
+from atlas import atlas_png
 from cleaner import clean
-from util import find, unique, exists
+from density import surface_areas, texels_per_meter, density_size
+from encoder import encoded_images, DEFAULT_COMPRESS_LEVEL
+from imagecache import ImageCache
+from index import model_index, indexed
+from memo import memoized
+from model import Accessor, BufferView, Primitive, to_json
+from payload import payload_holder
+from model import Image as GltfImage  # PIL.Imageと区別する
+from mesh import merge_mesh_primitives
+from occlusion import remove_hidden_body
+from outline import reduce_outlines
+from skin import remove_unused_joints, limit_bone_weights
+from spring import reduce_spring_bones
+from tint import can_bake, merge_key, tint, tinted_png, bake_tint, replace_main_texture, other_uv_textures, \
+    shelf_layout, WHITE
+from util import find, unique, exists, hashable
 
 """
 VRoidモデルの削減処理
@@ -21,19 +39,18 @@ def unique_materials(materials):
     :param materials: マテリアルリスト
     :return: マテリアル名 -> 重複元マテリアル の対応辞書
     """
-    # ハッシュ化の関係で辞書が使えなかったので、リスト2つで代用
-    copied_materials = []  # nameキーを削除したマテリアルのリスト
-    uni_materials = []  # 重複しないマテリアルのリスト
+    # テクスチャはオブジェクトの同一性で比較する(画像データまで比較しない)
+    uni_materials = {}  # nameキーを削除したマテリアルの比較用キー -> 重複しないマテリアル
     for material in materials:
         copied = copy(material)
         del copied['name']  # 読み込み時に別々になるように書き換えているため、nameキーを除外して比較
+        copied['vectorProperties'] = deepcopy(material['vectorProperties'])  # 元のマテリアルと共有しない
         if '_OutlineColor' in copied['vectorProperties']:
             del copied['vectorProperties']['_OutlineColor']  # 0.4.0-p1でOutlineColorが統一されないバグがあるので除外する
 
-        if copied not in copied_materials:
-            copied_materials.append(copied)
-            uni_materials.append(material)
-        yield material['name'], uni_materials[copied_materials.index(copied)]
+        key = hashable(to_json(copied))
+        uni_materials.setdefault(key, material)
+        yield material['name'], uni_materials[key]
 
 
 def deduplicated_materials(gltf):
@@ -97,36 +114,36 @@ def combine_primitives(primitives):
     buf = head_view['buffer']
     offset = head_view['byteOffset']
     data = b''.join(map(lambda view: view['data'], buffer_views))  # バイトデータ
-    new_view = {
+    new_view = BufferView({
         'buffer': buf,
         'byteOffset': offset,
         'byteLength': len(data),
         'target': head_view['target'],
         'data': data
-    }
+    })
     if 'byteStride' in head_view:
         new_view['byteStride'] = head_view['byteStride']  # NOTE; VRoidでは出力されない
 
     # アクセッサーを統合
     accessor_count = sum(map(lambda x: x['count'], primitive_indices))  # アクセッサー総要素数
     head_indices = primitive_indices[0]
-    new_accessor = {
+    new_accessor = Accessor({
         'count': accessor_count,
         'byteOffset': head_indices['byteOffset'],
         'bufferView': new_view,
         'componentType': head_indices['componentType'],
         'type': head_indices['type'],
         'normalized': head_indices['normalized']
-    }
+    })
 
     # 髪メッシュのプリミティブを統合
     head_primitive = primitives[0]
-    new_primitive = {
+    new_primitive = Primitive({
         'mode': head_primitive['mode'],
         'indices': new_accessor,
         'attributes': head_primitive['attributes'],
         'material': head_primitive['material']
-    }
+    })
 
     return new_primitive, new_accessor, new_view
 
@@ -169,12 +186,12 @@ def remove_primitives(gltf, material_names):
     :return: プリミティブ削除後のglTFオブジェクト
     """
     gltf = deepcopy(gltf)
+    contained = {}  # マテリアル名 -> 判定結果
 
     def contain_name(name):
-        for material_name in material_names:
-            if name in material_name:
-                return True  # マテリアル名と部分一致
-        return False
+        if name not in contained:
+            contained[name] = exists(lambda material_name: name in material_name, material_names)  # 部分一致
+        return contained[name]
 
     # プリミティブ削除
     for mesh in gltf['meshes']:
@@ -219,6 +236,72 @@ def shrink_materials(gltf):
     return gltf
 
 
+# glTFマテリアルのテクスチャ情報
+GLTF_PBR_TEXTURES = ['baseColorTexture', 'metallicRoughnessTexture']
+GLTF_TEXTURES = ['normalTexture', 'occlusionTexture', 'emissiveTexture']
+
+
+def required_attributes(material, vrm_material):
+    """
+    マテリアルの描画に必要な頂点属性を返す
+    :param material: glTFマテリアル
+    :param vrm_material: VRMマテリアル
+    :return: 必要な頂点属性名のset(TANGENT, TEXCOORD_n, COLOR_0の判定のみ)
+    """
+    required = {'TEXCOORD_0'}  # VRMシェーダーはUV0を使用する
+
+    # glTFマテリアルが参照するUVセット
+    pbr = material.get('pbrMetallicRoughness', {})
+    texture_infos = [pbr[name] for name in GLTF_PBR_TEXTURES if name in pbr]
+    texture_infos += [material[name] for name in GLTF_TEXTURES if name in material]
+    for info in texture_infos:
+        required.add('TEXCOORD_{}'.format(info.get('texCoord', 0)))
+
+    # 法線マップを使う場合のみ接線が必要
+    if 'normalTexture' in material:
+        required.add('TANGENT')
+    if vrm_material and ('_BumpMap' in vrm_material['textureProperties'] or
+                         vrm_material['keywordMap'].get('_NORMALMAP')):
+        required.add('TANGENT')
+
+    # 頂点カラーはglTFシェーダーでのみ使用する
+    if not vrm_material or vrm_material.get('shader') == 'VRM_USE_GLTFSHADER':
+        required.add('COLOR_0')
+    return required
+
+
+def is_optional_attribute(name):
+    """
+    :param name: 頂点属性名
+    :return: マテリアルによって不要になる頂点属性ならTrue
+    """
+    return name == 'TANGENT' or name.startswith('TEXCOORD_') or name.startswith('COLOR_')
+
+
+def shrink_attributes(gltf):
+    """
+    マテリアルで使用しない頂点属性(接線、UV、頂点カラー)をプリミティブ、モーフターゲットから削除する
+    削除した頂点属性のアクセッサー、bufferViewはclean処理で削除される
+    :param gltf: glTFオブジェクト
+    :return: 頂点属性削除後のglTFオブジェクト
+    """
+    gltf = deepcopy(gltf)
+    vrm_materials = {m['name']: m for m in gltf['extensions']['VRM']['materialProperties']}
+    for mesh in gltf['meshes']:
+        for primitive in mesh['primitives']:
+            material = primitive['material']
+            required = required_attributes(material, vrm_materials.get(material['name']))
+
+            def used(name):
+                return not is_optional_attribute(name) or name in required
+
+            primitive['attributes'] = {k: v for k, v in primitive['attributes'].items() if used(k)}
+            if 'targets' in primitive:
+                primitive['targets'] = [{k: v for k, v in target.items() if used(k)}
+                                        for target in primitive['targets']]
+    return gltf
+
+
 def sorted_primitives(primitives, material_name_order):
     """
     指定したマテリアル順にプリミティブをソートする
@@ -229,12 +312,14 @@ def sorted_primitives(primitives, material_name_order):
     max_weight = len(material_name_order) + 1
     material_name_order = filter(None, material_name_order)
 
+    weights = {}  # マテリアル名 -> 重み
+
     def weight(name):
         # マテリアル名の重みを返す
-        for n, order_name in enumerate(material_name_order):
-            if order_name in name:
-                return n
-        return max_weight
+        if name not in weights:
+            weights[name] = next((n for n, order_name in enumerate(material_name_order) if order_name in name),
+                                 max_weight)
+        return weights[name]
 
     return sorted(primitives, key=lambda p: weight(p['material']['name']))
 
@@ -268,7 +353,7 @@ def find_material(gltf, name):
     :param name: 検索マテリアル名
     :return: マテリアル名に部分一致するglTFマテリアルを返す。見つからなければNone
     """
-    return find_material_from_name(gltf['materials'], name)
+    return model_index(gltf).materials.find(name)
 
 
 def find_vrm_material(gltf, name):
@@ -277,7 +362,7 @@ def find_vrm_material(gltf, name):
     :param name: 検索マテリアル名
     :return: マテリアル名に部分一致するVRMマテリアルを返す。見つからなければNone
     """
-    return find_material_from_name(gltf['extensions']['VRM']['materialProperties'], name)
+    return model_index(gltf).vrm_materials.find(name)
 
 
 def load_img(image_buffer):
@@ -289,6 +374,19 @@ def load_img(image_buffer):
     return Image.open(BytesIO(image_buffer))
 
 
+def cached_img(image_buffer, image_cache=None):
+    """
+    デコード済み画像キャッシュを使って画像を読み込む
+    glTFのコピーでは画像データは同じオブジェクトが共有されるため、オブジェクトの同一性で判定する
+    :param image_buffer: 画像ファイルのバイトデータ
+    :param image_cache: デコード済み画像キャッシュ(ImageCache)、Noneで使用しない
+    :return: PIL.Imageオブジェクト
+    """
+    if image_cache is None:
+        return load_img(image_buffer)
+    return image_cache.load(image_buffer)
+
+
 def image2bytes(img, fmt):
     """
     PIL.Imageオブジェクトを指定フォーマットの画像ファイル(バイトデータ)に変換する
@@ -321,12 +419,9 @@ def primitives_has_material(gltf, material_name):
     指定したマテリアル名に部分一致するプリミティブを列挙する
     :param gltf: glTFオブジェクト
     :param material_name: マテリアル名
-    :return: プリミティブリスト(generator)
+    :return: プリミティブリスト
     """
-    for mesh in gltf['meshes']:
-        for primitive in mesh['primitives']:
-            if material_name and material_name in primitive['material']['name']:
-                yield primitive
+    return model_index(gltf).primitives_has_material(material_name)
 
 
 def list_primitives(gltf, names):
@@ -335,41 +430,39 @@ def list_primitives(gltf, names):
     マテリアル名、プリミティブ、bufferViewインデックスを列挙
     :param gltf: glTFオブジェクト
     :param names: マテリアル名リスト
-    :return: (マテリアル名、プリミティブ、bufferViewインデックス)リスト(generator)
+    :return: (マテリアル名、プリミティブ、bufferViewインデックス)リスト
     """
-    for name in names:
-        for primitive in primitives_has_material(gltf, name):
-            view_index = gltf['bufferViews'].index(primitive['attributes']['TEXCOORD_0']['bufferView'])
-            yield (name, primitive, view_index)
+    index = model_index(gltf)
+    return [(name, primitive, index.view_positions[primitive['attributes']['TEXCOORD_0']['bufferView']])
+            for name in names for primitive in index.primitives_has_material(name)]
 
 
-def combine_material(gltf, resize_info, base_material_name, texture_size=(2048, 2048)):
+def atlas_size(resize_info, texture_size):
     """
-    再配置情報で指定されたマテリアルを結合する
-    テクスチャも結合する
-    :param gltf: glTFオブジェクト
     :param resize_info: マテリアル名とテクスチャ配置情報
-    :param base_material_name: 統合先にするマテリアル
-    :param texture_size: 指定したサイズ以下に縮小する
-    :return: マテリアル結合したglTFオブジェクト
+    :param texture_size: テクスチャサイズの上限値
+    :return: 結合画像のサイズ
     """
-    no_base_materials = [find_vrm_material(gltf, name) for name in resize_info if base_material_name != name]
-    if not no_base_materials:
-        return gltf  # 結合先でないマテリアルがない場合、結合済み
-
-    gltf = deepcopy(gltf)
+    resize_w, resize_h = max_size(resize_info)
+    tex_w, tex_h = texture_size
+    return min(resize_w, tex_w), min(resize_h, tex_h)
 
-    vrm_materials = {name: find_vrm_material(gltf, name) for name in resize_info}
-    main_tex_sources = {name: material['textureProperties']['_MainTex']['source'] for name, material in
-                        vrm_materials.items() if material}
 
+def atlas_image(sources, resize_info, texture_size, image_cache=None, memo=None):
+    """
+    再配置情報を元に画像を1つの画像にまとめる
+    :param sources: マテリアル名 -> 画像ファイルのバイトデータ(またはそれを保持するPayload)
+    :param resize_info: マテリアル名とテクスチャ配置情報
+    :param texture_size: 指定したサイズ以下に縮小する
+    :param image_cache: デコード済み画像キャッシュ
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
+    :return: 結合画像(pngファイルのバイトデータ)
+    """
     # リサイズ指定サイズ
     resize_w, resize_h = max_size(resize_info)
-    # テクスチャ指定サイズ
-    tex_w, tex_h = texture_size
 
     # 指定テクスチャサイズ以下になるようにスケール係数を計算
-    image_w, image_h = (min(resize_w, tex_w), min(resize_h, tex_h))
+    image_w, image_h = atlas_size(resize_info, texture_size)
     scale_w, scale_h = (image_w / float(resize_w), image_h / float(resize_h))
 
     def scaled():
@@ -383,25 +476,55 @@ def combine_material(gltf, resize_info, base_material_name, texture_size=(2048,
 
     scaled_info = dict(scaled())
 
-    # 再配置情報を元に1つの画像にまとめる
-    one_image = Image.new("RGBA", (image_w, image_h), (0, 0, 0, 0))
-    for name, tex_source in main_tex_sources.items():
-        pil_image = load_img(tex_source['bufferView']['data'])
-        info = scaled_info[name]
-        resized = pil_image.resize(info['size'], Image.BICUBIC)  # 透過境界部分にノイズが出ないようにBICUBICを使用
-        one_image.paste(resized, info['pos'])
-    new_view = {'data': image2bytes(one_image, 'png')}  # pngファイルデータに変換
+    # 再配置情報を元に帯ごとに1つの画像にまとめ、pngファイルデータに変換
+    return memoized(memo, lambda: atlas_png(sources, scaled_info, (image_w, image_h), image_cache),
+                    'atlas', sources, scaled_info, (image_w, image_h))
+
+
+def combine_material(gltf, resize_info, base_material_name, texture_size=(2048, 2048), image_cache=None,
+                     atlases=None, memo=None):
+    """
+    再配置情報で指定されたマテリアルを結合する
+    テクスチャも結合する
+    :param gltf: glTFオブジェクト
+    :param resize_info: マテリアル名とテクスチャ配置情報
+    :param base_material_name: 統合先にするマテリアル
+    :param texture_size: 指定したサイズ以下に縮小する
+    :param image_cache: デコード済み画像キャッシュ
+    :param atlases: 結合画像の作成情報を追加するリスト(別サイズで作り直す場合に使用)
+    :param memo: 処理結果のキャッシュ
+    :return: マテリアル結合したglTFオブジェクト
+    """
+    no_base_materials = [find_vrm_material(gltf, name) for name in resize_info if base_material_name != name]
+    if not no_base_materials:
+        return gltf  # 結合先でないマテリアルがない場合、結合済み
+
+    gltf = deepcopy(gltf)
+
+    vrm_materials = {name: find_vrm_material(gltf, name) for name in resize_info}
+    main_tex_sources = {name: material['textureProperties']['_MainTex']['source'] for name, material in
+                        vrm_materials.items() if material}
+
+    # リサイズ指定サイズ
+    resize_w, resize_h = max_size(resize_info)
+
+    # 作成情報に残すので、バイトデータではなく保持しているPayloadを参照する(退避したデータをメモリに残さない)
+    sources = {name: payload_holder(source['bufferView']['data']) for name, source in main_tex_sources.items()}
+    new_view = BufferView({'data': atlas_image(sources, resize_info, texture_size, image_cache, memo)})
     # 結合画像名は各画像名を結合した名前にする
     image_names = [source['name'] for source in main_tex_sources.values() if source['name']]
-    new_image = {'name': '-'.join(image_names), 'mimeType': 'image/png', 'bufferView': new_view}
-    # one_image.show()
+    new_image = GltfImage({'name': '-'.join(image_names), 'mimeType': 'image/png', 'bufferView': new_view})
+    if atlases is not None:
+        atlases.append({'material': base_material_name, 'resize_info': resize_info, 'sources': sources,
+                        'size': atlas_size(resize_info, texture_size)})
 
     # テクスチャ更新
     vrm_material = find_vrm_material(gltf, base_material_name)
     texture = vrm_material['textureProperties']['_MainTex']
     texture['source'] = new_image
-    gltf['images'].append(new_image)
-    gltf['bufferViews'].append(new_view)
+    model = model_index(gltf)
+    model.append_image(gltf, new_image)
+    model.append_buffer_view(gltf, new_view)
 
     # マテリアル統一(テクスチャを更新しているので適用するだけで良い)
     # VRM上の拡張マテリアルはclean処理で削除される
@@ -418,15 +541,18 @@ def combine_material(gltf, resize_info, base_material_name, texture_size=(2048,
         w, h = (paste_w / width, paste_h / height)
         return x, y, w, h
 
+    # マテリアル更新前のプリミティブ
+    primitives = list_primitives(gltf, resize_info.keys())
+
     # オリジナルバッファー
     original_view_datas = {}
-    for _, _, view_index in list_primitives(gltf, resize_info.keys()):
+    for _, _, view_index in primitives:
         if view_index not in original_view_datas:
             original_view_datas[view_index] = deepcopy(gltf['bufferViews'][view_index]['data'])
 
-    for name, primitive, view_index in list_primitives(gltf, resize_info.keys()):
+    for name, primitive, view_index in primitives:
         # マテリアル更新
-        primitive['material'] = new_material
+        model.set_material(primitive, new_material)
         # 頂点インデックス一覧
         accessor = primitive['indices']
         indices_buffer = accessor['bufferView']['data']
@@ -455,36 +581,272 @@ def combine_material(gltf, resize_info, base_material_name, texture_size=(2048,
     return gltf
 
 
-def reduced_image(image_buffer, texture_size):
+def baked_tints(gltf, names, image_cache=None, memo=None):
+    """
+    マテリアルの_Colorをテクスチャに焼き込む
+    結合先(names[0])のテクスチャは結合画像に書き換えられるので、色が白でもコピーに差し替える
+    :param gltf: glTFオブジェクト
+    :param names: マテリアル名リスト(先頭が結合先)
+    :param image_cache: デコード済み画像キャッシュ
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
+    :return: 焼き込み後のglTFオブジェクト
+    """
+    gltf = deepcopy(gltf)
+    model = model_index(gltf)
+    for name in names:
+        vrm_material = find_vrm_material(gltf, name)
+        color = tint(vrm_material)
+        source = vrm_material['textureProperties']['_MainTex']['source']
+        if color == WHITE:
+            if name == names[0]:
+                replace_main_texture(vrm_material, find_material(gltf, name), source)
+            continue
+        data = source['bufferView']['data']
+        new_view = BufferView({'data': memoized(memo, lambda: tinted_png(data, color, image_cache), 'tint', data,
+                                                color)})
+        new_image = GltfImage({'mimeType': 'image/png', 'bufferView': new_view})
+        if source['name']:
+            new_image['name'] = '{}-tint'.format(source['name'])
+        bake_tint(vrm_material, find_material(gltf, name), new_image)
+        model.append_image(gltf, new_image)
+        model.append_buffer_view(gltf, new_view)
+    return gltf
+
+
+def shares_vertices(gltf, names):
+    """
+    結合画像では頂点ごとに1つのUVしか持てないので、異なるマテリアルで共有する頂点があれば統合できない
+    UVのbufferViewを書き換えると、同じbufferViewを参照する統合対象外のプリミティブのUVも変わるので、それらも調べる
+    :param gltf: glTFオブジェクト
+    :param names: マテリアル名リスト
+    :return: 異なるマテリアルのプリミティブが同じ頂点を使っていればTrue
+    """
+    model = model_index(gltf)
+    uv_views = unique([primitive['attributes']['TEXCOORD_0']['bufferView']
+                       for _, primitive, _ in list_primitives(gltf, names)])
+    owners = {}  # (UVのbufferView, 頂点インデックス) -> glTFマテリアル
+    for uv_view in uv_views:
+        for primitive, accessor in model.primitives_using_view(uv_view):
+            if primitive['attributes'].get('TEXCOORD_0') is not accessor:
+                continue  # UV以外の頂点属性
+            for index in set(read_accessor(primitive['indices'])):
+                if owners.setdefault((uv_view, index), primitive['material']) is not primitive['material']:
+                    return True
+    return False
+
+
+def uvs_in_unit_square(gltf, names):
+    """
+    結合画像の中では繰り返しのUVを表現できないので、0～1の範囲外のUVがあれば統合できない
+    :param gltf: glTFオブジェクト
+    :param names: マテリアル名リスト
+    :return: マテリアルを使うプリミティブのUV(TEXCOORD_0)が全て0～1の範囲内ならTrue
+    """
+    for _, primitive, _ in list_primitives(gltf, names):
+        accessor = primitive['attributes']['TEXCOORD_0']
+        if 'min' in accessor and 'max' in accessor:
+            lower, upper = min(accessor['min']), max(accessor['max'])
+        else:
+            values = [x for uv in texcoords(accessor) for x in uv]
+            lower, upper = min(values or [0]), max(values or [0])
+        if lower < 0 or upper > 1:
+            return False
+    return True
+
+
+def merge_tinted_materials(gltf, texture_size, image_cache=None, atlases=None, memo=None):
+    """
+    _Colorをテクスチャに焼き込むとテクスチャ以外が同じになるマテリアルを、結合画像で1つのマテリアルに統合する
+    結合画像がテクスチャサイズの上限に収まる(縮小しない)場合のみ統合する
+    UVが0～1の範囲外のマテリアル、結合画像以外にUVで参照するテクスチャがあるマテリアルは統合しない
+    :param gltf: glTFオブジェクト
+    :param texture_size: 結合画像のテクスチャサイズの上限値
+    :param image_cache: デコード済み画像キャッシュ
+    :param atlases: 結合画像の作成情報を追加するリスト
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
+    :return: マテリアル統合後のglTFオブジェクト
+    """
+    used = set(primitive['material']['name'] for mesh in gltf['meshes'] for primitive in mesh['primitives'])
+    groups = {}  # 焼き込み後の比較用キー -> VRMマテリアルリスト
+    for vrm_material in gltf['extensions']['VRM']['materialProperties']:
+        name = vrm_material['name']
+        if name in used and can_bake(vrm_material) and not other_uv_textures(vrm_material) and \
+                uvs_in_unit_square(gltf, [name]):
+            groups.setdefault(merge_key(vrm_material), []).append(vrm_material)
+
+    sizes = {}  # マテリアル名 -> _MainTexの画像サイズ
+    tinted = set()  # 焼き込みが必要なマテリアル名
+    for vrm_material in [m for group in groups.values() if len(group) > 1 for m in group]:
+        data = vrm_material['textureProperties']['_MainTex']['source']['bufferView']['data']
+        sizes[vrm_material['name']] = image_cache.header(data)[2] if image_cache is not None else load_img(data).size
+        if tint(vrm_material) != WHITE:
+            tinted.add(vrm_material['name'])
+
+    def fits(names):
+        resize_info = shelf_layout({name: sizes[name] for name in names})
+        return atlas_size(resize_info, texture_size) == max_size(resize_info) and not shares_vertices(gltf, names)
+
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        # 結合画像が縮小なしで収まるように分ける(大きい画像から順に、収まる最初の組に入れる)
+        packs = []
+        for name in sorted((m['name'] for m in group), key=lambda n: (-sizes[n][0] * sizes[n][1], n)):
+            pack = find(lambda p: fits(p + [name]), packs)
+            if pack is None:
+                packs.append([name])
+            else:
+                pack.append(name)
+
+        for names in packs:
+            if len(names) < 2 or not tinted.intersection(names):
+                continue  # 色が同じでテクスチャのみ異なるマテリアルは対象外
+            print 'merge tinted materials: {}'.format(', '.join(sorted(names)))
+            gltf = baked_tints(gltf, names, image_cache, memo)
+            # 結合先は最も大きい画像のマテリアル(結合済みの画像であれば、その作成情報を置き換える)
+            resize_info = shelf_layout({name: sizes[name] for name in names})
+            gltf = combine_material(gltf, resize_info, names[0], texture_size, image_cache, atlases, memo)
+    return gltf
+
+
+def material_surface_areas(gltf, name, memo=None):
+    """
+    :param gltf: glTFオブジェクト
+    :param name: マテリアル部分名
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
+    :return: マテリアルを使うプリミティブの表面積、UV面積
+    """
+    primitives = primitives_has_material(gltf, name)
+    return memoized(memo, lambda: surface_areas(primitives), 'surface_areas', primitives)
+
+
+def main_texture_size(vrm_material, texture_size, image_cache=None):
+    """
+    :param vrm_material: VRMマテリアル
+    :param texture_size: テクスチャサイズの上限値
+    :param image_cache: デコード済み画像キャッシュ
+    :return: 上限値で縮小した後の_MainTexのサイズ
+    """
+    data = vrm_material['textureProperties']['_MainTex']['source']['bufferView']['data']
+    w, h = image_cache.header(data)[2] if image_cache is not None else load_img(data).size
+    return min(w, texture_size[0]), min(h, texture_size[1])
+
+
+def reference_texel_density(gltf, texture_size, image_cache=None, memo=None):
+    """
+    最も表面積の大きいマテリアル(体や服)のテクセル密度を基準にする
+    :param gltf: glTFオブジェクト
+    :param texture_size: テクスチャサイズの上限値
+    :param image_cache: デコード済み画像キャッシュ
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
+    :return: 基準のテクセル密度(表面1mあたりのピクセル数、求められなければNone)
+    """
+    used = set(primitive['material']['name'] for mesh in gltf['meshes'] for primitive in mesh['primitives'])
+    largest = None  # (表面積, UV面積), テクスチャサイズ
+    for vrm_material in gltf['extensions']['VRM']['materialProperties']:
+        if vrm_material['name'] not in used or '_MainTex' not in vrm_material['textureProperties']:
+            continue
+        areas = material_surface_areas(gltf, vrm_material['name'], memo)
+        if largest is None or areas[0] > largest[0][0]:
+            largest = areas, main_texture_size(vrm_material, texture_size, image_cache)
+    return texels_per_meter(*largest) if largest else None
+
+
+def texel_resize_info(gltf, resize_info, reference, memo=None):
+    """
+    結合画像の各マテリアルの配置サイズをテクセル密度に合わせて縮小し、配置し直す
+    :param gltf: glTFオブジェクト
+    :param resize_info: マテリアル名とテクスチャ配置情報
+    :param reference: 基準のテクセル密度(Noneで変更しない)
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
+    :return: マテリアル名とテクスチャ配置情報(縮小しなければresize_infoそのもの)
+    """
+    if reference is None:
+        return resize_info
+    sizes = {}
+    for name, info in resize_info.items():
+        density = texels_per_meter(material_surface_areas(gltf, name, memo), info['size'])
+        sizes[name] = density_size(info['size'], density, reference)
+        if sizes[name] != info['size']:
+            print '{}: {}x{} -> {}x{}'.format(name, info['size'][0], info['size'][1], *sizes[name])
+    if all(sizes[name] == info['size'] for name, info in resize_info.items()):
+        return resize_info
+    return shelf_layout(sizes)
+
+
+def texel_target_sizes(gltf, texture_size, image_cache=None, memo=None):
+    """
+    _MainTexの画像ごとに、テクセル密度を基準に揃えるサイズを求める
+    :param gltf: glTFオブジェクト
+    :param texture_size: テクスチャサイズの上限値
+    :param image_cache: デコード済み画像キャッシュ
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
+    :return: glTF画像 -> 縮小後のサイズ
+    """
+    reference = reference_texel_density(gltf, texture_size, image_cache, memo)
+    used = set(primitive['material']['name'] for mesh in gltf['meshes'] for primitive in mesh['primitives'])
+    image_areas = {}  # glTF画像 -> (表面積, UV面積)の合計(同じ画像を使うマテリアルの分をまとめる)
+    image_sizes = {}
+    for vrm_material in gltf['extensions']['VRM']['materialProperties']:
+        if vrm_material['name'] not in used or '_MainTex' not in vrm_material['textureProperties']:
+            continue
+        image = vrm_material['textureProperties']['_MainTex']['source']
+        world, uv = material_surface_areas(gltf, vrm_material['name'], memo)
+        total_world, total_uv = image_areas.get(image, (0.0, 0.0))
+        image_areas[image] = total_world + world, total_uv + uv
+        image_sizes[image] = main_texture_size(vrm_material, texture_size, image_cache)
+
+    target_sizes = {}
+    for image, areas in image_areas.items():
+        size = image_sizes[image]
+        target_sizes[image] = density_size(size, texels_per_meter(areas, size), reference)
+        if target_sizes[image] != size:
+            print '{}: {}x{} -> {}x{}'.format(image['name'], size[0], size[1], *target_sizes[image])
+    return target_sizes
+
+
+def reduced_image(image_buffer, texture_size, image_cache=None, memo=None):
     """
     画像を指定サイズ以下に縮小する
     :param image_buffer: イメージファイルバイトデータ
     :param texture_size: 画像の縮小上限値
+    :param image_cache: デコード済み画像キャッシュ
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
     :return: 新しいイメージファイルバイトデータ
     """
-    pil_image = load_img(image_buffer)
-    w, h = pil_image.size
+    if memo is not None:
+        return memoized(memo, lambda: reduced_image(image_buffer, texture_size, image_cache),
+                        'reduced_image', image_buffer, texture_size)
+
+    # 縮小しない画像はヘッダーのみ読み込む
+    w, h = image_cache.header(image_buffer)[2] if image_cache is not None else load_img(image_buffer).size
     max_w, max_h = texture_size
     if w <= max_w and h <= max_h:
         return image_buffer
 
+    pil_image = cached_img(image_buffer, image_cache)
+
     width, height = min(w, max_w), min(h, max_h)
     new_image = pil_image.resize((width, height), Image.BICUBIC)
 
     return image2bytes(new_image, 'png')
 
 
-def reduced_images(gltf, texture_size):
+def reduced_images(gltf, texture_size, image_cache=None, memo=None, target_sizes=None):
     """
     画像を指定サイズ以下に縮小する
     :param gltf: glTFオブジェクト
     :param texture_size: テクスチャサイズ
+    :param image_cache: デコード済み画像キャッシュ
+    :param memo: 処理結果のキャッシュ
+    :param target_sizes: glTF画像 -> 画像ごとの縮小後のサイズ(texture_sizeより優先する)
     :return: 画像リサイズ後のglTFオブジェクト
     """
+    sizes = [(target_sizes or {}).get(image, texture_size) for image in gltf['images']]  # コピー前の画像で引く
     gltf = deepcopy(gltf)
-    for image in gltf['images']:
+    for image, size in zip(gltf['images'], sizes):
         buffer_view = image['bufferView']
-        buffer_view['data'] = reduced_image(buffer_view['data'], texture_size)
+        buffer_view['data'] = reduced_image(buffer_view['data'], size, image_cache, memo)
     return gltf
 
 
@@ -542,13 +904,32 @@ def find_eye_extra_name(gltf):
     return find(contain_extra_eye, material_names)
 
 
-def reduce_vroid(gltf, replace_shade_color, texture_size):
+# 描画順の並び替えを行うメッシュ名
+FACE_MESH_NAME = 'Face'
+
+
+@indexed
+def prepare_vroid(gltf, texture_size, remove_bones=False, max_bone_weights=None, reduce_springs=False,
+                  max_spring_joints=None, merge_meshes=False, remove_hidden=False, image_cache=None, atlases=None,
+                  memo=None, min_outline_pixels=None, texel_density=False, merge_tinted=False):
     """
-    VRoidモデルを軽量化する
+    VRoidモデルの軽量化のうち、陰色の置き換え、画像の縮小以外を行う
+    結合画像の作成情報をatlasesに追加するので、finish_vroidで別のテクスチャサイズの結果を作成できる
     :param gltf: glTFオブジェクト(VRM拡張を含む)
-    :param replace_shade_color: Trueで陰色を消す
-    :param texture_size: テクスチャサイズの上限値
-    :return: 軽量化したglTFオブジェクト
+    :param texture_size: 結合画像のテクスチャサイズの上限値
+    :param remove_bones: Trueでウェイトのないボーンを削除する
+    :param max_bone_weights: 1頂点あたりのボーン影響数の上限値(Noneで制限しない)
+    :param reduce_springs: Trueで揺れものを軽量化する
+    :param max_spring_joints: 揺れもののジョイント数の上限値(Noneで間引きしない)
+    :param merge_meshes: Trueでメッシュをまたいでプリミティブを結合する
+    :param remove_hidden: Trueで服に隠れる体の三角形を削除する
+    :param image_cache: デコード済み画像キャッシュ
+    :param atlases: 結合画像の作成情報を追加するリスト
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
+    :param min_outline_pixels: 見積もったピクセル数がこれ未満のアウトラインを無効にする(Noneで変更しない)
+    :param texel_density: Trueで結合画像の配置サイズをテクセル密度に合わせて縮小する
+    :param merge_tinted: Trueで色の違いのみのマテリアルを、色をテクスチャに焼き込んで統合する
+    :return: 軽量化途中のglTFオブジェクト
     """
     # マテリアルの重複排除
     gltf = deduplicated_materials(gltf)
@@ -561,12 +942,28 @@ def reduce_vroid(gltf, replace_shade_color, texture_size):
     print 'shrink materials...'
     gltf = shrink_materials(gltf)
 
+    if remove_hidden:
+        # 服に隠れる体の三角形を削除(体のマテリアルが顔に結合される前に行う)
+        print 'remove hidden body triangles...'
+        gltf = memoized(memo, lambda: remove_hidden_body(gltf, image_cache=image_cache), 'remove_hidden_body', gltf)
+
     # 顔のプリミティブ描画順を並び替え
     print 'sort face primitives...'
-    gltf = sorted_mesh_primitives(gltf, 'Face', ['_Face_', find_eye_extra_name(gltf), '_FaceMouth_',
+    gltf = sorted_mesh_primitives(gltf, FACE_MESH_NAME, ['_Face_', find_eye_extra_name(gltf), '_FaceMouth_',
                                                  '_FaceEyeline_', '_FaceEyelash_', '_FaceBrow_',
                                                  '_EyeWhite_', '_EyeIris_', '_EyeHighlight_'])
 
+    reference = None
+    if texel_density:
+        # 最も表面積の大きいマテリアルのテクセル密度を基準にする
+        print 'analyze texel density...'
+        reference = reference_texel_density(gltf, texture_size, image_cache, memo)
+        print 'reference texel density: {:.1f}px/m'.format(reference) if reference else 'no texel density'
+
+    def layout(resize_info):
+        # テクセル密度の解析は結合時点のプリミティブで行う
+        return texel_resize_info(gltf, resize_info, reference, memo)
+
     # マテリアルを結合
     print 'combine materials...'
 
@@ -574,54 +971,52 @@ def reduce_vroid(gltf, replace_shade_color, texture_size):
 
     if cloth_type == CLOTH_STUDENT:
         # 制服上下、リボン、靴
-        gltf = combine_material(gltf, {
+        gltf = combine_material(gltf, layout({
             '_Tops_': {'pos': (0, 0), 'size': (2048, 1536)},
             '_Bottoms_': {'pos': (0, 1536), 'size': (512, 512)},
             '_Accessory_': {'pos': (512, 1536), 'size': (512, 512)},
             '_Shoes_': {'pos': (1024, 1536), 'size': (512, 512)}
-        }, '_Tops_', texture_size)
+        }), '_Tops_', texture_size, image_cache, atlases, memo)
 
     elif cloth_type == CLOTH_MALE_STUDENT:
-        gltf = combine_material(gltf, {
+        gltf = combine_material(gltf, layout({
             '_Tops_': {'pos': (0, 0), 'size': (2048, 1024)},
             '_Bottoms_': {'pos': (0, 1024), 'size': (1024, 1024)},
             '_Accessory_': {'pos': (1024, 1024), 'size': (512, 512)},
             '_Shoes_': {'pos': (1024, 1536), 'size': (512, 512)}
-        }, '_Tops_', texture_size)
+        }), '_Tops_', texture_size, image_cache, atlases, memo)
 
     elif cloth_type == CLOTH_ONE_PIECE:
         # ワンピース、靴
         # 0.3.0: Onepiece
         # 0.4.0-p1: Onepice
-        gltf = combine_material(gltf, {
+        gltf = combine_material(gltf, layout({
             'F00_002_Onepi': {'pos': (0, 0), 'size': (2048, 1536)},
             '_Shoes_': {'pos': (0, 1536), 'size': (512, 512)}
-        }, 'F00_002_Onepi', texture_size)
+        }), 'F00_002_Onepi', texture_size, image_cache, atlases, memo)
 
     # 体、顔、口
-    gltf = combine_material(gltf, {
+    gltf = combine_material(gltf, layout({
         '_Face_': {'pos': (0, 0), 'size': (512, 512)},
         '_FaceMouth_': {'pos': (512, 0), 'size': (512, 512)},
         '_Body_': {'pos': (0, 512), 'size': (2048, 1536)}
-    }, '_Face_', texture_size)
-    # レンダータイプを変更
-    face_mat = find_vrm_material(gltf, '_Face_')
-    face_mat['keywordMap']['_ALPHATEST_ON'] = True
-    face_mat['tagMap']["RenderType"] = 'TransparentCutout'
+    }), '_Face_', texture_size, image_cache, atlases, memo)
+    # レンダータイプを変更(不透明にできるかはfinish_vroidでテクスチャから判定する)
+    set_render_mode(find_vrm_material(gltf, '_Face_'), find_material(gltf, '_Face_'), CUTOUT)
 
     # アイライン、まつ毛
-    gltf = combine_material(gltf, {
+    gltf = combine_material(gltf, layout({
         find_eye_extra_name(gltf): {'pos': (0, 0), 'size': (1024, 512)},
         '_FaceEyeline_': {'pos': (0, 512), 'size': (1024, 512)},
         '_FaceEyelash_': {'pos': (0, 1024), 'size': (1024, 512)}
-    }, '_FaceEyeline_', texture_size)
+    }), '_FaceEyeline_', texture_size, image_cache, atlases, memo)
 
     # 瞳孔、ハイライト、白目
-    gltf = combine_material(gltf, {
+    gltf = combine_material(gltf, layout({
         '_EyeIris_': {'pos': (0, 0), 'size': (1024, 512)},
         '_EyeHighlight_': {'pos': (0, 512), 'size': (1024, 512)},
         '_EyeWhite_': {'pos': (0, 1024), 'size': (1024, 512)}
-    }, '_EyeHighlight_', texture_size)
+    }), '_EyeHighlight_', texture_size, image_cache, atlases, memo)
     # 髪の毛、頭の下毛
     hair_resize = {}
     hair_material = find_material(gltf, '_Hair_')
@@ -629,17 +1024,122 @@ def reduce_vroid(gltf, replace_shade_color, texture_size):
         hair_resize[hair_material['name']] = {'pos': (0, 0), 'size': (512, 1024)}
         if find_material(gltf, '_HairBack_'):
             hair_resize['_HairBack_'] = {'pos': (512, 0), 'size': (1024, 1024)}
-        gltf = combine_material(gltf, hair_resize, '_Hair_', texture_size)
-
-    if replace_shade_color:
-        # 陰色を消す
-        gltf = replace_shade(gltf)
+        gltf = combine_material(gltf, layout(hair_resize), '_Hair_', texture_size, image_cache, atlases, memo)
+
+    if merge_tinted:
+        # 色の違いのみのマテリアルを、色をテクスチャに焼き込んで統合
+        print 'merge tinted materials...'
+        gltf = merge_tinted_materials(gltf, texture_size, image_cache, atlases, memo)
+
+    if min_outline_pixels is not None:
+        # ほとんど見えないアウトラインを無効にし、アウトライン以外が同じマテリアルを統合(メッシュ結合の前に行う)
+        print 'reduce outlines...'
+        gltf = deduplicated_materials(reduce_outlines(gltf, min_outline_pixels))
+
+    # 使用しない頂点属性を削除(削除する属性だけが異なるプリミティブも結合できるように、メッシュ結合の前に行う)
+    print 'shrink attributes...'
+    gltf = shrink_attributes(gltf)
+
+    if merge_meshes:
+        # マテリアル、スキンが同じプリミティブを結合(顔は描画順を維持する)
+        print 'merge mesh primitives...'
+        gltf = merge_mesh_primitives(gltf, [FACE_MESH_NAME])
+
+    if reduce_springs or max_spring_joints is not None:
+        # 揺れもの軽量化
+        print 'reduce spring bones...'
+        gltf = reduce_spring_bones(gltf, max_spring_joints)
+
+    if max_bone_weights:
+        # ボーン影響数を制限
+        print 'limit bone weights...'
+        gltf = limit_bone_weights(gltf, max_bone_weights)
+
+    if remove_bones:
+        # ウェイトのないボーンを削除
+        print 'remove unused bones...'
+        gltf = remove_unused_joints(gltf)
 
     # 不要要素削除
-    gltf = clean(gltf)
+    return clean(gltf)
+
+
+@indexed
+def finish_vroid(gltf, atlases, replace_shade_color, texture_size, image_cache=None, jpeg_quality=None,
+                 compress_level=DEFAULT_COMPRESS_LEVEL, memo=None, texel_density=False):
+    """
+    prepare_vroidの結果から指定テクスチャサイズのモデルを作成する
+    :param gltf: prepare_vroidで軽量化途中のglTFオブジェクト
+    :param atlases: prepare_vroidで作成した結合画像の作成情報リスト
+    :param replace_shade_color: Trueで陰色を消す
+    :param texture_size: テクスチャサイズの上限値
+    :param image_cache: デコード済み画像キャッシュ
+    :param jpeg_quality: 不透明な画像をJPEGにする場合の品質(Noneで可逆圧縮のみ)
+    :param compress_level: PNGの圧縮レベル(0～9)
+    :param memo: 処理結果のキャッシュ(Noneで使用しない)
+    :param texel_density: Trueで画像ごとにテクセル密度を揃えるサイズまで縮小する
+    :return: 軽量化したglTFオブジェクト
+    """
+    # 陰色を消す
+    gltf = replace_shade(gltf) if replace_shade_color else deepcopy(gltf)
+
+    for n, atlas in enumerate(atlases):
+        if atlas['size'] == atlas_size(atlas['resize_info'], texture_size):
+            continue  # 作成済みの結合画像と同じサイズ
+        vrm_material = find_vrm_material(gltf, atlas['material'])
+        if any(find_vrm_material(gltf, later['material']) is vrm_material for later in atlases[n + 1:]):
+            continue  # 後の結合画像に含まれる(作成元の画像は元のサイズで保持している)
+        # 結合画像をテクスチャサイズに合わせて作り直す
+        print 'recombine {} texture...'.format(atlas['material'])
+        image = vrm_material['textureProperties']['_MainTex']['source']
+        image['bufferView']['data'] = atlas_image(atlas['sources'], atlas['resize_info'], texture_size, image_cache,
+                                                   memo)
 
     # 他のテクスチャ画像サイズの変換
     print 'reduced images...'
-    gltf = reduced_images(gltf, texture_size)
+    target_sizes = texel_target_sizes(gltf, texture_size, image_cache, memo) if texel_density else None
+    gltf = reduced_images(gltf, texture_size, image_cache, memo, target_sizes)
+
+    # 使用範囲のアルファ値から描画モードを選び直す
+    print 'optimize render modes...'
+    gltf = optimize_render_modes(gltf, image_cache, memo)
+
+    # 画像ごとに最も小さい形式で再エンコード
+    print 'encode images...'
+    gltf = encoded_images(gltf, jpeg_quality, compress_level, image_cache, memo)
 
     return clean(gltf)
+
+
+def reduce_vroid(gltf, replace_shade_color, texture_size, remove_bones=False, max_bone_weights=None,
+                 reduce_springs=False, max_spring_joints=None, merge_meshes=False, remove_hidden=False,
+                 jpeg_quality=None, compress_level=DEFAULT_COMPRESS_LEVEL, image_cache=None, memo=None,
+                 min_outline_pixels=None, texel_density=False, merge_tinted=False):
+    """
+    VRoidモデルを軽量化する
+    :param gltf: glTFオブジェクト(VRM拡張を含む)
+    :param replace_shade_color: Trueで陰色を消す
+    :param texture_size: テクスチャサイズの上限値
+    :param remove_bones: Trueでウェイトのないボーンを削除する
+    :param max_bone_weights: 1頂点あたりのボーン影響数の上限値(Noneで制限しない)
+    :param reduce_springs: Trueで揺れものを軽量化する
+    :param max_spring_joints: 揺れもののジョイント数の上限値(Noneで間引きしない)
+    :param merge_meshes: Trueでメッシュをまたいでプリミティブを結合する
+    :param remove_hidden: Trueで服に隠れる体の三角形を削除する
+    :param jpeg_quality: 不透明な画像をJPEGにする場合の品質(Noneで可逆圧縮のみ)
+    :param compress_level: PNGの圧縮レベル(0～9)
+    :param image_cache: デコード済み画像キャッシュ(Noneで既定の上限のキャッシュを使用する)
+    :param memo: 処理結果のキャッシュ(監視モードで変換をまたいで使用する)
+    :param min_outline_pixels: 見積もったピクセル数がこれ未満のアウトラインを無効にする(Noneで変更しない)
+    :param texel_density: Trueでテクセル密度に合わせて結合画像の配置、画像ごとのサイズを縮小する
+    :param merge_tinted: Trueで色の違いのみのマテリアルを、色をテクスチャに焼き込んで統合する
+    :return: 軽量化したglTFオブジェクト
+    """
+    if image_cache is None:
+        image_cache = ImageCache()  # 各画像のデコードを1回にする
+    atlases = []
+    gltf = prepare_vroid(gltf, texture_size, remove_bones, max_bone_weights, reduce_springs, max_spring_joints,
+                         merge_meshes, remove_hidden, image_cache, atlases, memo, min_outline_pixels, texel_density,
+                         merge_tinted)
+    return finish_vroid(gltf, atlases, replace_shade_color, texture_size, image_cache, jpeg_quality, compress_level,
+                        memo, texel_density)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from io import BytesIO
+
+from accessor import element_size
+from imageinfo import image_size
+from spring import spring_cost
+from util import unique_instances
+
+"""
+実行時の負荷見積もり(ドローコール、VRAM、スキニング、モーフ、揺れもの)
+"""
+
+# ミップマップを含めたテクスチャのメモリ倍率
+MIPMAP_FACTOR = 4.0 / 3.0
+
+# デコード後の1ピクセルのバイト数(RGBA32)
+PIXEL_BYTES = 4
+
+
+def has_outline(vrm_material):
+    """
+    :param vrm_material: VRMマテリアル
+    :return: MToonのアウトラインが描画されるならTrue
+    """
+    if not vrm_material or vrm_material.get('shader') != 'VRM/MToon':
+        return False
+    keywords = vrm_material.get('keywordMap', {})
+    if not (keywords.get('MTOON_OUTLINE_WIDTH_WORLD') or keywords.get('MTOON_OUTLINE_WIDTH_SCREEN')):
+        return False
+    return vrm_material['floatProperties'].get('_OutlineWidth', 0) > 0
+
+
+def primitives(gltf):
+    """
+    :param gltf: glTFオブジェクト
+    :return: (メッシュインデックス、プリミティブ)リスト
+    """
+    return [(n, primitive) for n, mesh in enumerate(gltf['meshes']) for primitive in mesh['primitives']]
+
+
+def accessor_bytes(accessors):
+    return sum(a['count'] * element_size(a) for a in unique_instances(accessors))
+
+
+def texture_bytes(gltf):
+    """
+    デコード後のテクスチャのメモリ量(ミップマップ込み)を見積もる
+    :param gltf: glTFオブジェクト
+    :return: バイト数
+    """
+    total = 0
+    for image in unique_instances(gltf['images']):
+        if 'bufferView' not in image:
+            continue
+        data = image['bufferView']['data']
+        size = image_size(BytesIO(data), 0, len(data), image.get('mimeType'))
+        if size:
+            total += int(size[0] * size[1] * PIXEL_BYTES * MIPMAP_FACTOR)
+    return total
+
+
+def runtime_report(gltf):
+    """
+    モデルの実行時負荷を見積もる
+    :param gltf: glTFオブジェクト
+    :return: 見積もり辞書
+    """
+    vrm_materials = {m['name']: m for m in gltf['extensions']['VRM']['materialProperties']}
+    skinned_meshes = set(node['mesh'] for node in gltf['nodes'] if 'mesh' in node and 'skin' in node)
+    all_primitives = primitives(gltf)
+
+    draw_calls = 0
+    outline_draw_calls = 0
+    for _, primitive in all_primitives:
+        draw_calls += 1
+        if has_outline(vrm_materials.get(primitive['material']['name'])):
+            outline_draw_calls += 1
+
+    # 頂点データはプリミティブ間で共有されることがあるので、POSITIONアクセッサーごとに数える
+    sources = {}  # (メッシュインデックス, id(POSITION)) -> (メッシュインデックス, 頂点数, モーフターゲット数)
+    for mesh_index, primitive in all_primitives:
+        position = primitive['attributes']['POSITION']
+        key = (mesh_index, id(position))
+        targets = max(len(primitive.get('targets', [])), sources.get(key, (0, 0, 0))[2])
+        sources[key] = (mesh_index, position['count'], targets)
+
+    vertex_accessors = [a for _, p in all_primitives for a in p['attributes'].values()]
+    vertex_accessors += [a for _, p in all_primitives for t in p.get('targets', []) for a in t.values()]
+    index_accessors = [p['indices'] for _, p in all_primitives if 'indices' in p]
+
+    springs = spring_cost(gltf)
+    return {
+        'draw_calls': draw_calls + outline_draw_calls,
+        'outline_draw_calls': outline_draw_calls,
+        'materials': len(gltf['materials']),
+        'textures': len(unique_instances(gltf['images'])),
+        'texture_bytes': texture_bytes(gltf),
+        'vertices': sum(count for _, count, _ in sources.values()),
+        'vertex_bytes': accessor_bytes(vertex_accessors),
+        'triangles': sum(p['indices']['count'] // 3 for _, p in all_primitives
+                         if 'indices' in p and p.get('mode', 4) == 4),
+        'index_bytes': accessor_bytes(index_accessors),
+        'skinned_vertices': sum(count for mesh_index, count, _ in sources.values() if mesh_index in skinned_meshes),
+        'joints': len(set(j for skin in gltf['skins'] for j in skin['joints'])),
+        'morph_targets': sum(targets for _, _, targets in sources.values()),
+        'morph_vertices': sum(count * targets for _, count, targets in sources.values()),
+        'spring_joints': springs['joints'],
+        'spring_colliders': springs['colliders'],
+        'spring_collision_checks': springs['collision_checks']
+    }
+
+
+# 表示名、単位
+REPORT_ITEMS = [
+    ('draw_calls', 'draw calls', None),
+    ('outline_draw_calls', '\toutline', None),
+    ('materials', 'materials', None),
+    ('textures', 'textures', None),
+    ('texture_bytes', 'texture VRAM (with mips)', 'MB'),
+    ('vertices', 'vertices', None),
+    ('vertex_bytes', 'vertex buffers', 'MB'),
+    ('triangles', 'triangles', None),
+    ('index_bytes', 'index buffers', 'MB'),
+    ('skinned_vertices', 'skinned vertices', None),
+    ('joints', 'joints', None),
+    ('morph_targets', 'morph targets', None),
+    ('morph_vertices', 'morph target vertices', None),
+    ('spring_joints', 'spring joints', None),
+    ('spring_colliders', 'spring colliders', None),
+    ('spring_collision_checks', 'spring collision checks', None)
+]
+
+
+def format_value(value, unit):
+    if unit == 'MB':
+        return '{:.2f}MB'.format(value / 1024.0 / 1024.0)
+    return str(value)
+
+
+def print_report(before, after=None):
+    """
+    実行時負荷の見積もりを表示する(変換後を指定すると比較表示、減った項目は削減量も表示)
+    :param before: 見積もり辞書
+    :param after: 変換後の見積もり辞書
+    """
+    print 'runtime cost:'
+    for key, label, unit in REPORT_ITEMS:
+        if after is None:
+            print '\t{}: {}'.format(label, format_value(before[key], unit))
+        else:
+            saved = ' (-{})'.format(format_value(before[key] - after[key], unit)) if after[key] < before[key] else ''
+            print '\t{}: {} -> {}{}'.format(label, format_value(before[key], unit), format_value(after[key], unit),
+                                           saved)
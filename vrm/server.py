@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import httplib
+import json
+import os
+import socket
+import struct
+import sys
+import time
+import traceback
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, UnixStreamServer
+from multiprocessing import Pool
+from threading import BoundedSemaphore, Lock
+from urlparse import urlparse, parse_qs
+
+"""
+常駐変換サービス(HTTP、Unixソケット)
+POST /reduce にVRMファイルを送ると軽量化したVRMファイルを返す
+"""
+
+# 受け付けるVRMファイルの最大サイズ
+MAX_CONTENT_LENGTH = 512 * 1024 * 1024
+
+
+def parse_flag(value):
+    return value.lower() in ['1', 'true', 'yes', 'on']
+
+
+def parse_size(value):
+    option = value.split(',')[:2]
+    w, h = (option * 2)[:2]
+    return int(w), int(h)
+
+
+# クエリパラメータ名 -> 変換関数
+OPTION_PARSERS = {
+    'replace_shade_color': parse_flag,
+    'texture_size': parse_size,
+    'remove_bones': parse_flag,
+    'max_bone_weights': int,
+    'reduce_springs': parse_flag,
+    'max_spring_joints': int,
+    'merge_meshes': parse_flag,
+    'remove_hidden': parse_flag,
+    'interleave': parse_flag,
+    'jpeg_quality': int,
+    'compress_level': int,
+    'min_outline_pixels': float,
+    'texel_density': parse_flag,
+    'merge_tinted': parse_flag
+}
+
+DEFAULT_OPTIONS = {
+    'replace_shade_color': False,
+    'texture_size': (2048, 2048),
+    'remove_bones': False,
+    'max_bone_weights': None,
+    'reduce_springs': False,
+    'max_spring_joints': None,
+    'merge_meshes': False,
+    'remove_hidden': False,
+    'interleave': False,
+    'jpeg_quality': None,
+    'compress_level': 6,
+    'min_outline_pixels': None,
+    'texel_density': False,
+    'merge_tinted': False
+}
+
+
+def parse_options(query):
+    """
+    クエリ文字列から変換オプションを作成する
+    :param query: クエリ文字列(texture_size=512,512&merge_meshes=1)
+    :return: 変換オプション辞書
+    """
+    options = dict(DEFAULT_OPTIONS)
+    for name, values in parse_qs(query).items():
+        if name not in OPTION_PARSERS:
+            raise ValueError('unknown option: {}'.format(name))
+        options[name] = OPTION_PARSERS[name](values[-1])
+    return options
+
+
+# ワーカープロセスのbufferViewのバイトデータをメモリ上に保持する上限(Noneで上限なし)
+_payload_memory = [None]
+
+
+def init_worker(payload_memory=None):
+    """
+    ワーカープロセスの初期化
+    変換処理のモジュール(Pillowを含む)を読み込んでおき、進捗表示を捨てる
+    :param payload_memory: bufferViewのバイトデータをメモリ上に保持する上限(Noneで上限なし)
+    """
+    import reducer  # noqa
+    _payload_memory[0] = payload_memory
+    sys.stdout = open(os.devnull, 'w')
+
+
+def convert(glb_bin, options, queued_at):
+    """
+    ワーカープロセスでVRMを読み込み、軽量化し、保存する
+    例外はプロセス間で受け渡せない場合があるので結果辞書で返す
+    :param glb_bin: VRMファイルのバイトデータ
+    :param options: 変換オプション辞書
+    :param queued_at: 要求の受付時刻
+    :return: 結果辞書(status, data/errors/message, timings)
+    """
+    from payload import PayloadStore, set_active_store
+    from reducer import reduce_vroid
+    from validator import ValidationError
+    from vrm import loads
+
+    timings = {'queue': time.time() - queued_at}
+    # 一時ファイルは変換ごとに作成し、変換後に削除する(ワーカープロセスの間に大きくならないようにする)
+    store = PayloadStore(_payload_memory[0]) if _payload_memory[0] is not None else None
+    set_active_store(store)
+    try:
+        start = time.time()
+        vrm = loads(glb_bin)
+        timings['load'] = time.time() - start
+
+        start = time.time()
+        vrm.gltf = reduce_vroid(vrm.gltf, options['replace_shade_color'], options['texture_size'],
+                                options['remove_bones'], options['max_bone_weights'],
+                                options['reduce_springs'], options['max_spring_joints'],
+                                options['merge_meshes'], options['remove_hidden'],
+                                options['jpeg_quality'], options['compress_level'],
+                                min_outline_pixels=options['min_outline_pixels'],
+                                texel_density=options['texel_density'],
+                                merge_tinted=options['merge_tinted'])
+        timings['reduce'] = time.time() - start
+
+        start = time.time()
+        data = vrm.dumps(options['interleave'])
+        timings['save'] = time.time() - start
+    except ValidationError as e:
+        return {'status': 'invalid', 'errors': e.errors, 'timings': timings}
+    except (AssertionError, struct.error, ValueError, KeyError, IndexError, TypeError) as e:
+        # 読み込めないファイル、VRoid以外のモデル
+        return {'status': 'bad_request', 'message': repr(e), 'timings': timings}
+    except Exception:
+        return {'status': 'error', 'message': traceback.format_exc(), 'timings': timings}
+    finally:
+        set_active_store(None)
+        if store is not None:
+            store.close()
+    return {'status': 'ok', 'data': data, 'timings': timings}
+
+
+class ReducerHandler(BaseHTTPRequestHandler):
+    """
+    変換要求のHTTPハンドラ
+    """
+    server_version = 'VReducer'
+
+    def address_string(self):
+        # Unixソケットではクライアントアドレスがない
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def log_message(self, fmt, *args):
+        sys.stderr.write('{} - - [{}] {}\n'.format(self.address_string(), self.log_date_time_string(), fmt % args))
+
+    def send_json(self, code, value, headers=None):
+        body = json.dumps(value)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, header in (headers or {}).items():
+            self.send_header(name, header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/status':
+            self.send_json(404, {'error': 'not found'})
+            return
+        self.send_json(200, self.server.status())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/reduce':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            options = parse_options(url.query)
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if not length:
+            self.send_json(411, {'error': 'Content-Length required'})
+            return
+        if length > MAX_CONTENT_LENGTH:
+            self.send_json(413, {'error': 'too large'})
+            return
+        glb_bin = self.rfile.read(length)
+
+        start = time.time()
+        result = self.server.submit(glb_bin, options)
+        if result is None:
+            # 実行中、待機中の要求が上限に達している
+            self.send_json(503, {'error': 'busy'}, {'Retry-After': '1'})
+            return
+        timings = result['timings']
+        timings['total'] = time.time() - start
+        headers = {'X-Reducer-{}-Time'.format(name.capitalize()): '{:.3f}'.format(value)
+                   for name, value in timings.items()}
+        self.log_message('reduce %s', ' '.join('{}={:.3f}'.format(k, v) for k, v in sorted(timings.items())))
+
+        if result['status'] == 'invalid':
+            self.send_json(422, {'error': 'invalid model', 'errors': result['errors']}, headers)
+        elif result['status'] == 'bad_request':
+            self.send_json(400, {'error': result['message']}, headers)
+        elif result['status'] == 'error':
+            self.log_error('%s', result['message'])
+            self.send_json(500, {'error': 'internal error'}, headers)
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'model/gltf-binary')
+            self.send_header('Content-Length', str(len(result['data'])))
+            for name, header in headers.items():
+                self.send_header(name, header)
+            self.end_headers()
+            self.wfile.write(result['data'])
+
+
+class ReducerServerMixIn(ThreadingMixIn):
+    """
+    ワーカープロセスプールへの要求の受け渡し、同時実行数と待機数の制限
+    """
+    daemon_threads = True
+
+    def init_pool(self, workers, max_queue, max_tasks=None, payload_memory=None):
+        """
+        :param workers: ワーカープロセス数(同時実行数)
+        :param max_queue: 実行待ちで待機できる要求数(超えた要求は503を返す)
+        :param max_tasks: ワーカープロセスを作り直すまでの変換数(Noneで作り直さない)
+        :param payload_memory: ワーカーごとのbufferViewのバイトデータをメモリ上に保持する上限(Noneで上限なし)
+        """
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pool = Pool(workers, init_worker, (payload_memory,), maxtasksperchild=max_tasks)
+        self.slots = BoundedSemaphore(workers + max_queue)
+        self.lock = Lock()
+        self.active = 0
+        self.processed = 0
+
+    def submit(self, glb_bin, options):
+        """
+        ワーカープロセスで変換し、結果を待つ
+        :param glb_bin: VRMファイルのバイトデータ
+        :param options: 変換オプション辞書
+        :return: 結果辞書(受付できない場合はNone)
+        """
+        if not self.slots.acquire(False):
+            return None
+        try:
+            with self.lock:
+                self.active += 1
+            # get()にタイムアウトを指定しないとKeyboardInterruptで止められない
+            return self.pool.apply_async(convert, (glb_bin, options, time.time())).get(sys.maxint)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.processed += 1
+            self.slots.release()
+
+    def status(self):
+        """
+        :return: ワーカー数、実行中、待機中の要求数、処理済み数の辞書
+        """
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'running': min(self.active, self.workers),
+                'queued': max(0, self.active - self.workers),
+                'processed': self.processed
+            }
+
+    def close_pool(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class ReducerHTTPServer(ReducerServerMixIn, HTTPServer):
+    pass
+
+
+class ReducerUnixServer(ReducerServerMixIn, UnixStreamServer):
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)  # 前回の起動で残ったソケット
+        UnixStreamServer.server_bind(self)
+
+
+def create_server(address, workers=2, max_queue=4, max_tasks=None, payload_memory=None):
+    """
+    変換サービスを作成する
+    :param address: (ホスト, ポート)、またはUnixソケットのパス
+    :param workers: ワーカープロセス数
+    :param max_queue: 実行待ちで待機できる要求数
+    :param max_tasks: ワーカープロセスを作り直すまでの変換数
+    :param payload_memory: ワーカーごとのbufferViewのバイトデータをメモリ上に保持する上限
+    :return: サーバーオブジェクト
+    """
+    if isinstance(address, tuple):
+        server = ReducerHTTPServer(address, ReducerHandler)
+    else:
+        server = ReducerUnixServer(address, ReducerHandler)
+    server.init_pool(workers, max_queue, max_tasks, payload_memory)
+    return server
+
+
+def serve(address, workers=2, max_queue=4, max_tasks=None, payload_memory=None):
+    """
+    変換サービスを起動する(Ctrl+Cで終了)
+    :param address: (ホスト, ポート)、またはUnixソケットのパス
+    :param workers: ワーカープロセス数
+    :param max_queue: 実行待ちで待機できる要求数
+    :param max_tasks: ワーカープロセスを作り直すまでの変換数
+    :param payload_memory: ワーカーごとのbufferViewのバイトデータをメモリ上に保持する上限
+    """
+    server = create_server(address, workers, max_queue, max_tasks, payload_memory)
+    print 'serving on {} (workers: {}, queue: {})'.format(address, workers, max_queue)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.close_pool()
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """
+    Unixソケット接続のHTTPConnection
+    """
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connection(address, timeout=None):
+    if isinstance(address, tuple):
+        return httplib.HTTPConnection(address[0], address[1], timeout=timeout)
+    return UnixHTTPConnection(address, timeout)
+
+
+def request(address, glb_bin, options=None, timeout=None):
+    """
+    変換サービスにVRMファイルを送る(ローカルクライアント)
+    :param address: (ホスト, ポート)、またはUnixソケットのパス
+    :param glb_bin: VRMファイルのバイトデータ
+    :param options: クエリパラメータ辞書({'texture_size': '512,512', 'merge_meshes': 1})
+    :param timeout: タイムアウト秒数
+    :return: ステータスコード、レスポンスヘッダー辞書、レスポンスボディ
+    """
+    query = '&'.join('{}={}'.format(k, v) for k, v in sorted((options or {}).items()))
+    conn = connection(address, timeout)
+    try:
+        conn.request('POST', '/reduce' + ('?' + query if query else ''), glb_bin,
+                     {'Content-Type': 'model/gltf-binary'})
+        response = conn.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        conn.close()
+
+
+def status(address, timeout=None):
+    """
+    変換サービスの状態を取得する
+    :param address: (ホスト, ポート)、またはUnixソケットのパス
+    :param timeout: タイムアウト秒数
+    :return: 状態辞書
+    """
+    conn = connection(address, timeout)
+    try:
+        conn.request('GET', '/status')
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from collections import OrderedDict
+from copy import deepcopy
+
+from accessor import read_accessor, packed_accessor
+
+"""
+スキン(ボーン)の削減処理
+"""
+
+# 正規化整数ウェイトの最大値
+NORMALIZED_MAX = {
+    5121: 255.0,
+    5123: 65535.0
+}
+
+
+def read_weights(accessor):
+    """
+    ウェイトを浮動小数点で読み込む
+    :param accessor: WEIGHTS_nアクセッサー
+    :return: ウェイト値リスト
+    """
+    values = read_accessor(accessor)
+    scale = NORMALIZED_MAX.get(accessor['componentType'])
+    if scale:
+        return [v / scale for v in values]
+    return list(values)
+
+
+def pack_weights(weights, accessor):
+    """
+    浮動小数点のウェイトをアクセッサーの型に合わせる
+    :param weights: ウェイト値リスト
+    :param accessor: 元のWEIGHTS_nアクセッサー
+    :return: アクセッサーの型に合わせた値リスト
+    """
+    scale = NORMALIZED_MAX.get(accessor['componentType'])
+    if scale:
+        return [int(round(w * scale)) for w in weights]
+    return weights
+
+
+def skinned_primitives(gltf):
+    """
+    スキンを持つノードのプリミティブを列挙する
+    :param gltf: glTFオブジェクト
+    :return: (スキンインデックス、プリミティブ)リスト(generator)
+    """
+    for node in gltf['nodes']:
+        if 'mesh' in node and 'skin' in node:
+            for primitive in gltf['meshes'][node['mesh']]['primitives']:
+                yield node['skin'], primitive
+
+
+def joint_sets(primitive):
+    """
+    プリミティブのJOINTS_n、WEIGHTS_nアクセッサーの組を列挙する
+    :param primitive: プリミティブ
+    :return: (JOINTS_nアクセッサー、WEIGHTS_nアクセッサー)リスト
+    """
+    attributes = primitive['attributes']
+    sets = []
+    n = 0
+    while 'JOINTS_{}'.format(n) in attributes and 'WEIGHTS_{}'.format(n) in attributes:
+        sets.append((attributes['JOINTS_{}'.format(n)], attributes['WEIGHTS_{}'.format(n)]))
+        n += 1
+    return sets
+
+
+def weighted_joints(gltf):
+    """
+    頂点ウェイトを持つジョイントのノードインデックスを列挙する
+    :param gltf: glTFオブジェクト
+    :return: ノードインデックスのset
+    """
+    used = set()
+    checked = set()  # 共有アクセッサーの二重読み込み防止
+    for skin_index, primitive in skinned_primitives(gltf):
+        joints = gltf['skins'][skin_index]['joints']
+        for joints_accessor, weights_accessor in joint_sets(primitive):
+            key = (skin_index, id(joints_accessor), id(weights_accessor))
+            if key in checked:
+                continue
+            checked.add(key)
+            weights = read_weights(weights_accessor)
+            for joint, weight in zip(read_accessor(joints_accessor), weights):
+                if weight > 0:
+                    used.add(joints[joint])
+    return used
+
+
+def parent_map(nodes):
+    """
+    :param nodes: ノードリスト
+    :return: 子ノードインデックス -> 親ノードインデックス の対応辞書
+    """
+    return {child: n for n, node in enumerate(nodes) for child in node.get('children', [])}
+
+
+def descendants(nodes, index):
+    """
+    子孫ノードを列挙する(自身を含む)
+    :param nodes: ノードリスト
+    :param index: ノードインデックス
+    :return: ノードインデックスリスト
+    """
+    result = [index]
+    for child in nodes[index].get('children', []):
+        result.extend(descendants(nodes, child))
+    return result
+
+
+def protected_nodes(gltf):
+    """
+    削除してはいけないノードを列挙する
+    ヒューマノイドボーン、揺れものボーン(子孫を含む)、コライダー、一人称ボーン、メッシュを持つノード
+    :param gltf: glTFオブジェクト
+    :return: ノードインデックスのset
+    """
+    nodes = gltf['nodes']
+    vrm = gltf['extensions']['VRM']
+    protected = set()
+
+    for bone in vrm.get('humanoid', {}).get('humanBones', []):
+        protected.add(bone['node'])
+
+    first_person = vrm.get('firstPerson', {})
+    if first_person.get('firstPersonBone', -1) >= 0:
+        protected.add(first_person['firstPersonBone'])
+
+    secondary = vrm.get('secondaryAnimation', {})
+    for group in secondary.get('boneGroups', []):
+        for bone in group['bones']:
+            protected.update(descendants(nodes, bone))  # 揺れものは子孫ノードも計算に使用する
+        if group.get('center', -1) >= 0:
+            protected.add(group['center'])
+    for collider_group in secondary.get('colliderGroups', []):
+        protected.add(collider_group['node'])
+
+    for skin in gltf['skins']:
+        if 'skeleton' in skin:
+            protected.add(skin['skeleton'])
+
+    for scene in gltf.get('scenes', []):
+        protected.update(scene.get('nodes', []))
+
+    for n, node in enumerate(nodes):
+        if 'mesh' in node or 'camera' in node:
+            protected.add(n)
+    return protected
+
+
+def unused_joints(gltf):
+    """
+    ウェイトがなく、ヒューマノイド、揺れものでもないジョイントを列挙する
+    :param gltf: glTFオブジェクト
+    :return: ノードインデックスのset
+    """
+    joints = set(joint for skin in gltf['skins'] for joint in skin['joints'])
+    return joints - weighted_joints(gltf) - protected_nodes(gltf)
+
+
+def removable_nodes(nodes, candidates):
+    """
+    子孫を含めて全て削除候補のノードを列挙する
+    :param nodes: ノードリスト
+    :param candidates: 削除候補ノードインデックス
+    :return: ノードインデックスのset
+    """
+    return set(n for n in candidates if set(descendants(nodes, n)) <= candidates)
+
+
+def remap_nodes(gltf, node_map):
+    """
+    ノードインデックスの参照を更新する
+    :param gltf: glTFオブジェクト
+    :param node_map: 旧ノードインデックス -> 新ノードインデックス の対応辞書(削除ノードは含まない)
+    """
+    for node in gltf['nodes']:
+        if 'children' in node:
+            node['children'] = [node_map[c] for c in node['children'] if c in node_map]
+            if not node['children']:
+                del node['children']
+
+    for scene in gltf.get('scenes', []):
+        scene['nodes'] = [node_map[n] for n in scene.get('nodes', []) if n in node_map]
+
+    for skin in gltf['skins']:
+        skin['joints'] = [node_map[j] for j in skin['joints']]
+        if 'skeleton' in skin:
+            skin['skeleton'] = node_map[skin['skeleton']]
+
+    vrm = gltf['extensions']['VRM']
+    for bone in vrm.get('humanoid', {}).get('humanBones', []):
+        bone['node'] = node_map[bone['node']]
+
+    first_person = vrm.get('firstPerson', {})
+    if first_person.get('firstPersonBone', -1) >= 0:
+        first_person['firstPersonBone'] = node_map[first_person['firstPersonBone']]
+
+    secondary = vrm.get('secondaryAnimation', {})
+    for group in secondary.get('boneGroups', []):
+        group['bones'] = [node_map[b] for b in group['bones']]
+        if group.get('center', -1) >= 0:
+            group['center'] = node_map[group['center']]
+    for collider_group in secondary.get('colliderGroups', []):
+        collider_group['node'] = node_map[collider_group['node']]
+
+
+def remove_nodes(gltf, removed):
+    """
+    指定したノードを削除してインデックスを詰める
+    :param gltf: glTFオブジェクト
+    :param removed: 削除するノードインデックスのset
+    """
+    node_map = {}
+    new_nodes = []
+    for n, node in enumerate(gltf['nodes']):
+        if n not in removed:
+            node_map[n] = len(new_nodes)
+            new_nodes.append(node)
+    gltf['nodes'] = new_nodes
+    remap_nodes(gltf, node_map)
+
+
+def update_skin_joints(gltf, removed_joints):
+    """
+    スキンから指定したジョイントを削除し、JOINTS_n、inverseBindMatricesを振り直す
+    :param gltf: glTFオブジェクト
+    :param removed_joints: 削除するジョイントのノードインデックスset
+    :raise ValueError: 同じプリミティブが振り直し方の異なる複数のスキンで使われている場合
+    """
+    # スキンごとに 旧ジョイント番号 -> 新ジョイント番号 の対応を作成
+    kept_joints = [[n for n, joint in enumerate(skin['joints']) if joint not in removed_joints]
+                   for skin in gltf['skins']]
+    joint_maps = [{old: new for new, old in enumerate(kept)} for kept in kept_joints]
+
+    # 書き換え前に 元のJOINTS_nアクセッサー -> (スキン、参照元リスト) を集める
+    # (1つのメッシュが複数のスキンで使われる場合、同じアクセッサーが複数回現れる)
+    targets = OrderedDict()  # 出力順を固定する
+    for skin_index, primitive in skinned_primitives(gltf):
+        attributes = primitive['attributes']
+        for name in [k for k in attributes if k.startswith('JOINTS_')]:
+            joints_accessor = attributes[name]
+            other, users = targets.setdefault(id(joints_accessor), (skin_index, []))
+            if joint_maps[other] != joint_maps[skin_index]:
+                raise ValueError('JOINTS accessor is shared by skins {} and {} with different joint maps'.format(
+                    other, skin_index))
+            users.append((attributes, name))
+
+    for skin, kept in zip(gltf['skins'], kept_joints):
+        # inverseBindMatricesを詰め直す
+        matrices = read_accessor(skin['inverseBindMatrices'])
+        new_matrices = [v for n in kept for v in matrices[n * 16:(n + 1) * 16]]
+        accessor, view = packed_accessor(skin['inverseBindMatrices'], new_matrices)
+        skin['inverseBindMatrices'] = accessor
+        gltf['accessors'].append(accessor)
+        gltf['bufferViews'].append(view)
+        skin['joints'] = [skin['joints'][n] for n in kept]
+
+    # JOINTS_nを元のアクセッサーごとに1回だけ振り直す(削除ジョイントはウェイト0なので0番に置き換える)
+    for skin_index, users in targets.values():
+        attributes, name = users[0]
+        joints_accessor = attributes[name]
+        joint_map = joint_maps[skin_index]
+        joints = [joint_map.get(j, 0) for j in read_accessor(joints_accessor)]
+        accessor, view = packed_accessor(joints_accessor, joints)
+        gltf['accessors'].append(accessor)
+        gltf['bufferViews'].append(view)
+        for attributes, name in users:
+            attributes[name] = accessor
+
+
+def remove_unused_joints(gltf):
+    """
+    ウェイトのないジョイントをスキン、ノードツリーから削除する
+    ヒューマノイドボーン、揺れものボーンは残す
+    :param gltf: glTFオブジェクト
+    :return: ジョイント削除後のglTFオブジェクト
+    """
+    gltf = deepcopy(gltf)
+    unused = unused_joints(gltf)
+    if not unused:
+        return gltf
+
+    update_skin_joints(gltf, unused)
+    # 子孫も全て不要なノードのみツリーから削除する
+    remove_nodes(gltf, removable_nodes(gltf['nodes'], unused))
+    return gltf
+
+
+def limited_weights(joints, weights, max_weights):
+    """
+    1頂点のウェイトを影響数の大きい順に指定数までに制限し、正規化する
+    :param joints: ジョイント番号リスト
+    :param weights: ウェイトリスト
+    :param max_weights: 1頂点あたりの最大影響数
+    :return: ジョイント番号リスト、ウェイトリスト(元と同じ長さ)
+    """
+    influences = sorted(zip(weights, joints), key=lambda x: -x[0])[:max_weights]
+    influences = [(w, j) for w, j in influences if w > 0]
+    total = sum(w for w, _ in influences)
+    if not total:
+        return joints, weights
+    padding = [(0.0, 0)] * (len(joints) - len(influences))
+    new_weights, new_joints = zip(*(influences + padding))
+    return list(new_joints), [w / total for w in new_weights]
+
+
+def limit_bone_weights(gltf, max_weights):
+    """
+    1頂点あたりのボーン影響数を制限する
+    :param gltf: glTFオブジェクト
+    :param max_weights: 1頂点あたりの最大影響数(1～4)
+    :return: ウェイト制限後のglTFオブジェクト
+    """
+    gltf = deepcopy(gltf)
+    new_accessors = {}
+    for _, primitive in skinned_primitives(gltf):
+        sets = joint_sets(primitive)
+        if not sets:
+            continue
+        key = tuple(id(a) for pair in sets for a in pair)
+        if key not in new_accessors:
+            # 全セットを頂点ごとにまとめる
+            joints_values = [read_accessor(j) for j, _ in sets]
+            weights_values = [read_weights(w) for _, w in sets]
+            new_joints, new_weights = [], []
+            for i in xrange(0, len(joints_values[0]), 4):
+                joints = [v for values in joints_values for v in values[i:i + 4]]
+                weights = [v for values in weights_values for v in values[i:i + 4]]
+                joints, weights = limited_weights(joints, weights, max_weights)
+                new_joints.extend(joints[:4])  # 4影響以下に制限するため先頭セットのみ使用する
+                new_weights.extend(weights[:4])
+
+            joints_accessor, weights_accessor = sets[0]
+            new_joints_accessor, joints_view = packed_accessor(joints_accessor, new_joints)
+            new_weights_accessor, weights_view = packed_accessor(weights_accessor,
+                                                                 pack_weights(new_weights, weights_accessor))
+            gltf['accessors'].extend([new_joints_accessor, new_weights_accessor])
+            gltf['bufferViews'].extend([joints_view, weights_view])
+            new_accessors[key] = (sets, new_joints_accessor, new_weights_accessor)
+
+        _, new_joints_accessor, new_weights_accessor = new_accessors[key]
+        attributes = primitive['attributes']
+        for n in range(1, len(sets)):
+            del attributes['JOINTS_{}'.format(n)]
+            del attributes['WEIGHTS_{}'.format(n)]
+        attributes['JOINTS_0'] = new_joints_accessor
+        attributes['WEIGHTS_0'] = new_weights_accessor
+    return gltf
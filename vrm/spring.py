@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from copy import deepcopy
+from math import sqrt
+
+from skin import descendants
+from util import hashable
+
+"""
+揺れもの(secondaryAnimation)の削減処理
+"""
+
+
+def bone_groups(gltf):
+    """
+    集計用(変更しない)
+    :param gltf: glTFオブジェクト
+    :return: 揺れものグループリスト(なければ空のリスト)
+    """
+    return gltf['extensions']['VRM'].get('secondaryAnimation', {}).get('boneGroups', [])
+
+
+def collider_groups(gltf):
+    """
+    集計用(変更しない)
+    :param gltf: glTFオブジェクト
+    :return: コライダーグループリスト(なければ空のリスト)
+    """
+    return gltf['extensions']['VRM'].get('secondaryAnimation', {}).get('colliderGroups', [])
+
+
+def group_joint_count(nodes, group):
+    """
+    揺れものグループで計算されるジョイント数を返す(ルートボーン以下の全ノード)
+    :param nodes: ノードリスト
+    :param group: 揺れものグループ
+    :return: ジョイント数
+    """
+    return sum(len(descendants(nodes, bone)) for bone in group['bones'])
+
+
+def group_collider_count(colliders, group):
+    """
+    揺れものグループが参照するコライダー(球)数を返す
+    :param colliders: コライダーグループリスト
+    :param group: 揺れものグループ
+    :return: コライダー数
+    """
+    return sum(len(colliders[n]['colliders']) for n in group.get('colliderGroups', []))
+
+
+def spring_cost(gltf):
+    """
+    揺れものの計算コストを集計する
+    :param gltf: glTFオブジェクト
+    :return: グループ数、ジョイント数、コライダー数、衝突判定数の辞書
+    """
+    nodes = gltf['nodes']
+    groups = bone_groups(gltf)
+    colliders = collider_groups(gltf)
+    return {
+        'groups': len(groups),
+        'joints': sum(group_joint_count(nodes, group) for group in groups),
+        'colliders': sum(len(cg['colliders']) for cg in colliders),
+        # ジョイントごとに参照コライダー全てと判定する
+        'collision_checks': sum(group_joint_count(nodes, group) * group_collider_count(colliders, group)
+                                for group in groups)
+    }
+
+
+def group_parameters(group):
+    """
+    揺れものグループの比較用パラメータを返す(ボーン、コメントを除外)
+    :param group: 揺れものグループ
+    :return: 比較用パラメータ辞書
+    """
+    params = {k: v for k, v in group.items() if k not in ['bones', 'comment', 'colliderGroups']}
+    params['colliderGroups'] = sorted(set(group.get('colliderGroups', [])))
+    return params
+
+
+def merge_spring_groups(groups):
+    """
+    パラメータ、コライダーが同じ揺れものグループを1つにまとめる
+    :param groups: 揺れものグループリスト
+    :return: 新しい揺れものグループリスト
+    """
+    merged_groups = {}  # 比較用パラメータ -> まとめ先の揺れものグループ
+    new_groups = []
+    for group in groups:
+        params = hashable(group_parameters(group))
+        if params in merged_groups:
+            merged = merged_groups[params]
+            merged['bones'] += [b for b in group['bones'] if b not in merged['bones']]
+            if group.get('comment') and group['comment'] not in merged.get('comment', ''):
+                merged['comment'] = '-'.join(filter(None, [merged.get('comment'), group['comment']]))
+        else:
+            merged_groups[params] = group
+            new_groups.append(group)
+    return new_groups
+
+
+def thin_spring_chains(nodes, groups, max_joints):
+    """
+    ジョイント数が上限以下になるまで揺れものチェーンを間引く
+    長いチェーンから順にルートボーンを子ボーンに置き換えて根元側を固定し、
+    それでも超える場合は短いチェーンから揺れものを外す
+    :param nodes: ノードリスト
+    :param groups: 揺れものグループリスト
+    :param max_joints: ジョイント数の上限値
+    """
+
+    def total():
+        return sum(group_joint_count(nodes, group) for group in groups)
+
+    def chains():
+        # (ジョイント数, グループ, ルートボーン)リスト
+        return [(len(descendants(nodes, bone)), group, bone) for group in groups for bone in group['bones']]
+
+    while total() > max_joints:
+        candidates = [c for c in chains() if nodes[c[2]].get('children')]
+        if not candidates:
+            break
+        _, group, bone = max(candidates, key=lambda c: c[0])
+        index = group['bones'].index(bone)
+        children = [c for c in nodes[bone]['children'] if c not in group['bones']]
+        group['bones'][index:index + 1] = children  # 根元を固定して子ボーンをルートにする
+
+    while total() > max_joints:
+        remaining = chains()
+        if not remaining:
+            break
+        _, group, bone = min(remaining, key=lambda c: c[0])
+        group['bones'].remove(bone)
+
+    groups[:] = [group for group in groups if group['bones']]
+
+
+def sphere_contains(outer, inner):
+    """
+    :param outer: コライダー(球)
+    :param inner: コライダー(球)
+    :return: innerがouterの内側に含まれていればTrue
+    """
+    o, i = outer['offset'], inner['offset']
+    distance = sqrt(sum((o[k] - i[k]) ** 2 for k in 'xyz'))
+    return distance + inner['radius'] <= outer['radius']
+
+
+def simplified_colliders(colliders):
+    """
+    他の球に包含されるコライダーを削除する
+    :param colliders: コライダーリスト
+    :return: 新しいコライダーリスト
+    """
+    new_colliders = []
+    for n, collider in enumerate(colliders):
+        # 包含する球(同一の場合は先のものを残す)があれば削除
+        contained = [other for m, other in enumerate(colliders) if m != n and sphere_contains(other, collider)
+                     and (m < n or not sphere_contains(collider, other))]
+        if not contained:
+            new_colliders.append(collider)
+    return new_colliders
+
+
+def remove_unused_collider_groups(secondary):
+    """
+    揺れものグループから参照されないコライダーグループを削除する
+    :param secondary: secondaryAnimation拡張
+    """
+    used = sorted(set(n for group in secondary['boneGroups'] for n in group.get('colliderGroups', [])))
+    index_map = {old: new for new, old in enumerate(used)}
+    secondary['colliderGroups'] = [secondary['colliderGroups'][n] for n in used]
+    for group in secondary['boneGroups']:
+        group['colliderGroups'] = [index_map[n] for n in group.get('colliderGroups', [])]
+
+
+def reduce_spring_bones(gltf, max_joints=None):
+    """
+    揺れものを軽量化する
+    同一パラメータのグループ統合、ジョイント数上限までの間引き、未使用コライダー削除、包含コライダー削除
+    :param gltf: glTFオブジェクト
+    :param max_joints: 揺れもののジョイント数上限値(Noneで間引きしない)
+    :return: 揺れもの軽量化後のglTFオブジェクト
+    """
+    gltf = deepcopy(gltf)
+    # 変更を反映するため、拡張がなければ作成する
+    secondary = gltf['extensions']['VRM'].setdefault('secondaryAnimation', {})
+    secondary.setdefault('boneGroups', [])
+    secondary.setdefault('colliderGroups', [])
+
+    secondary['boneGroups'] = merge_spring_groups(secondary['boneGroups'])
+    if max_joints is not None:
+        thin_spring_chains(gltf['nodes'], secondary['boneGroups'], max_joints)
+
+    remove_unused_collider_groups(secondary)
+    for collider_group in secondary['colliderGroups']:
+        collider_group['colliders'] = simplified_colliders(collider_group['colliders'])
+
+    return gltf
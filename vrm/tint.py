@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from copy import copy
+from io import BytesIO
+from math import ceil, sqrt
+
+from PIL import Image
+
+from model import to_json
+from util import hashable
+
+"""
+色(_Color)のテクスチャへの焼き込み
+MToonの明色はMainTex * _Color、陰色はShadeTexture * _ShadeColorなので、
+_Colorをテクスチャに掛けて白にし、_ShadeColorを_Colorで割れば見た目は変わらない
+焼き込むとテクスチャ以外が同じになるマテリアルは、テクスチャを並べた結合画像で1つのマテリアルにできる
+"""
+
+WHITE = [1, 1, 1, 1]
+
+# 焼き込み後の陰色の小数点以下の桁数(割り算の誤差で比較が変わらないようにする)
+COLOR_DIGITS = 4
+
+# 結合画像にまとめるテクスチャ(マテリアルの比較から除外する)
+BAKED_TEXTURES = ['_MainTex', '_ShadeTexture']
+
+# UVを使わないテクスチャ(スフィアマップは法線で参照する)
+NON_UV_TEXTURES = ['_SphereAdd']
+
+
+def tint(vrm_material):
+    """
+    :param vrm_material: VRMマテリアル
+    :return: _Color(RGBA)
+    """
+    return vrm_material['vectorProperties'].get('_Color', WHITE)
+
+
+def shares_main_texture(vrm_material):
+    """
+    :param vrm_material: VRMマテリアル
+    :return: 陰色テクスチャが_MainTexと同じ画像ならTrue
+    """
+    textures = vrm_material['textureProperties']
+    shade = textures.get('_ShadeTexture')
+    return shade is not None and shade['source'] is textures['_MainTex']['source']
+
+
+def can_bake(vrm_material):
+    """
+    MToonで、陰色テクスチャがないか_MainTexと同じ画像の場合のみ焼き込める
+    (別の陰色テクスチャは_Colorと無関係なので、_ShadeColorを割ると色が変わる)
+    :param vrm_material: VRMマテリアル
+    :return: _Colorをテクスチャに焼き込めればTrue
+    """
+    if vrm_material['shader'] != 'VRM/MToon' or '_MainTex' not in vrm_material['textureProperties']:
+        return False
+    if vrm_material['textureProperties'].get('_ShadeTexture') is not None and not shares_main_texture(vrm_material):
+        return False
+    color = tint(vrm_material)
+    if len(color) != 4 or any(c > 1 or c < 0 for c in color):
+        return False  # 8bitの画像に焼き込めない
+    return not shares_main_texture(vrm_material) or all(c > 0 for c in color[:3])
+
+
+def other_uv_textures(vrm_material):
+    """
+    結合画像に合わせてUVを変換すると、これらのテクスチャは別の位置を参照してしまう
+    :param vrm_material: VRMマテリアル
+    :return: 結合画像にまとめるテクスチャ以外の、UVで参照するテクスチャ名リスト
+    """
+    return [name for name, texture in vrm_material['textureProperties'].items()
+            if texture is not None and name not in BAKED_TEXTURES + NON_UV_TEXTURES]
+
+
+def baked_shade_color(vrm_material):
+    """
+    :param vrm_material: VRMマテリアル
+    :return: 焼き込み後の_ShadeColor(なければNone)
+    """
+    shade = vrm_material['vectorProperties'].get('_ShadeColor')
+    if shade is None or not shares_main_texture(vrm_material):
+        return shade
+    color = tint(vrm_material)
+    return [round(s / float(c), COLOR_DIGITS) for s, c in zip(shade[:3], color[:3])] + list(shade[3:])
+
+
+def merge_key(vrm_material):
+    """
+    :param vrm_material: VRMマテリアル
+    :return: 焼き込み後のテクスチャ以外のプロパティの比較用キー
+    (陰色テクスチャの有無で陰色の計算が変わるので、_MainTexと同じ陰色テクスチャを持つかもキーに含める)
+    """
+    properties = dict(to_json(vrm_material))
+    del properties['name']
+    vectors = dict(properties['vectorProperties'])
+    vectors['_Color'] = WHITE
+    if '_ShadeColor' in vectors:
+        vectors['_ShadeColor'] = baked_shade_color(vrm_material)
+    vectors.pop('_OutlineColor', None)  # 重複排除と同じく除外する
+    properties['vectorProperties'] = vectors
+    properties['textureProperties'] = {k: v for k, v in properties['textureProperties'].items()
+                                       if k not in BAKED_TEXTURES}
+    return hashable(properties), shares_main_texture(vrm_material)
+
+
+def tinted_image(img, color):
+    """
+    :param img: PIL.Imageオブジェクト
+    :param color: 掛ける色(RGBA)
+    :return: 各チャンネルに色を掛けたRGBA画像
+    """
+    bands = img.convert('RGBA').split()
+    return Image.merge('RGBA', [band.point(lambda x, c=c: int(round(x * c))) for band, c in zip(bands, color)])
+
+
+def tinted_png(data, color, image_cache=None):
+    """
+    :param data: 画像ファイルのバイトデータ
+    :param color: 掛ける色(RGBA)
+    :param image_cache: デコード済み画像キャッシュ
+    :return: 色を掛けた画像(pngファイルのバイトデータ)
+    """
+    img = image_cache.load(data) if image_cache is not None else Image.open(BytesIO(data))
+    with BytesIO() as bio:
+        tinted_image(img, color).save(bio, format='png')
+        return bio.getvalue()
+
+
+def bake_tint(vrm_material, material, image):
+    """
+    _Colorを焼き込んだ画像に差し替え、_Colorを白、_ShadeColorを_Colorとの比にする
+    :param vrm_material: VRMマテリアル
+    :param material: 同名のglTFマテリアル(なければNone)
+    :param image: tinted_pngの画像を持つglTF画像
+    """
+    vectors = vrm_material['vectorProperties']
+    if '_ShadeColor' in vectors:
+        vectors['_ShadeColor'] = baked_shade_color(vrm_material)
+    vectors['_Color'] = list(WHITE)
+    if material is not None and 'baseColorFactor' in material.get('pbrMetallicRoughness', {}):
+        material['pbrMetallicRoughness']['baseColorFactor'] = list(WHITE)
+    replace_main_texture(vrm_material, material, image)
+
+
+def replace_main_texture(vrm_material, material, image):
+    """
+    _MainTex(と同じ画像の_ShadeTexture、glTFの基本色テクスチャ)を、コピーしたテクスチャに差し替える
+    元のテクスチャは他のマテリアルと共有している場合があるので、書き換えずにコピーする
+    :param vrm_material: VRMマテリアル
+    :param material: 同名のglTFマテリアル(なければNone)
+    :param image: 差し替え後のテクスチャのglTF画像
+    """
+    textures = vrm_material['textureProperties']
+    main = textures['_MainTex']
+    texture = copy(main)
+    texture['source'] = image
+    if textures.get('_ShadeTexture') is not None:
+        textures['_ShadeTexture'] = texture  # can_bakeで_MainTexと同じ画像であることを確認済み
+    textures['_MainTex'] = texture
+
+    if material is not None and 'pbrMetallicRoughness' in material:
+        pbr = material['pbrMetallicRoughness']
+        if pbr.get('baseColorTexture', {}).get('index') is main:
+            pbr['baseColorTexture']['index'] = texture
+
+
+def shelf_layout(sizes):
+    """
+    画像を高さの順に行(棚)に並べた配置を作成する(縮小はしない)
+    :param sizes: マテリアル名 -> 画像サイズ
+    :return: マテリアル名とテクスチャ配置情報
+    """
+    area = sum(w * h for w, h in sizes.values())
+    width = max(max(w for w, _ in sizes.values()), int(ceil(sqrt(area))))
+    resize_info = {}
+    x, y, row_h = 0, 0, 0
+    for name in sorted(sizes, key=lambda n: (-sizes[n][1], n)):
+        w, h = sizes[name]
+        if x + w > width:
+            x, y, row_h = 0, y + row_h, 0
+        resize_info[name] = {'pos': (x, y), 'size': (w, h)}
+        x += w
+        row_h = max(row_h, h)
+    return resize_info
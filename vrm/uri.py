@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import base64
+import hashlib
+import mmap
+import re
+from os import fstat
+from os.path import join, exists
+from urllib import unquote
+
+"""
+.gltfファイルのURI参照(data URI、外部ファイル)の読み書き
+"""
+
+DATA_URI = re.compile(r'^data:([^;,]*)((?:;[^;,]*)*?)(;base64)?,(.*)$', re.S)
+
+# MIMEタイプ -> 画像ファイルの拡張子
+IMAGE_EXTENSIONS = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg'
+}
+
+# MIMEタイプ -> 画像データ先頭のシグネチャ
+IMAGE_SIGNATURES = {
+    'image/png': b'\x89PNG\r\n\x1a\n',
+    'image/jpeg': b'\xff\xd8\xff'
+}
+
+
+def is_data_uri(uri):
+    return uri.startswith('data:')
+
+
+def decode_data_uri(uri):
+    """
+    :param uri: data URI
+    :return: MIMEタイプ、バイトデータ
+    """
+    match = DATA_URI.match(uri)
+    if not match:
+        raise ValueError('invalid data uri: {}...'.format(uri[:32]))
+    mime_type, _, is_base64, data = match.groups()
+    data = data.encode('ascii') if isinstance(data, unicode) else data
+    return mime_type, base64.b64decode(data) if is_base64 else unquote(data)
+
+
+def uri_path(uri, base_dir):
+    """
+    :param uri: 相対URI
+    :param base_dir: .gltfファイルのディレクトリ
+    :return: ファイルパス
+    """
+    return join(base_dir, unquote(uri.encode('utf-8') if isinstance(uri, unicode) else uri))
+
+
+def read_uri(uri, base_dir, mapped=False):
+    """
+    URIの参照先を読み込む
+    :param uri: data URIまたは相対URI
+    :param base_dir: .gltfファイルのディレクトリ
+    :param mapped: Trueで外部ファイルをメモリマップする(ファイル全体を1つのバイトデータとして読み込まない)
+    :return: バイトデータ(mappedの場合は読み込み専用のmmapオブジェクト、使用後に呼び出し元で閉じる)
+    """
+    if is_data_uri(uri):
+        return decode_data_uri(uri)[1]
+    with open(uri_path(uri, base_dir), 'rb') as fi:
+        if not mapped:
+            return fi.read()
+        if fstat(fi.fileno()).st_size == 0:
+            return b''  # 空のファイルはメモリマップできない
+        return mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def data_mime_type(data):
+    """
+    画像データ先頭のシグネチャからMIMEタイプを判定する
+    :param data: 画像のバイトデータ
+    :return: 画像のMIMEタイプ(PNG、JPEG以外はNone)
+    """
+    for mime_type, signature in IMAGE_SIGNATURES.items():
+        if data[:len(signature)] == signature:
+            return mime_type
+    return None
+
+
+def write_hashed(base_dir, data, extension):
+    """
+    内容のハッシュ値をファイル名にして保存する(同じ内容のファイルがあれば書き込まない)
+    :param base_dir: 保存先ディレクトリ
+    :param data: バイトデータ
+    :param extension: 拡張子
+    :return: ファイル名(相対URI)
+    """
+    name = hashlib.sha1(data).hexdigest()[:16] + extension
+    path = join(base_dir, name)
+    if not exists(path):
+        with open(path, 'wb') as fo:
+            fo.write(data)
+    return name
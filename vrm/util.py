@@ -36,3 +36,30 @@ def exists(func, seq):
         if func(x):
             return True
     return None
+
+
+def unique_instances(seq):
+    """
+    :param seq: リスト
+    :return: 同一インスタンスの重複のないリストを返す(値が等しくても別インスタンスは残す)
+    """
+    ids = set()
+    new_list = []
+    for x in seq:
+        if id(x) not in ids:
+            ids.add(id(x))
+            new_list.append(x)
+    return new_list
+
+
+def hashable(obj):
+    """
+    辞書、リストを値で比較するハッシュ可能なキーに変換する
+    :param obj: JSONの値(辞書、リストの中のglTF要素はオブジェクトの同一性で比較する)
+    :return: ハッシュ可能なキー
+    """
+    if isinstance(obj, dict):
+        return tuple(sorted((k, hashable(v)) for k, v in obj.items()))
+    if isinstance(obj, list):
+        return tuple(hashable(x) for x in obj)
+    return obj
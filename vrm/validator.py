@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import struct
+from array import array
+
+from accessor import COMPONENT_FORMATS, TYPE_SIZES
+
+"""
+保存前のglTF(インデックス番号参照)の範囲情報更新、構造検証
+"""
+
+
+class ValidationError(Exception):
+    """
+    glTFの構造が不正
+    """
+
+    def __init__(self, errors):
+        super(ValidationError, self).__init__('\n'.join(errors))
+        self.errors = errors
+
+
+def array_typecode(component_type):
+    """
+    :param component_type: componentType
+    :return: 同じバイト数のarrayの型コード
+    """
+    fmt = COMPONENT_FORMATS[component_type]
+    size = struct.calcsize('<' + fmt)
+    candidates = {'b': 'b', 'B': 'B', 'h': 'h', 'H': 'H', 'I': 'IL', 'f': 'f'}[fmt]
+    for code in candidates:
+        if array(code).itemsize == size:
+            return code
+    raise ValueError('unsupported componentType: {}'.format(component_type))
+
+
+def accessor_layout(gltf, accessor):
+    """
+    :param gltf: glTFオブジェクト
+    :param accessor: アクセッサー
+    :return: チャンク内の先頭位置、要素のバイト数、ストライド
+    """
+    view = gltf['bufferViews'][accessor['bufferView']]
+    n = TYPE_SIZES[accessor['type']]
+    size = struct.calcsize('<' + COMPONENT_FORMATS[accessor['componentType']]) * n
+    offset = view.get('byteOffset', 0) + accessor.get('byteOffset', 0)
+    return offset, size, view.get('byteStride', size)
+
+
+def accessor_values(gltf, chunks, accessor):
+    """
+    アクセッサーの値をarrayとして読み込む
+    :param gltf: glTFオブジェクト
+    :param chunks: チャンクデータリスト
+    :param accessor: アクセッサー
+    :return: 全要素の成分を並べたarray
+    """
+    view = gltf['bufferViews'][accessor['bufferView']]
+    chunk = chunks[view['buffer']]
+    offset, size, stride = accessor_layout(gltf, accessor)
+    count = accessor['count']
+    if stride == size:
+        data = chunk[offset:offset + size * count]
+    else:
+        data = b''.join(chunk[offset + i * stride:offset + i * stride + size] for i in xrange(count))
+    values = array(array_typecode(accessor['componentType']))
+    values.fromstring(data)
+    return values
+
+
+def bounds_accessors(gltf):
+    """
+    min/maxが必要なアクセッサーのインデックスを列挙する
+    POSITION(モーフターゲットを含む)と、元からmin/maxを持つアクセッサー
+    :param gltf: glTFオブジェクト
+    :return: アクセッサーインデックスのset
+    """
+    indices = set(n for n, a in enumerate(gltf['accessors']) if 'min' in a or 'max' in a)
+    for mesh in gltf['meshes']:
+        for primitive in mesh['primitives']:
+            if 'POSITION' in primitive['attributes']:
+                indices.add(primitive['attributes']['POSITION'])
+            for target in primitive.get('targets', []):
+                if 'POSITION' in target:
+                    indices.add(target['POSITION'])
+    return indices
+
+
+def update_bounds(gltf, chunks):
+    """
+    アクセッサーのmin/maxを再計算する
+    :param gltf: glTFオブジェクト(インデックス番号参照)
+    :param chunks: チャンクデータリスト
+    """
+    for index in bounds_accessors(gltf):
+        accessor = gltf['accessors'][index]
+        if not accessor['count']:
+            continue
+        values = accessor_values(gltf, chunks, accessor)
+        n = TYPE_SIZES[accessor['type']]
+        columns = [values[i::n] for i in xrange(n)]
+        accessor['min'] = [min(c) for c in columns]
+        accessor['max'] = [max(c) for c in columns]
+
+
+def validate_buffers(gltf, chunks):
+    """
+    バッファ、bufferView、アクセッサーの範囲を検証する
+    :param gltf: glTFオブジェクト
+    :param chunks: チャンクデータリスト
+    :return: エラーメッセージリスト(generator)
+    """
+    buffers = gltf['buffers']
+    for n, buf in enumerate(buffers):
+        if n >= len(chunks) or buf['byteLength'] > len(chunks[n]):
+            yield 'buffers[{}]: byteLength exceeds chunk length'.format(n)
+
+    views = gltf['bufferViews']
+    for n, view in enumerate(views):
+        if not 0 <= view['buffer'] < len(buffers):
+            yield 'bufferViews[{}]: invalid buffer {}'.format(n, view['buffer'])
+            continue
+        if view.get('byteOffset', 0) + view['byteLength'] > buffers[view['buffer']]['byteLength']:
+            yield 'bufferViews[{}]: range exceeds buffer'.format(n)
+        stride = view.get('byteStride')
+        if stride is not None and (stride < 4 or stride > 252 or stride % 4):
+            yield 'bufferViews[{}]: invalid byteStride {}'.format(n, stride)
+
+    for n, accessor in enumerate(gltf['accessors']):
+        if not 0 <= accessor['bufferView'] < len(views):
+            yield 'accessors[{}]: invalid bufferView {}'.format(n, accessor['bufferView'])
+            continue
+        view = views[accessor['bufferView']]
+        offset, size, stride = accessor_layout(gltf, accessor)
+        component = size // TYPE_SIZES[accessor['type']]
+        if offset % component:
+            yield 'accessors[{}]: offset {} is not aligned to {} bytes'.format(n, offset, component)
+        if stride < size:
+            yield 'accessors[{}]: byteStride {} is less than element size {}'.format(n, stride, size)
+        end = accessor.get('byteOffset', 0) + stride * (accessor['count'] - 1) + size
+        if accessor['count'] and end > view['byteLength']:
+            yield 'accessors[{}]: range exceeds bufferView {}'.format(n, accessor['bufferView'])
+
+
+def validate_meshes(gltf, chunks):
+    """
+    プリミティブの参照、頂点数、インデックス範囲を検証する
+    :param gltf: glTFオブジェクト
+    :param chunks: チャンクデータリスト
+    :return: エラーメッセージリスト(generator)
+    """
+    accessors = gltf['accessors']
+    skins = gltf['skins']
+    # メッシュ -> スキンのジョイント数
+    joint_counts = {node['mesh']: len(skins[node['skin']]['joints']) for node in gltf['nodes']
+                    if 'mesh' in node and 'skin' in node and node['skin'] < len(skins)}
+
+    for m, mesh in enumerate(gltf['meshes']):
+        for p, primitive in enumerate(mesh['primitives']):
+            name = 'meshes[{}].primitives[{}]'.format(m, p)
+            references = list(primitive['attributes'].values()) + [v for t in primitive.get('targets', [])
+                                                                   for v in t.values()]
+            if 'indices' in primitive:
+                references.append(primitive['indices'])
+            if any(not 0 <= a < len(accessors) for a in references):
+                yield '{}: invalid accessor'.format(name)
+                continue
+            if not 0 <= primitive.get('material', 0) < len(gltf['materials']):
+                yield '{}: invalid material {}'.format(name, primitive['material'])
+
+            counts = set(accessors[a]['count'] for a in references if a != primitive.get('indices'))
+            if len(counts) != 1:
+                yield '{}: vertex attributes have different counts {}'.format(name, sorted(counts))
+                continue
+            vertex_count = counts.pop()
+
+            if 'indices' in primitive:
+                indices = accessor_values(gltf, chunks, accessors[primitive['indices']])
+                if indices and max(indices) >= vertex_count:
+                    yield '{}: index {} out of range (vertex count {})'.format(name, max(indices), vertex_count)
+
+            joints = primitive['attributes'].get('JOINTS_0')
+            if joints is not None and m in joint_counts:
+                values = accessor_values(gltf, chunks, accessors[joints])
+                if values and max(values) >= joint_counts[m]:
+                    yield '{}: joint {} out of range (joint count {})'.format(name, max(values), joint_counts[m])
+
+
+def validate_references(gltf):
+    """
+    ノード、スキン、画像、テクスチャの参照を検証する
+    :param gltf: glTFオブジェクト
+    :return: エラーメッセージリスト(generator)
+    """
+    nodes = gltf['nodes']
+    for n, node in enumerate(nodes):
+        if any(not 0 <= c < len(nodes) for c in node.get('children', [])):
+            yield 'nodes[{}]: invalid children'.format(n)
+        if 'mesh' in node and not 0 <= node['mesh'] < len(gltf['meshes']):
+            yield 'nodes[{}]: invalid mesh {}'.format(n, node['mesh'])
+        if 'skin' in node and not 0 <= node['skin'] < len(gltf['skins']):
+            yield 'nodes[{}]: invalid skin {}'.format(n, node['skin'])
+
+    accessors = gltf['accessors']
+    for n, skin in enumerate(gltf['skins']):
+        if any(not 0 <= j < len(nodes) for j in skin['joints']):
+            yield 'skins[{}]: invalid joints'.format(n)
+        if 'inverseBindMatrices' not in skin:
+            continue
+        if not 0 <= skin['inverseBindMatrices'] < len(accessors):
+            yield 'skins[{}]: invalid inverseBindMatrices {}'.format(n, skin['inverseBindMatrices'])
+        elif accessors[skin['inverseBindMatrices']]['count'] != len(skin['joints']):
+            yield 'skins[{}]: inverseBindMatrices count does not match joints'.format(n)
+
+    for n, image in enumerate(gltf['images']):
+        if 'bufferView' in image and not 0 <= image['bufferView'] < len(gltf['bufferViews']):
+            yield 'images[{}]: invalid bufferView {}'.format(n, image['bufferView'])
+
+    for n, texture in enumerate(gltf['textures']):
+        if not 0 <= texture['source'] < len(gltf['images']):
+            yield 'textures[{}]: invalid source {}'.format(n, texture['source'])
+
+
+def validate(gltf, chunks):
+    """
+    glTFの構造を検証する
+    :param gltf: glTFオブジェクト(インデックス番号参照)
+    :param chunks: チャンクデータリスト
+    :return: エラーメッセージリスト
+    """
+    errors = list(validate_buffers(gltf, chunks))
+    if errors:
+        return errors  # 範囲外の読み込みを避けるため、以降の検証を行わない
+    return list(validate_references(gltf)) + list(validate_meshes(gltf, chunks))
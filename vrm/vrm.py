@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 import json
+import mmap
 import struct
+from os.path import dirname
 
 from gltf import instancing, indexing
+from uri import read_uri, data_mime_type, write_hashed, IMAGE_EXTENSIONS
+from validator import update_bounds, validate, ValidationError
 
 
 def read_binary(path):
@@ -15,6 +19,13 @@ GLTF_MAGIC = 0x46546c67  # glTF
 JSON_TYPE = 0x4e4f534a  # JSON
 CHUNK_TYPE = 0x4e4942  # BIN
 
+# .gltfファイルを読み込んだ場合のバージョン(GLBヘッダーのバージョン)
+GLTF_VERSION = 2
+
+
+def is_gltf_path(path):
+    return path.lower().endswith('.gltf')
+
 
 class VRM(object):
     def __init__(self, version, gltf, chunks):
@@ -27,37 +38,219 @@ class VRM(object):
         self.version = version
         self.gltf = instancing(gltf, chunks)  # インデックス番号を参照に変換
 
-    def save(self, path):
+    def save(self, path, interleaved=False):
         """
-        VRMファイル保存
+        VRMファイル保存(拡張子が.gltfの場合はsave_gltfで保存する)
         :param path: 保存先ファイルパス
+        :param interleaved: Trueで頂点属性をインターリーブして保存する
+        """
+        if is_gltf_path(path):
+            self.save_gltf(path, interleaved)
+            return
+        glb_bin = self.dumps(interleaved)
+        with open(path, 'wb') as fo:
+            fo.write(glb_bin)
+
+    def indexed(self, interleaved=False):
+        """
+        保存用のglTFオブジェクトに変換する
+        :param interleaved: Trueで頂点属性をインターリーブする
+        :return: glTFオブジェクト(インデックス番号参照)、チャンクデータリスト
+        """
+        gltf, chunks = indexing(self.gltf, interleaved)  # 参照をインデックス番号に変換
+
+        # アクセッサーの範囲情報を更新し、構造を検証する
+        update_bounds(gltf, chunks)
+        errors = validate(gltf, chunks)
+        if errors:
+            raise ValidationError(errors)
+        return gltf, chunks
+
+    def dumps(self, interleaved=False):
+        """
+        VRMファイルのバイトデータに変換する
+        :param interleaved: Trueで頂点属性をインターリーブして保存する
+        :return: VRMファイルのバイトデータ
         """
+        gltf, chunks = self.indexed(interleaved)
+
+        # チャンクは4バイト境界に揃える(JSONは空白、バイナリは0で埋める)
+        gltf_encoded = json.dumps(gltf).encode('utf-8')
+        gltf_encoded += b' ' * (-len(gltf_encoded) % 4)
+        chunks = [chunk + b'\0' * (-len(chunk) % 4) for chunk in chunks]
+        glb_length = 20 + len(gltf_encoded) + sum(8 + len(chunk) for chunk in chunks)
+
+        # glTF header
+        data = [struct.pack('5I', GLTF_MAGIC, self.version, glb_length, len(gltf_encoded), JSON_TYPE)]
+        # glTF JSON
+        data.append(gltf_encoded)
+        # chunk data
+        for chunk in chunks:
+            data.append(struct.pack('2I', len(chunk), CHUNK_TYPE))
+            data.append(chunk)
+        return b''.join(data)
+
+    def save_gltf(self, path, interleaved=False):
+        """
+        .gltfファイルと、内容のハッシュ値をファイル名にした画像、.binファイルに分けて保存する
+        画像は1ファイルずつ、ジオメトリは最初に参照するメッシュごとに1ファイルにまとめるので、
+        バージョン間で変更のない画像、メッシュは同じファイル名になる
+        :param path: 保存先の.gltfファイルパス
+        :param interleaved: Trueで頂点属性をインターリーブして保存する
+        """
+        gltf, chunks = self.indexed(interleaved)
+        base_dir = dirname(path)
+        chunk = chunks[0]
+        views = gltf['bufferViews']
+
+        def view_data(view):
+            offset = view['byteOffset']
+            return chunk[offset:offset + view['byteLength']]
+
+        # 画像は個別のファイルに保存
+        image_views = set()
+        for image in gltf['images']:
+            if 'bufferView' not in image:
+                continue
+            n = image.pop('bufferView')
+            image_views.add(n)
+            extension = IMAGE_EXTENSIONS.get(image.get('mimeType'), '.bin')
+            image['uri'] = write_hashed(base_dir, view_data(views[n]), extension)
+
+        # 画像以外のbufferViewを参照元ごとの.binファイルにまとめる
+        buffers = []
+        view_map = {}  # 元のbufferViewインデックス -> 新しいbufferViewインデックス
+        new_views = []
+        for group in view_groups(gltf, image_views):
+            datas = []
+            offset = 0
+            for n in group:
+                data = view_data(views[n])
+                padding = -offset % 4  # アクセッサーのアライメントのため4バイト境界に揃える
+                datas.append(b'\0' * padding)
+                offset += padding
+                view = dict(views[n], buffer=len(buffers), byteOffset=offset)
+                view_map[n] = len(new_views)
+                new_views.append(view)
+                datas.append(data)
+                offset += len(data)
+            data = b''.join(datas)
+            buffers.append({'uri': write_hashed(base_dir, data, '.bin'), 'byteLength': len(data)})
+        gltf['buffers'] = buffers
+        gltf['bufferViews'] = new_views
+        for accessor in gltf['accessors']:
+            if 'bufferView' in accessor:
+                accessor['bufferView'] = view_map[accessor['bufferView']]
+
         with open(path, 'wb') as fo:
-            gltf, chunks = indexing(self.gltf)  # 参照をインデックス番号に変換
-            gltf_encoded = json.dumps(gltf).encode('utf-8')
-            glb_length = 20 + len(gltf_encoded) + sum(map(len, chunks))
-
-            # glTF header
-            for v in [GLTF_MAGIC, self.version, glb_length, len(gltf_encoded), JSON_TYPE]:
-                fo.write(struct.pack('I', v))
-            # glTF JSON
-            fo.write(gltf_encoded)
-            # chunk data
-            for chunk in chunks:
-                for v in [len(chunk), CHUNK_TYPE]:
-                    fo.write(struct.pack('I', v))
-                fo.write(chunk)
+            fo.write(json.dumps(gltf).encode('utf-8'))
+
+
+def view_groups(gltf, excluded):
+    """
+    bufferViewを最初に参照するメッシュごとにまとめる(メッシュ以外から参照されるものは最後にまとめる)
+    :param gltf: glTFオブジェクト(インデックス番号参照)
+    :param excluded: 除外するbufferViewインデックスのset
+    :return: bufferViewインデックスリストのリスト
+    """
+    accessors = gltf['accessors']
+    groups = []
+    grouped = set(excluded)
+    for mesh in gltf['meshes']:
+        group = []
+        for primitive in mesh['primitives']:
+            indices = [primitive['indices']] if 'indices' in primitive else []
+            indices += primitive['attributes'].values()
+            indices += [a for target in primitive.get('targets', []) for a in target.values()]
+            for n in indices:
+                view = accessors[n].get('bufferView')
+                if view is not None and view not in grouped:
+                    grouped.add(view)
+                    group.append(view)
+        groups.append(group)
+    groups.append([n for n in xrange(len(gltf['bufferViews'])) if n not in grouped])
+    return [sorted(group) for group in groups if group]
 
 
 def load(path):
     """
-    VRM読み込み
+    VRM読み込み(拡張子が.gltfの場合はload_gltfで読み込む)
     :param path: VRMファイルパス
     :return: VRMオブジェクト
     """
+    if is_gltf_path(path):
+        return load_gltf(path)
+    return loads(read_binary(path))
+
+
+def load_gltf(path):
+    """
+    外部ファイル、data URIのバッファ、画像を参照する.gltfファイルを読み込む
+    外部の.binファイルはファイル全体を1つのバイトデータにせず、メモリマップからbufferViewごとに切り出す
+    (切り出したデータはPayloadStoreが有効なら順に退避できる)
+    URI参照の画像はファイル全体を読み込む(mimeTypeがなければデータのシグネチャから判定する)
+    :param path: .gltfファイルパス
+    :return: VRMオブジェクト
+    :raise ValueError: mimeTypeがなく、PNG、JPEGのどちらとも判定できない画像がある場合
+    """
+    with open(path, 'rb') as fi:
+        gltf = json.loads(fi.read().decode('utf-8'))
+    base_dir = dirname(path)
+    buffers = gltf.setdefault('buffers', [])
+    chunks = [read_uri(buf['uri'], base_dir, mapped=True) if 'uri' in buf else b'' for buf in buffers]
+
+    # URI参照の画像は読み込んでbufferViewに変換する(軽量化処理は画像をbufferViewのデータとして扱う)
+    views = gltf.setdefault('bufferViews', [])
+    for image in gltf.get('images', []):
+        if 'uri' not in image:
+            continue
+        uri = image.pop('uri')
+        data = read_uri(uri, base_dir)
+        if 'mimeType' not in image:
+            mime_type = data_mime_type(data)
+            if mime_type is None:
+                raise ValueError('unknown image type (not PNG or JPEG): {}'.format(uri[:64]))
+            image['mimeType'] = mime_type
+        image['bufferView'] = len(views)
+        views.append({'buffer': len(buffers), 'byteOffset': 0, 'byteLength': len(data)})
+        buffers.append({'byteLength': len(data)})
+        chunks.append(data)
+
+    try:
+        return VRM(GLTF_VERSION, gltf, chunks)
+    finally:
+        # bufferViewのデータは切り出し済みなので、メモリマップを閉じる
+        for chunk in chunks:
+            if isinstance(chunk, mmap.mmap):
+                chunk.close()
+
+
+def load_json(path):
+    """
+    VRMファイルのヘッダーとJSONチャンクのみを読み込む(BINチャンクは読まない)
+    :param path: VRMファイルパス
+    :return: VRMバージョン、glTFオブジェクト(インデックス番号参照)、BINチャンクのデータの先頭位置(.gltfファイルはNone)
+    """
+    if is_gltf_path(path):
+        with open(path, 'rb') as fi:
+            return GLTF_VERSION, json.loads(fi.read().decode('utf-8')), None
+    with open(path, 'rb') as fi:
+        # glTF header, JSON chunk header
+        gltf_magic, version, length, json_length, json_type = struct.unpack('5I', fi.read(20))
+        assert gltf_magic == GLTF_MAGIC
+        assert json_type == JSON_TYPE
+        gltf = json.loads(fi.read(json_length).decode('utf-8'))
+    return version, gltf, 20 + json_length + 8
+
+
+def loads(glb_bin):
+    """
+    VRMファイルのバイトデータから読み込む
+    :param glb_bin: VRMファイルのバイトデータ
+    :return: VRMオブジェクト
+    """
 
     # glb header
-    glb_bin = read_binary(path)
     struct.unpack_from("II", glb_bin)
 
     # glTF header
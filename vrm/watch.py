@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import struct
+from copy import copy
+from os import stat
+from time import sleep, time
+
+from imagecache import DEFAULT_MAX_BYTES
+from memo import Memo
+from vrm import load
+
+"""
+VRMファイルの監視と差分変換
+ファイルが更新されるたびに変換し、入力が変わらない処理は前回の結果を再利用する
+"""
+
+# ファイル更新の確認間隔(秒)
+POLL_INTERVAL = 0.5
+
+
+def file_state(path):
+    """
+    :param path: ファイルパス
+    :return: (更新日時, ファイルサイズ)、ファイルがなければNone
+    """
+    try:
+        st = stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+def wait_for_change(path, last_state, interval=POLL_INTERVAL):
+    """
+    ファイルが更新され、書き込みが終わる(1周期の間状態が変わらない)まで待つ
+    :param path: ファイルパス
+    :param last_state: 前回変換時のファイルの状態
+    :param interval: 確認間隔(秒)
+    :return: 更新後のファイルの状態
+    """
+    while True:
+        state = file_state(path)
+        if state is not None and state != last_state:
+            sleep(interval)
+            if file_state(path) == state:
+                return state
+            continue
+        sleep(interval)
+
+
+class Watcher(object):
+    def __init__(self, reduce, image_cache_bytes=DEFAULT_MAX_BYTES):
+        """
+        変換をまたいで処理結果を保持する変換器
+        :param reduce: (glTFオブジェクト, デコード済み画像キャッシュ, Memoオブジェクト) -> 軽量化したglTFオブジェクト
+        :param image_cache_bytes: デコード済み画像のメモリ量の上限
+        """
+        self.reduce = reduce
+        self.image_cache_bytes = image_cache_bytes
+        self.memo = Memo()
+        self.checkpoint = None  # 前回変換したモデルのハッシュ値
+
+    def convert(self, vrm):
+        """
+        :param vrm: VRMオブジェクト
+        :return: 軽量化したVRMオブジェクト、前回と同じモデルならNone
+        """
+        key = self.memo.key('model', vrm.gltf)
+        if key == self.checkpoint:
+            return None  # 保存し直しただけ
+        image_cache = self.memo.image_cache(vrm.gltf, self.image_cache_bytes)
+        result = copy(vrm)
+        result.gltf = self.reduce(vrm.gltf, image_cache, self.memo)
+        self.memo.finish(image_cache)
+        self.checkpoint = key
+        return result
+
+
+def watch(path, watcher, save, interval=POLL_INTERVAL):
+    """
+    ファイルを監視して更新されるたびに変換する(Ctrl+Cで終了)
+    :param path: VRMファイルパス
+    :param watcher: Watcherオブジェクト
+    :param save: 変換したVRMオブジェクトを保存する関数
+    :param interval: 確認間隔(秒)
+    """
+    print 'watching {} (Ctrl+C to stop)'.format(path)
+    state = None
+    try:
+        while True:
+            state = wait_for_change(path, state, interval)
+            start = time()
+            try:
+                result = watcher.convert(load(path))
+            except (IOError, AssertionError, struct.error, ValueError, KeyError, IndexError) as e:
+                # 書き出し途中、壊れたファイルは次の更新を待つ
+                print 'failed to convert: {}'.format(e)
+                continue
+            if result is None:
+                print 'no changes.'
+                continue
+            save(result)
+            print 'converted in {:.2f}s'.format(time() - start)
+    except KeyboardInterrupt:
+        pass